@@ -7,6 +7,7 @@ admin.site.register(Workout)
 admin.site.register(UserImageFile)
 admin.site.register(Profile)
 admin.site.register(Community)
+admin.site.register(CommunityMembership)
 admin.site.register(Challenge)
 admin.site.register(ChallengeParticipant)
 admin.site.register(RemovedCommunityMember)
\ No newline at end of file
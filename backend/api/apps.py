@@ -7,4 +7,11 @@ class ApiConfig(AppConfig):
 
     def ready(self):
         import api.signal
+        from django.conf import settings
+        if settings.METRICS_ENABLED:
+            from django.db.backends.signals import connection_created
+            from api.metrics import instrument_serializers, install_query_recorder
+            instrument_serializers()
+            install_query_recorder()
+            connection_created.connect(install_query_recorder)
 
@@ -0,0 +1,52 @@
+from inspect import isawaitable
+from asgiref.sync import sync_to_async
+from rest_framework.views import APIView
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers are coroutines. DRF 3.14 only dispatches sync
+    handlers, so authentication, permission and throttle checks run in the
+    request's database thread and the handler runs on the event loop.
+    """
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            if isawaitable(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+def async_api_view(http_method_names):
+    """
+    Counterpart of DRF's @api_view for `async def` views. Honours
+    @permission_classes the same way.
+    """
+    def decorator(func):
+        async def handler(self, *args, **kwargs):
+            return await func(*args, **kwargs)
+
+        attributes = {method.lower(): handler for method in http_method_names}
+        attributes['http_method_names'] = [*attributes, 'options']
+        attributes['__doc__'] = func.__doc__
+        if hasattr(func, 'permission_classes'):
+            attributes['permission_classes'] = func.permission_classes
+        view_class = type(func.__name__, (AsyncAPIView,), attributes)
+        view_class.__module__ = func.__module__
+        return view_class.as_view()
+    return decorator
@@ -0,0 +1,112 @@
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from rest_framework_simplejwt.tokens import RefreshToken
+from api.models import Profile
+
+BLACKLIST_KEY = 'token_blacklist:{}'
+REVOKED_USER_KEY = 'revoked_user:{}'
+
+
+def add_profile_claims(token, user):
+    token['username'] = user.username
+    profile_id = Profile.objects.filter(user=user).values_list('id', flat=True).first()
+    if profile_id:
+        token['profile_id'] = profile_id
+    return token
+
+
+class ProfileJWTAuthentication(JWTAuthentication):
+    """
+    Builds request.user from the access token instead of loading the user row.
+    The user is a real User instance with only id and username loaded, so it
+    works in queries and foreign keys, and any other field is read the first
+    time it is accessed. Tokens without the profile claims are authenticated
+    the usual way.
+
+    Users that were deactivated or deleted since are marked in the cache by
+    revoke_user_tokens(), and their tokens go through the usual lookup, which
+    rejects them. The marker is set from signals, so a QuerySet.update() of
+    is_active does not revoke anything. Without a shared cache
+    (AUTH_TRUST_TOKEN_CLAIMS off) other workers would not see the marker, so
+    every token is looked up the usual way.
+    """
+    def get_user(self, validated_token):
+        claims = [api_settings.USER_ID_CLAIM, 'profile_id', 'username']
+        if not settings.AUTH_TRUST_TOKEN_CLAIMS or api_settings.CHECK_REVOKE_TOKEN or any(x not in validated_token for x in claims) \
+                or cache.get(REVOKED_USER_KEY.format(validated_token[api_settings.USER_ID_CLAIM])):
+            return super().get_user(validated_token)
+
+        user = User.from_db(DEFAULT_DB_ALIAS, [api_settings.USER_ID_FIELD, 'username'], [validated_token[api_settings.USER_ID_CLAIM], validated_token['username']])
+        user.profile_id = validated_token['profile_id']
+        return user
+
+
+def revoke_user_tokens(user_id):
+    # Access tokens issued before now expire within ACCESS_TOKEN_LIFETIME
+    cache.set(REVOKED_USER_KEY.format(user_id), True, int(api_settings.ACCESS_TOKEN_LIFETIME.total_seconds()))
+
+
+def get_profile_ref(user):
+    """
+    The user's profile with only its id loaded, for filtering and foreign keys.
+    Costs no query when the profile id came with the access token.
+    """
+    if getattr(user, 'profile_id', None) is None:
+        return get_request_profile(user)
+    profile = Profile.from_db(DEFAULT_DB_ALIAS, ['id', 'user_id'], [user.profile_id, user.id])
+    profile._state.fields_cache['user'] = user
+    return profile
+
+
+def get_request_profile(user):
+    """
+    The user's full profile, loaded on first use and kept for the rest of the
+    request.
+    """
+    if getattr(user, '_request_profile', None) is None:
+        profiles = Profile.objects.select_related('user', 'img')
+        user._request_profile = profiles.get(id=user.profile_id) if getattr(user, 'profile_id', None) else profiles.get(user=user)
+    return user._request_profile
+
+
+def remember_blacklisted(jti, exp):
+    # Kept until the token expires, after which it fails validation anyway.
+    # Also replaces a cached miss for the token.
+    cache.set(BLACKLIST_KEY.format(jti), True, max(int(exp - time.time()), 1))
+
+
+def is_blacklisted(jti, exp):
+    """
+    Answers from the cache when it can. Misses are only cached for
+    AUTH_BLACKLIST_MISS_SECONDS and never past the token's expiry, since a
+    logout handled by another worker only clears them in a shared cache.
+    """
+    key = BLACKLIST_KEY.format(jti)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    if BlacklistedToken.objects.filter(token__jti=jti).exists():
+        remember_blacklisted(jti, exp)
+        return True
+    timeout = min(settings.AUTH_BLACKLIST_MISS_SECONDS, int(exp - time.time()))
+    if timeout > 0:
+        cache.set(key, False, timeout)
+    return False
+
+
+class CachedRefreshToken(RefreshToken):
+    def check_blacklist(self):
+        if is_blacklisted(self.payload[api_settings.JTI_CLAIM], self.payload['exp']):
+            raise TokenError("Token is blacklisted")
+
+    def blacklist(self):
+        result = super().blacklist()
+        remember_blacklisted(self.payload[api_settings.JTI_CLAIM], self.payload['exp'])
+        return result
@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import time
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from api.models import WorkoutType
+from api.serializer import WorkoutTypeSerializerOne
+from api.renderers import ORJSONRenderer
+
+# The workout type catalogue is cached per version stamp. The stamp lives in
+# the shared cache and is replaced whenever a WorkoutType is saved or deleted,
+# so every process rebuilds its in-process copy on the next lookup.
+VERSION_KEY = 'workout_types:version'
+CATALOGUE_KEY = 'workout_types:catalogue:{}'
+
+_local = {'version': None, 'catalogue': None}
+_local_lock = threading.Lock()
+
+
+def get_workout_types_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, str(time.time_ns()), settings.WORKOUT_TYPES_CACHE_TIMEOUT)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_workout_types_version():
+    cache.set(VERSION_KEY, str(time.time_ns()), settings.WORKOUT_TYPES_CACHE_TIMEOUT)
+
+
+def build_catalogue(version):
+    workout_types = list(WorkoutType.objects.order_by('-id'))
+    return {
+        'version': version,
+        'types': {x.id: x for x in workout_types},
+        'data': WorkoutTypeSerializerOne(workout_types, many=True).data,
+        'payloads': {},
+    }
+
+
+def get_workout_type_catalogue():
+    version = get_workout_types_version()
+    catalogue = _local['catalogue']
+    if catalogue is not None and _local['version'] == version:
+        return catalogue
+
+    catalogue = cache.get(CATALOGUE_KEY.format(version))
+    if catalogue is None:
+        catalogue = build_catalogue(version)
+        cache.set(CATALOGUE_KEY.format(version), catalogue, settings.WORKOUT_TYPES_CACHE_TIMEOUT)
+    with _local_lock:
+        _local['version'], _local['catalogue'] = version, catalogue
+    return catalogue
+
+
+def get_workout_type(workout_type_id:int):
+    workout_type = get_workout_type_catalogue()['types'].get(workout_type_id)
+    if workout_type is None:
+        raise WorkoutType.DoesNotExist(f"WorkoutType {workout_type_id} does not exist")
+    return workout_type
+
+
+def get_workout_types(workout_type_ids):
+    types = get_workout_type_catalogue()['types']
+    return [types[x] for x in workout_type_ids if x in types]
+
+
+def get_app_data_payload():
+    # Rendered bytes and ETag of the app/data response, built once per
+    # catalogue version and year.
+    catalogue = get_workout_type_catalogue()
+    current_year = timezone.now().year
+    payload = catalogue['payloads'].get(current_year)
+    if payload is None:
+        content = ORJSONRenderer().render({
+            'workout_types': catalogue['data'],
+            'current_year_start_date': datetime(current_year, 1, 1).strftime("%Y-%m-%d"),
+            'current_year_end_date': datetime(current_year, 12, 31).strftime("%Y-%m-%d"),
+        })
+        payload = (content, f'"{hashlib.md5(content).hexdigest()}"')
+        catalogue['payloads'][current_year] = payload
+    return payload
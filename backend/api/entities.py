@@ -0,0 +1,168 @@
+from collections import defaultdict
+from django.db.models import Exists, OuterRef
+from api.models import *
+from api.catalogue import get_workout_type_catalogue
+from api.projections import ImageURLs, get_member_values
+from api.serializer import get_default_image, get_image_url
+
+
+class EntityMap:
+    """
+    Identity map for the normalized response shape (?shape=normalized). The
+    payload refers to profiles, images and workout types by id, and each of
+    them is loaded and serialized once per request into the 'entities' section.
+    """
+    def __init__(self):
+        self.urls = ImageURLs()
+        self.profiles = {}
+        self.images = {}
+        self.workout_types = set()
+        # Referenced by id only, loaded together when the entities are returned
+        self.missing_profiles = set()
+        # Communities of the response. Referenced profiles that are not members
+        # of any of them, like past challenge participants, only get a username.
+        self.community_ids = set()
+
+    def add_image(self, row:dict, relation:str='img'):
+        image_id = row[relation]
+        if image_id and image_id not in self.images:
+            self.images[image_id] = {
+                'id': image_id,
+                'status': row[f"{relation}__status"],
+                **{x: self.urls.get_image_url(row, relation, x) for x in ['url', 'medium', 'thumb']},
+            }
+        return image_id
+
+    def add_image_file(self, image):
+        if image and image.id not in self.images:
+            self.images[image.id] = {
+                'id': image.id,
+                'status': image.status,
+                **{x: get_image_url(image, x) for x in ['url', 'medium', 'thumb']},
+            }
+        return image.id if image else None
+
+    def add_profile(self, row:dict, prefix:str=''):
+        # row comes from get_member_values()
+        profile_id = row[f"{prefix}id"]
+        if profile_id not in self.profiles:
+            self.profiles[profile_id] = {
+                'id': profile_id,
+                'username': row[f"{prefix}user__username"],
+                'email': row[f"{prefix}user__email"],
+                'gender': row[f"{prefix}gender"],
+                'bio': row[f"{prefix}bio"],
+                'country': row[f"{prefix}country"],
+                'city': row[f"{prefix}city"],
+                'age': row[f"{prefix}age"],
+                'height': row[f"{prefix}height"],
+                'weight': row[f"{prefix}weight"],
+                'img': self.add_image(row, f"{prefix}img"),
+            }
+        return profile_id
+
+    def ref_profile(self, profile_id:int):
+        if profile_id not in self.profiles:
+            self.missing_profiles.add(profile_id)
+        return profile_id
+
+    def ref_workout_type(self, workout_type_id:int):
+        self.workout_types.add(workout_type_id)
+        return workout_type_id
+
+    def get_entities(self):
+        missing = self.missing_profiles - set(self.profiles)
+        if missing:
+            is_member = Exists(CommunityMembership.objects.filter(profile_id=OuterRef('id'), community_id__in=self.community_ids))
+            for row in get_member_values(Profile.objects.filter(id__in=missing).annotate(is_member=is_member), '', 'is_member'):
+                if row['is_member']:
+                    self.add_profile(row)
+                else:
+                    self.profiles[row['id']] = {'id': row['id'], 'username': row['user__username']}
+        self.missing_profiles = set()
+
+        # JSON object keys are strings, so the ids are too
+        return {
+            'profiles': {str(key): value for key, value in self.profiles.items()},
+            'images': {str(key): value for key, value in self.images.items()},
+            'workout_types': {str(x['id']): x for x in get_workout_type_catalogue()['data'] if x['id'] in self.workout_types},
+        }
+
+
+def get_default_images():
+    # Shown by clients for entities whose img is null or not ready
+    return {
+        'profile': get_default_image('staff_img'),
+        'community': get_default_image('app_logo'),
+        'workout': get_default_image('app_logo'),
+    }
+
+
+def get_normalized_workouts(rows, entities:EntityMap):
+    # rows come from get_workout_values()
+    return [{
+        'id': row['id'],
+        'img': entities.add_image(row),
+        'workout_type': entities.ref_workout_type(row['workout_type']),
+        'duration': row['duration'],
+        'calories_burned': row['calories_burned'],
+        'points': row['points'],
+        'date': row['date'],
+    } for row in rows]
+
+
+def get_normalized_community(community, entities:EntityMap):
+    # community comes from get_community_summary_queryset()
+    return {
+        'id': community.id,
+        'name': community.name,
+        'description': community.description,
+        'img': entities.add_image_file(community.img),
+        'join_code': community.join_code,
+        'date': community.date,
+        'member_count': community.member_count,
+        'admin_count': community.admin_count,
+        'active_challenge_count': community.active_challenge_count,
+        'role': 'admin' if community.is_admin else 'member' if community.is_member else None,
+    }
+
+
+def get_normalized_participant(row:dict, entities:EntityMap):
+    return {
+        'id': row['id'],
+        'profile': entities.ref_profile(row['profile_id']),
+        'points': row['points'],
+        'rank': row['rank'],
+        'date_joined': row['date_joined'],
+    }
+
+
+def get_participant_values(participants):
+    return participants.values('id', 'challenge_id', 'profile_id', 'points', 'rank', 'date_joined')
+
+
+def get_normalized_challenges(rows, entities:EntityMap):
+    # rows come from get_challenge_values()
+    rows = list(rows)
+    if not rows:
+        return []
+    challenge_ids = [x['id'] for x in rows]
+    workout_types = defaultdict(list)
+    for challenge_id, workout_type_id in Challenge.workout_types.through.objects.filter(challenge_id__in=challenge_ids).order_by('-workouttype_id').values_list('challenge_id', 'workouttype_id'):
+        workout_types[challenge_id].append(entities.ref_workout_type(workout_type_id))
+
+    participants = defaultdict(list)
+    for row in get_participant_values(ChallengeParticipant.objects.filter(challenge_id__in=challenge_ids).order_by('rank', 'id')):
+        participants[row['challenge_id']].append(get_normalized_participant(row, entities))
+
+    return [{
+        'id': row['id'],
+        'community': row['community_id'],
+        'name': row['name'],
+        'description': row['description'],
+        'workout_types': workout_types[row['id']],
+        'start_date': row['start_date'],
+        'end_date': row['end_date'],
+        'date': row['date'],
+        'participants': participants[row['id']],
+    } for row in rows]
@@ -0,0 +1,151 @@
+import io
+import os
+import uuid
+import traceback
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+from api.models import UserImageFile, Workout, Community
+from api.metrics import track
+from api.storage import delete_stored_files
+from api.sync import log_change
+from api.utils import log_error
+
+# Longest edge in pixels for each stored rendition. 'original' replaces the
+# uploaded file, capped so multi-megabyte phone photos are not kept as is.
+RENDITION_SIZES = {
+    'thumb': 160,
+    'medium': 720,
+    'original': 2048,
+}
+
+
+def render_image(image, max_size:int, image_format:str):
+    rendition = image.copy()
+    rendition.thumbnail((max_size, max_size), Image.LANCZOS)
+    if image_format == 'JPEG' and rendition.mode != 'RGB':
+        rendition = rendition.convert('RGB')
+
+    output = io.BytesIO()
+    # Nothing from the source info (EXIF, GPS, ICC) is passed to save(),
+    # so the rendition is written without metadata
+    rendition.save(output, format=image_format, quality=settings.IMAGE_RENDITION_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def create_renditions(uploaded_file):
+    uploaded_file.seek(0)
+    with Image.open(uploaded_file) as source:
+        image = ImageOps.exif_transpose(source)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    image_format = settings.IMAGE_RENDITION_FORMAT
+    extension = 'webp' if image_format == 'WEBP' else 'jpg'
+    stem = os.path.splitext(os.path.basename(uploaded_file.name or 'image'))[0]
+    return {
+        name: ContentFile(render_image(image, size, image_format), name=f"{stem}_{name}.{extension}")
+        for name, size in RENDITION_SIZES.items()
+    }
+
+
+def create_user_image(user, uploaded_file):
+    renditions = create_renditions(uploaded_file)
+    with track('storage'):
+        return UserImageFile.objects.create(
+            user=user,
+            url=renditions['original'],
+            thumb=renditions['thumb'],
+            medium=renditions['medium'],
+            filename=uploaded_file.name,
+        )
+
+
+def spool_upload(uploaded_file):
+    os.makedirs(settings.MEDIA_SPOOL_DIR, exist_ok=True)
+    extension = os.path.splitext(uploaded_file.name or '')[1]
+    path = os.path.join(settings.MEDIA_SPOOL_DIR, f"{uuid.uuid4().hex}{extension}")
+    uploaded_file.seek(0)
+    with open(path, 'wb') as spool:
+        for chunk in uploaded_file.chunks():
+            spool.write(chunk)
+    return path
+
+
+def store_user_image(user, uploaded_file):
+    if settings.MEDIA_UPLOAD_MODE != 'deferred':
+        return create_user_image(user, uploaded_file)
+    return UserImageFile.objects.create(
+        user=user,
+        filename=uploaded_file.name,
+        status='pending',
+        spool_path=spool_upload(uploaded_file),
+    )
+
+
+def prepare_user_image(user, uploaded_file):
+    """
+    Does the slow part of store_user_image without touching the database: the
+    renditions are written to the storage (or the upload is spooled) and the
+    returned UserImageFile is left for the caller to save. The async views run
+    this outside the request's database thread and transaction.
+    """
+    if settings.MEDIA_UPLOAD_MODE == 'deferred':
+        image = UserImageFile(user=user, filename=uploaded_file.name, status='pending', spool_path=spool_upload(uploaded_file))
+    else:
+        renditions = create_renditions(uploaded_file)
+        image = UserImageFile(user=user, filename=uploaded_file.name)
+        with track('storage'):
+            for field, rendition in [('url', renditions['original']), ('thumb', renditions['thumb']), ('medium', renditions['medium'])]:
+                getattr(image, field).save(rendition.name, rendition, save=False)
+    # The caller may still validate the upload
+    uploaded_file.seek(0)
+    return image
+
+
+def upload_spooled_image(image):
+    with open(image.spool_path, 'rb') as spool:
+        renditions = create_renditions(File(spool, name=image.filename))
+    spool_path = image.spool_path
+    image.url, image.thumb, image.medium = renditions['original'], renditions['thumb'], renditions['medium']
+    image.status, image.spool_path = 'ready', ''
+    image.save(update_fields=['url', 'thumb', 'medium', 'status', 'spool_path'])
+
+    # Clients that already synced the pending image pick up the new urls on their next sync
+    for workout_id, profile_id in Workout.objects.filter(img=image).values_list('id', 'profile_id'):
+        log_change('workout', workout_id, 'upsert', profile_ref=profile_id)
+    for community_id in Community.objects.filter(img=image).values_list('id', flat=True):
+        log_change('community', community_id, 'upsert', community_ref=community_id)
+    transaction.on_commit(lambda: os.path.exists(spool_path) and os.remove(spool_path))
+
+
+def process_pending_uploads(limit:int=20):
+    """
+    Pushes up to `limit` spooled images to the configured storage and returns
+    the number stored. Failed uploads are retried on later runs until
+    MEDIA_UPLOAD_MAX_ATTEMPTS is reached.
+    """
+    stored = 0
+    image_ids = list(UserImageFile.objects.filter(status='pending').order_by('id').values_list('id', flat=True)[:limit])
+    for image_id in image_ids:
+        with transaction.atomic():
+            # Skipping locked rows lets several workers share the queue
+            image = UserImageFile.objects.select_for_update(skip_locked=True).filter(id=image_id, status='pending').first()
+            if not image:
+                continue
+            try:
+                with transaction.atomic():
+                    upload_spooled_image(image)
+            except Exception:
+                log_error(traceback.format_exc())
+                delete_stored_files([x.name for x in image.get_files() if x._committed])
+                attempts = image.upload_attempts + 1
+                status = 'failed' if attempts >= settings.MEDIA_UPLOAD_MAX_ATTEMPTS else 'pending'
+                UserImageFile.objects.filter(id=image.id).update(upload_attempts=attempts, status=status)
+                continue
+            stored += 1
+
+    return stored
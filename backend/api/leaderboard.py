@@ -0,0 +1,105 @@
+import operator
+from functools import reduce
+from django.db.models import F, Max, Min, Q, Window, Case, When
+from django.db.models.functions import DenseRank
+from api.models import Challenge, ChallengeParticipant
+from api.realtime import queue_event
+
+# Ranks are dense (tied points share a rank) and ties are listed by id, so the
+# leaderboard order is always (rank, id). Every update shifts only the rows
+# whose points lie below the moved value, through indexed range updates.
+
+
+def lock_leaderboards(challenge_ids):
+    # Serialize rank updates per challenge. Locks are taken in id order so
+    # concurrent writers touching several challenges cannot deadlock.
+    list(Challenge.objects.select_for_update().filter(id__in=challenge_ids).order_by('id').values_list('id', flat=True))
+
+
+def shift_ranks(others, shifts):
+    """
+    Moves the rows of each (rows, delta) pair by delta ranks in one update.
+    A set-based update() sends no post_save, so connected clients get one
+    challenge_ranks_update with a [rank_from, rank_to, delta] range per shift,
+    in the ranks from before the update. Its size does not depend on the
+    number of rows moved. Sync clients only get the moved participant's own
+    row and derive the other ranks from the points they already have.
+    """
+    shifts = [(rows, delta) for rows, delta in shifts if delta]
+    if not shifts:
+        return
+    bounds = {}
+    for i, (rows, _) in enumerate(shifts):
+        bounds[f"from_{i}"], bounds[f"to_{i}"] = Min('rank', filter=rows), Max('rank', filter=rows)
+    row = others.values('challenge_id', 'challenge__community_id').annotate(**bounds).order_by('challenge_id').first()
+    ranges = [[row[f"from_{i}"], row[f"to_{i}"], delta] for i, (_, delta) in enumerate(shifts) if row and row[f"from_{i}"] is not None]
+    if not ranges:
+        return
+
+    others.filter(reduce(operator.or_, [rows for rows, _ in shifts])).update(rank=Case(*[When(rows, then=F('rank') + delta) for rows, delta in shifts]))
+    queue_event(f"community_{row['challenge__community_id']}", 'challenge_ranks_update', {'challenge_id': row['challenge_id'], 'shifts': ranges})
+
+
+def place_on_leaderboard(challenge_id, points, exclude_id=None):
+    others = ChallengeParticipant.objects.filter(challenge_id=challenge_id).exclude(id=exclude_id)
+    tied_rank = others.filter(points=points).values_list('rank', flat=True).first()
+    if tied_rank is not None:
+        return tied_rank
+
+    shift_ranks(others, [(Q(points__lt=points), 1)])
+    rank_above = others.filter(points__gt=points).aggregate(rank=Max('rank'))['rank']
+    return (rank_above or 0) + 1
+
+
+def remove_from_leaderboard(challenge_id, points, exclude_id=None):
+    others = ChallengeParticipant.objects.filter(challenge_id=challenge_id).exclude(id=exclude_id)
+    if not others.filter(points=points).exists():
+        shift_ranks(others, [(Q(points__lt=points), -1)])
+
+
+def move_on_leaderboard(participant, old_points):
+    """
+    Re-ranks a participant whose points changed from old_points, both as
+    stored. Rows between the two scores move by one rank in a single update;
+    rows below both move only when a distinct score appears or disappears,
+    which dense ranks require.
+    """
+    new_points = participant.points
+    if new_points == old_points:
+        return participant.rank
+    others = ChallengeParticipant.objects.filter(challenge_id=participant.challenge_id).exclude(id=participant.id)
+    tied = set(others.filter(points__in=[old_points, new_points]).values_list('points', flat=True).distinct())
+    added = 0 if new_points in tied else 1
+    removed = 0 if old_points in tied else 1
+    low, high = min(old_points, new_points), max(old_points, new_points)
+
+    # Moving up passes the band from above (new score added over it), moving
+    # down leaves it (old score taken away from over it)
+    band = added if new_points > old_points else -removed
+    shift_ranks(others, [(Q(points__gte=low, points__lt=high), band), (Q(points__lt=low), added - removed)])
+
+    rank_at_or_above = others.filter(points__gte=new_points).aggregate(rank=Max('rank'))['rank']
+    participant.rank = (rank_at_or_above or 0) + added
+    return participant.rank
+
+
+def rebuild_leaderboard(challenge_id):
+    participants = list(ChallengeParticipant.objects.filter(challenge_id=challenge_id).annotate(
+        new_rank=Window(expression=DenseRank(), order_by=F('points').desc()),
+    ).only('id', 'rank', 'points'))
+    changed = [x for x in participants if x.rank != x.new_rank]
+    for participant in changed:
+        participant.rank = participant.new_rank
+    ChallengeParticipant.objects.bulk_update(changed, ['rank'], batch_size=1000)
+    return len(changed)
+
+
+def get_leaderboard_top(challenge_id, limit):
+    return list(ChallengeParticipant.objects.filter(challenge_id=challenge_id).order_by('rank', 'id')[:limit])
+
+
+def get_leaderboard_neighbours(participant, count):
+    participants = ChallengeParticipant.objects.filter(challenge_id=participant.challenge_id)
+    above = participants.filter(Q(rank__lt=participant.rank) | Q(rank=participant.rank, id__lt=participant.id)).order_by('-rank', '-id')[:count]
+    below = participants.filter(Q(rank__gt=participant.rank) | Q(rank=participant.rank, id__gt=participant.id)).order_by('rank', 'id')[:count]
+    return list(reversed(above)), list(below)
@@ -0,0 +1,350 @@
+import io
+import os
+import json
+import math
+import time
+import shutil
+import platform
+import tempfile
+from contextlib import ExitStack
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from api.management.commands.seed_powerup import SEED_PASSWORD
+from api.models import UserImageFile, WorkoutType, Profile, Workout, Community, CommunityMembership, Challenge, ChallengeParticipant
+from api.queries import get_community_queryset
+from api.serializer import CommunitySerializerOne, WorkoutSerializerOne
+from api.projections import get_communities_data, get_workout_values, get_workouts_data
+from api.storage import IMAGE_FIELDS
+from api.views import UserAuthSerializer
+
+SERIALIZER_SIZES = {
+    'CommunitySerializerOne': [1, 10, 50],
+    'WorkoutSerializerOne': [10, 100, 1000],
+}
+
+
+class StubPusher:
+    def trigger(self, *args, **kwargs):
+        return {}
+
+    def trigger_batch(self, *args, **kwargs):
+        return {}
+
+
+def percentile(values, p:float):
+    # Nearest-rank percentile on sorted values
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def summarize(timings, queries, sizes):
+    timings = sorted(x * 1000 for x in timings)
+    return {
+        'iterations': len(timings),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'queries': max(queries),
+        'bytes': max(sizes),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Times every endpoint with the test client against a database filled by seed_powerup. "
+        "Everything runs in one transaction that is rolled back, and Pusher, SMTP and the image storage are stubbed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='seed', help="Username prefix the data was seeded with")
+        parser.add_argument('--iterations', type=int, default=30, help="Timed requests per scenario")
+        parser.add_argument('--warmup', type=int, default=3, help="Untimed requests per scenario, run first")
+        parser.add_argument('--scenario', action='append', default=[], help="Only run scenarios whose name contains this value. Can be repeated")
+        parser.add_argument('--output', default='benchmark.json', help="Where to write the results")
+        parser.add_argument('--baseline', help="Results file to compare against")
+        parser.add_argument('--threshold', type=float, default=0.2, help="Allowed p95 slowdown against the baseline, as a fraction")
+
+    def handle(self, *args, **options):
+        self.prefix = options['prefix']
+        self.iterations, self.warmup = options['iterations'], options['warmup']
+        if self.iterations < 1:
+            raise CommandError("--iterations must be at least 1")
+        if not User.objects.filter(username__startswith=f"{self.prefix}_").exists():
+            raise CommandError(f"No users with the prefix '{self.prefix}_'. Run seed_powerup first.")
+
+        media_root = tempfile.mkdtemp()
+        setup_test_environment()
+        try:
+            with ExitStack() as stack:
+                # Image writes go to a throwaway directory and realtime delivery never leaves the process
+                stack.enter_context(override_settings(MEDIA_ROOT=media_root, MEDIA_UPLOAD_MODE='sync'))
+                for name in IMAGE_FIELDS:
+                    stack.enter_context(mock.patch.object(UserImageFile._meta.get_field(name), 'storage', FileSystemStorage(location=media_root, base_url='/media/')))
+                stack.enter_context(mock.patch('api.realtime.use_pusher', return_value=StubPusher()))
+                # The test environment swaps SMTP for the in-memory backend, but register still reads the sender from the environment
+                stack.enter_context(mock.patch.dict(os.environ, {
+                    'EMAIL_HOST_USER': os.environ.get('EMAIL_HOST_USER') or 'benchmark@example.com',
+                    'EMAIL_SENDER_NAME': os.environ.get('EMAIL_SENDER_NAME') or 'PowerUp',
+                }))
+                with transaction.atomic():
+                    results = self.run_benchmarks(options['scenario'])
+                    transaction.set_rollback(True)
+        finally:
+            teardown_test_environment()
+            shutil.rmtree(media_root, True)
+
+        with open(options['output'], 'w') as file:
+            json.dump(results, file, indent=2)
+        self.stdout.write(f"Results written to {options['output']}")
+
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                regressions = self.compare(json.load(file), results, options['threshold'])
+            if regressions:
+                raise CommandError(f"{len(regressions)} regressions against {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
+
+    def run_benchmarks(self, filters):
+        self.setup_data()
+        results = {
+            'meta': {
+                'date': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'prefix': self.prefix,
+                'iterations': self.iterations,
+                'users': Profile.objects.filter(user__username__startswith=f"{self.prefix}_").count(),
+                'workouts': Workout.objects.count(),
+                'communities': Community.objects.count(),
+            },
+            'endpoints': {},
+            'serializers': {},
+        }
+        for name, prepare in self.get_scenarios():
+            if filters and not any(x in name for x in filters):
+                continue
+            results['endpoints'][name] = self.measure(prepare)
+            self.report(name, results['endpoints'][name])
+
+        for name, prepare in self.get_serializer_scenarios():
+            if filters and not any(x in name for x in filters):
+                continue
+            results['serializers'][name] = self.measure(prepare)
+            self.report(name, results['serializers'][name])
+        return results
+
+    def measure(self, prepare):
+        timings, queries, sizes = [], [], []
+        for i in range(self.warmup + self.iterations):
+            # prepare() sets up state outside the timed section and returns the call to time
+            call = prepare()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = call()
+                elapsed = time.perf_counter() - started
+            if getattr(response, 'status_code', 200) >= 400:
+                raise CommandError(f"Request failed with {response.status_code}: {response.content[:500]}")
+            if i >= self.warmup:
+                timings.append(elapsed)
+                queries.append(len(captured))
+                sizes.append(len(response.content) if hasattr(response, 'content') else len(json.dumps(response, default=str)))
+        return summarize(timings, queries, sizes)
+
+    def report(self, name, result):
+        self.stdout.write(f"{name:<40} p50 {result['p50_ms']:>9.2f}ms  p95 {result['p95_ms']:>9.2f}ms  p99 {result['p99_ms']:>9.2f}ms  {result['queries']:>4} queries  {result['bytes']:>9} bytes")
+
+    def compare(self, baseline, results, threshold:float):
+        regressions = []
+        for section in ['endpoints', 'serializers']:
+            for name, result in results[section].items():
+                previous = baseline.get(section, {}).get(name)
+                if not previous:
+                    continue
+                change = result['p95_ms'] / previous['p95_ms'] - 1 if previous['p95_ms'] else 0
+                if change > threshold:
+                    regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {result['p95_ms']}ms ({change:+.0%})")
+                if result['queries'] > previous['queries']:
+                    regressions.append(f"{name}: queries {previous['queries']} -> {result['queries']}")
+        for regression in regressions:
+            self.stdout.write(self.style.ERROR(regression))
+        return regressions
+
+    def setup_data(self):
+        self.today = timezone.now().date()
+        profiles = list(Profile.objects.filter(user__username__startswith=f"{self.prefix}_").annotate(
+            workout_count=Count('workouts')).select_related('user').order_by('workout_count', 'id'))
+        # The lightest, a typical and the heaviest user by workout history
+        self.sized_profiles = {'small': profiles[0], 'median': profiles[len(profiles) // 2], 'large': profiles[-1]}
+
+        community_ids = Community.objects.filter(members__user__username__startswith=f"{self.prefix}_").annotate(
+            member_count=Count('members')).order_by('-member_count', 'id').values_list('id', flat=True)
+        self.community = Community.objects.get(id=community_ids[0])
+        self.other_community = Community.objects.get(id=community_ids[1]) if len(community_ids) > 1 else Community.objects.create(name='Benchmark')
+        self.actor = Profile.objects.select_related('user').filter(memberships__community=self.community, memberships__role='admin').order_by('id').first()
+        CommunityMembership.objects.filter(community=self.other_community, profile=self.actor).delete()
+        self.challenge = Challenge.objects.filter(community=self.community, end_date__gte=self.today).order_by('id').first() or \
+            Challenge.objects.create(community=self.community, name='Benchmark', end_date=self.today + timedelta(days=30))
+        self.workout_types = list(WorkoutType.objects.order_by('id').values_list('id', flat=True))
+        if not self.challenge.workout_types.exists():
+            self.challenge.workout_types.set(self.workout_types[:1])
+        self.workout_type = self.challenge.workout_types.order_by('id').first().id
+        self.sample_profiles = list(self.community.members.exclude(id=self.actor.id).order_by('id').values_list('id', flat=True)[:20])
+
+        output = io.BytesIO()
+        Image.new('RGB', (640, 480), 'red').save(output, format='JPEG')
+        self.selfie = output.getvalue()
+        self.created = 0
+
+    def get_client(self, user=None):
+        client = APIClient()
+        if user:
+            client.credentials(HTTP_AUTHORIZATION=f"Bearer {UserAuthSerializer.get_token(user).access_token}")
+        return client
+
+    def create_profile(self):
+        self.created += 1
+        user = User.objects.create(username=f"{self.prefix}_bench_{self.created}", email=f"{self.prefix}_bench_{self.created}@example.com")
+        return Profile.objects.create(user=user)
+
+    def is_participant(self):
+        return ChallengeParticipant.objects.filter(profile=self.actor, challenge=self.challenge).exists()
+
+    def get_scenarios(self):
+        anonymous, actor = self.get_client(), self.get_client(self.actor.user)
+
+        def post(data):
+            return lambda: actor.post('/workout/data', data, format='multipart')
+
+        scenarios = [(f"GET workout/data [{size}]", lambda client=self.get_client(profile.user): lambda: client.get('/workout/data'))
+                     for size, profile in self.sized_profiles.items()]
+        sync_token = actor.get('/workout/data').data['sync_token']
+        scenarios += [
+            ("GET workout/data?since", lambda: lambda: actor.get('/workout/data', {'since': sync_token})),
+            ("GET workout/history", lambda: lambda: actor.get('/workout/history')),
+            ("GET community", lambda: lambda: actor.get(f"/community/{self.community.id}")),
+            ("GET challenge leaderboard", lambda: lambda: actor.get(f"/challenge/{self.challenge.id}/leaderboard")),
+            ("GET challenge leaderboard/me", lambda: lambda: actor.get(f"/challenge/{self.challenge.id}/leaderboard/me")),
+            ("GET user/data", lambda: lambda: actor.get('/user/data')),
+            ("GET app/data", lambda: lambda: anonymous.get('/app/data')),
+        ]
+
+        def login():
+            return lambda: anonymous.post('/login', {'username': self.actor.user.username, 'password': SEED_PASSWORD}, format='json')
+
+        refresh_client = APIClient()
+        refresh_client.post('/login', {'username': self.actor.user.username, 'password': SEED_PASSWORD}, format='json')
+
+        def register():
+            self.created += 1
+            name = f"{self.prefix}_register_{self.created}"
+            return lambda: anonymous.post('/register', {'userImage': 'null', 'dataObj': json.dumps({
+                'email': f"{name}@example.com", 'username': name, 'password': SEED_PASSWORD, 'age': 30, 'gender': 'other', 'country': 'Ghana', 'city': 'Accra',
+            })}, format='multipart')
+
+        def create_workout():
+            return post({'type': 'createWorkout', 'selfie': SimpleUploadedFile('selfie.jpg', self.selfie), 'workoutType': self.workout_type,
+                         'pointsEarned': 10, 'caloriesBurned': 50, 'duration': 20})
+
+        def create_community():
+            return post({'type': 'createCommunity', 'communityImage': 'null', 'dataObj': json.dumps({'name': 'Benchmark', 'description': 'Benchmark community'})})
+
+        def add_admin():
+            member = self.create_profile()
+            CommunityMembership.objects.create(community=self.community, profile=member)
+            return post({'type': 'addCommunityAdmin', 'memberId': member.id, 'communityId': self.community.id})
+
+        def remove_admin():
+            admin = self.create_profile()
+            CommunityMembership.objects.create(community=self.community, profile=admin, role='admin')
+            return post({'type': 'removeCommunityAdmin', 'adminId': admin.id, 'communityId': self.community.id})
+
+        def add_member():
+            return post({'type': 'addCommunityMember', 'username': self.create_profile().user.username, 'communityId': self.community.id})
+
+        def remove_member():
+            member = self.create_profile()
+            CommunityMembership.objects.create(community=self.community, profile=member)
+            return post({'type': 'removeCommunityMember', 'memberId': member.id, 'communityId': self.community.id})
+
+        def join_community():
+            CommunityMembership.objects.filter(community=self.other_community, profile=self.actor).delete()
+            return post({'type': 'joinCommunity', 'dataObj': json.dumps({'join_code': self.other_community.join_code})})
+
+        def exit_community():
+            CommunityMembership.objects.get_or_create(community=self.other_community, profile=self.actor)
+            return post({'type': 'exitCommunity', 'communityId': self.other_community.id})
+
+        def delete_community():
+            community = Community.objects.create(name='Benchmark')
+            CommunityMembership.objects.bulk_create([CommunityMembership(community=community, profile=self.actor, role='admin')] +
+                                                    [CommunityMembership(community=community, profile_id=x) for x in self.sample_profiles])
+            challenge = Challenge.objects.create(community=community, name='Benchmark', end_date=self.today + timedelta(days=30))
+            ChallengeParticipant.objects.bulk_create([ChallengeParticipant(challenge=challenge, profile_id=x, date_joined=self.today) for x in self.sample_profiles])
+            return post({'type': 'deleteCommunity', 'itemId': community.id})
+
+        def create_challenge():
+            return post({'type': 'createChallenge', 'communityId': self.community.id, 'dataObj': json.dumps({
+                'name': 'Benchmark', 'description': 'Benchmark challenge', 'start_date': self.today.isoformat(),
+                'end_date': (self.today + timedelta(days=30)).isoformat(), 'workout_types': self.workout_types[:3],
+            })})
+
+        def join_challenge():
+            if self.is_participant():
+                post({'type': 'exitChallenge', 'challengeId': self.challenge.id})()
+            return post({'type': 'joinChallenge', 'challengeId': self.challenge.id})
+
+        def exit_challenge():
+            if not self.is_participant():
+                post({'type': 'joinChallenge', 'challengeId': self.challenge.id})()
+            return post({'type': 'exitChallenge', 'challengeId': self.challenge.id})
+
+        def delete_challenge():
+            challenge = Challenge.objects.create(community=self.community, name='Benchmark', end_date=self.today + timedelta(days=30))
+            ChallengeParticipant.objects.bulk_create([ChallengeParticipant(challenge=challenge, profile_id=x, date_joined=self.today) for x in self.sample_profiles])
+            return post({'type': 'deleteChallenge', 'itemId': challenge.id})
+
+        return scenarios + [
+            ("POST login", login),
+            ("POST token refresh", lambda: lambda: refresh_client.post('/api/token/refresh/')),
+            ("POST register", register),
+            ("POST createWorkout", create_workout),
+            ("POST createCommunity", create_community),
+            ("POST addCommunityAdmin", add_admin),
+            ("POST removeCommunityAdmin", remove_admin),
+            ("POST addCommunityMember", add_member),
+            ("POST removeCommunityMember", remove_member),
+            ("POST joinCommunity", join_community),
+            ("POST exitCommunity", exit_community),
+            ("POST deleteCommunity", delete_community),
+            ("POST createChallenge", create_challenge),
+            ("POST joinChallenge", join_challenge),
+            ("POST exitChallenge", exit_challenge),
+            ("POST deleteChallenge", delete_challenge),
+        ]
+
+    def get_serializer_scenarios(self):
+        scenarios = []
+        for size in SERIALIZER_SIZES['CommunitySerializerOne']:
+            # Rows are loaded up front so only serialization is timed
+            communities = list(get_community_queryset()[:size])
+            scenarios.append((f"CommunitySerializerOne x{len(communities)}", lambda x=communities: lambda: CommunitySerializerOne(x, many=True).data))
+            # The values() projections load and build in one step, so both paths are also timed with their queries
+            ids = [x.id for x in communities]
+            scenarios.append((f"CommunitySerializerOne+queries x{len(ids)}", lambda x=ids: lambda: CommunitySerializerOne(get_community_queryset().filter(id__in=x), many=True).data))
+            scenarios.append((f"get_communities_data x{len(ids)}", lambda x=ids: lambda: get_communities_data(Community.objects.filter(id__in=x))))
+        for size in SERIALIZER_SIZES['WorkoutSerializerOne']:
+            workouts = list(Workout.objects.select_related('img', 'workout_type').order_by('-id')[:size])
+            scenarios.append((f"WorkoutSerializerOne x{len(workouts)}", lambda x=workouts: lambda: WorkoutSerializerOne(x, many=True).data))
+            scenarios.append((f"WorkoutSerializerOne+queries x{len(workouts)}", lambda x=size: lambda: WorkoutSerializerOne(Workout.objects.select_related('img', 'workout_type').order_by('-id')[:x], many=True).data))
+            scenarios.append((f"get_workouts_data x{len(workouts)}", lambda x=size: lambda: get_workouts_data(get_workout_values(Workout.objects.order_by('-id'))[:x])))
+        return scenarios
@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from api.images import process_pending_uploads
+
+
+class Command(BaseCommand):
+    help = "Upload spooled images to the configured storage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Process the pending uploads once and exit")
+        parser.add_argument('--limit', type=int, default=20, help="Images to process per round")
+        parser.add_argument('--interval', type=float, default=1, help="Seconds to sleep when nothing is pending")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            stored = process_pending_uploads(limit=options['limit'])
+            total += stored
+            if options['once'] and stored < options['limit']:
+                self.stdout.write(f"Stored {total} images")
+                break
+            if not stored:
+                time.sleep(options['interval'])
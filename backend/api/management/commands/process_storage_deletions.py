@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from api.storage import process_storage_deletions
+
+
+class Command(BaseCommand):
+    help = "Delete queued image files from the storage in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain the queue once and exit")
+        parser.add_argument('--limit', type=int, default=500, help="Files to delete per round")
+        parser.add_argument('--interval', type=float, default=5, help="Seconds to sleep when the queue is empty")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            deleted = process_storage_deletions(limit=options['limit'])
+            total += deleted
+            if options['once'] and deleted < options['limit']:
+                self.stdout.write(f"Deleted {total} files")
+                break
+            if not deleted:
+                time.sleep(options['interval'])
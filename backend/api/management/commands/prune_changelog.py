@@ -0,0 +1,24 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api.models import ChangeLog
+
+
+class Command(BaseCommand):
+    help = "Delete change log entries older than the sync retention window"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.SYNC_CHANGE_RETENTION_DAYS)
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        deleted = 0
+        while True:
+            ids = list(ChangeLog.objects.filter(date__lt=cutoff).order_by('id').values_list('id', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+            deleted += ChangeLog.objects.filter(id__in=ids).delete()[0]
+
+        self.stdout.write(f"Deleted {deleted} change log entries")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+
+
+class Command(BaseCommand):
+    help = "Delete expired refresh tokens from the outstanding and blacklisted token tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        # An expired token fails validation before the blacklist is consulted,
+        # so neither row is needed any more
+        cutoff = timezone.now()
+        deleted = {OutstandingToken._meta.label: 0, BlacklistedToken._meta.label: 0}
+        while True:
+            ids = list(OutstandingToken.objects.filter(expires_at__lte=cutoff).order_by('id').values_list('id', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+            for label, count in OutstandingToken.objects.filter(id__in=ids).delete()[1].items():
+                deleted[label] += count
+
+        self.stdout.write(f"Deleted {deleted[OutstandingToken._meta.label]} outstanding and {deleted[BlacklistedToken._meta.label]} blacklisted tokens")
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum, FloatField
+from django.db.models.functions import Coalesce
+from api.leaderboard import lock_leaderboards, rebuild_leaderboard
+from api.models import Challenge, ChallengeParticipant, Workout
+
+
+class Command(BaseCommand):
+    help = "Recompute challenge participant points from workout history and repair any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--challenge', type=int, action='append', dest='challenges', help="Only repair the given challenge id (repeatable)")
+        parser.add_argument('--dry-run', action='store_true', help="Report drift without writing")
+
+    def handle(self, *args, **options):
+        challenges = Challenge.objects.order_by('id')
+        if options['challenges']:
+            challenges = challenges.filter(id__in=options['challenges'])
+
+        repaired = 0
+        for challenge_id in challenges.values_list('id', flat=True):
+            with transaction.atomic():
+                if not options['dry_run']:
+                    lock_leaderboards([challenge_id])
+                drifted = self.get_drifted_participants(challenge_id)
+                if drifted and not options['dry_run']:
+                    ChallengeParticipant.objects.bulk_update(drifted, ['points'], batch_size=1000)
+                    rebuild_leaderboard(challenge_id)
+            for participant in drifted:
+                self.stdout.write(f"Challenge {challenge_id}: participant {participant.id} {participant.stored_points} -> {participant.points}")
+            repaired += len(drifted)
+
+        action = 'Found' if options['dry_run'] else 'Repaired'
+        self.stdout.write(f"{action} {repaired} participants with drifted points")
+
+    def get_drifted_participants(self, challenge_id):
+        totals = Workout.objects.filter(
+            profile_id=OuterRef('profile_id'),
+            workout_type__challenges=OuterRef('challenge_id'),
+            date__gte=OuterRef('challenge__start_date'),
+            date__lte=OuterRef('challenge__end_date'),
+        ).filter(date__gte=OuterRef('date_joined')).order_by().values('profile_id').annotate(total=Sum('points')).values('total')
+
+        participants = ChallengeParticipant.objects.filter(challenge_id=challenge_id).annotate(
+            expected_points=Coalesce(Subquery(totals, output_field=FloatField()), 0.0),
+        ).only('id', 'points')
+
+        drifted = []
+        for participant in participants:
+            if abs(participant.points - participant.expected_points) > 1e-6:
+                participant.stored_points, participant.points = participant.points, participant.expected_points
+                drifted.append(participant)
+        return drifted
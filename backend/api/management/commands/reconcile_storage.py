@@ -0,0 +1,31 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.models import UserImageFile
+from api.storage import find_orphans, delete_stored_files, chunked
+
+
+class Command(BaseCommand):
+    help = "Delete stored images no UserImageFile points at, and UserImageFile rows whose file is gone"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='powerup/users', help="Storage folder to reconcile")
+        parser.add_argument('--grace-hours', type=float, default=24, help="Leave files and rows newer than this alone")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be removed without removing it")
+
+    def handle(self, *args, **options):
+        orphans, missing = find_orphans(options['prefix'], timedelta(hours=options['grace_hours']))
+        self.stdout.write(f"Found {len(orphans)} orphaned files and {len(missing)} images with missing files")
+        if options['dry_run']:
+            for name in orphans:
+                self.stdout.write(f"File: {name}")
+            for image_id in missing:
+                self.stdout.write(f"Image: {image_id}")
+            return
+
+        failed = delete_stored_files(orphans)
+        for batch in chunked(missing, 500):
+            # Remaining renditions of these rows are queued by the post_delete receiver
+            with transaction.atomic():
+                UserImageFile.objects.filter(id__in=batch).delete()
+        self.stdout.write(f"Deleted {len(orphans) - len(failed)} files and {len(missing)} images ({len(failed)} files failed)")
@@ -0,0 +1,207 @@
+import io
+import time
+import random
+from datetime import timedelta
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from api.models import UserImageFile, WorkoutType, Profile, Workout, Community, CommunityMembership, Challenge, ChallengeParticipant
+
+# users, communities, challenges per community, average workouts per user
+PRESETS = {
+    'tiny': (50, 5, 3, 20),
+    'small': (1000, 50, 5, 50),
+    'medium': (10000, 300, 8, 100),
+    'large': (50000, 1000, 10, 100),
+}
+# Every generated user shares this password so benchmarks can log in as any of them
+SEED_PASSWORD = 'password123'
+DEFAULT_WORKOUT_TYPES = ['Running', 'Cycling', 'Swimming', 'Walking', 'Yoga', 'Strength Training', 'Rowing', 'Hiking']
+# Placeholder files live outside powerup/users so reconcile_storage leaves the rows alone
+PLACEHOLDER_IMAGES = {
+    'avatar': 'powerup/placeholders/avatar.webp',
+    'selfie': 'powerup/placeholders/selfie.webp',
+    'community': 'powerup/placeholders/community.webp',
+}
+
+
+class Command(BaseCommand):
+    help = "Generate a reproducible synthetic data set for load and scale testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--preset', choices=PRESETS, default='small', help="Base size of the data set")
+        parser.add_argument('--factor', type=float, default=1, help="Multiply every preset count by this factor")
+        parser.add_argument('--seed', type=int, default=42, help="Random seed, so runs with the same arguments produce the same data")
+        parser.add_argument('--prefix', default='seed', help="Username prefix for generated users")
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Rows per bulk insert")
+        parser.add_argument('--history-days', type=int, default=365, help="How far back workouts and challenges go")
+
+    def handle(self, *args, **options):
+        users, communities, challenges, workouts = PRESETS[options['preset']]
+        factor = options['factor']
+        self.counts = {
+            'users': max(int(users * factor), 2),
+            'communities': max(int(communities * factor), 1),
+            'challenges': challenges,
+            'workouts': workouts,
+        }
+        self.rng = random.Random(options['seed'])
+        self.prefix = options['prefix']
+        self.chunk_size = options['chunk_size']
+        self.history_days = options['history_days']
+        self.today = timezone.now().date()
+        if User.objects.filter(username__startswith=f"{self.prefix}_").exists():
+            raise CommandError(f"Users with the prefix '{self.prefix}_' already exist. Use another --prefix or a fresh database.")
+
+        started = time.monotonic()
+        for stage in [self.create_placeholders, self.create_users, self.create_communities, self.create_challenges, self.create_workouts, self.settle_leaderboards]:
+            stage_started = time.monotonic()
+            with transaction.atomic():
+                summary = stage()
+            self.stdout.write(f"{summary} ({time.monotonic() - stage_started:.1f}s)")
+        self.stdout.write(self.style.SUCCESS(f"Seeded in {time.monotonic() - started:.1f}s"))
+
+    def bulk_create(self, model, objects):
+        created = 0
+        batch = []
+        for item in objects:
+            batch.append(item)
+            if len(batch) >= self.chunk_size:
+                model.objects.bulk_create(batch)
+                created += len(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_create(batch)
+            created += len(batch)
+        return created
+
+    def skewed_size(self, limit:int, alpha:float=1.2, minimum:int=1):
+        # Pareto draw: most values are small, a few are close to the limit
+        return max(minimum, min(limit, int(minimum * self.rng.paretovariate(alpha))))
+
+    def create_placeholders(self):
+        self.images = {
+            name: UserImageFile.objects.create(url=path, thumb=path, medium=path, filename=path.rsplit('/', 1)[-1])
+            for name, path in PLACEHOLDER_IMAGES.items()
+        }
+        existing = set(WorkoutType.objects.values_list('name', flat=True))
+        WorkoutType.objects.bulk_create([WorkoutType(name=x) for x in DEFAULT_WORKOUT_TYPES if x not in existing])
+        self.workout_types = list(WorkoutType.objects.order_by('id').values_list('id', 'points_per_minute', 'calories_burned_per_minute'))
+        return f"Created {len(self.images)} placeholder images, {len(self.workout_types)} workout types available"
+
+    def create_users(self):
+        # Hashing once keeps user creation from being dominated by the password hasher
+        password = make_password(SEED_PASSWORD)
+        joined = timezone.now() - timedelta(days=self.history_days)
+        self.bulk_create(User, (User(
+            username=f"{self.prefix}_{i}",
+            email=f"{self.prefix}_{i}@example.com",
+            password=password,
+            date_joined=joined,
+        ) for i in range(self.counts['users'])))
+        user_ids = list(User.objects.filter(username__startswith=f"{self.prefix}_").order_by('id').values_list('id', flat=True))
+
+        genders = ['male', 'female', 'other']
+        avatar = self.images['avatar']
+        self.bulk_create(Profile, (Profile(
+            user_id=user_id,
+            img=avatar if self.rng.random() < 0.7 else None,
+            gender=self.rng.choice(genders),
+            age=self.rng.randint(16, 70),
+            height=round(self.rng.uniform(150, 200), 1),
+            weight=round(self.rng.uniform(45, 120), 1),
+            created_at=joined,
+        ) for user_id in user_ids))
+        self.profiles = list(Profile.objects.filter(user_id__in=user_ids).order_by('id').values_list('id', 'user__username'))
+        self.usernames = dict(self.profiles)
+        self.profile_ids = [x[0] for x in self.profiles]
+        return f"Created {len(self.profile_ids)} users with profiles"
+
+    def create_communities(self):
+        image = self.images['community']
+        codes = set(Community.objects.exclude(join_code__isnull=True).values_list('join_code', flat=True))
+        new_communities = []
+        for i in range(self.counts['communities']):
+            code = ''.join(self.rng.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=6))
+            while code in codes:
+                code = ''.join(self.rng.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=6))
+            codes.add(code)
+            new_communities.append(Community(name=f"{self.prefix.title()} Community {i}", description='Generated community', img=image, join_code=code,
+                                             date=self.today - timedelta(days=self.rng.randint(0, self.history_days))))
+        self.bulk_create(Community, new_communities)
+        self.communities = list(Community.objects.filter(join_code__in=[x.join_code for x in new_communities]).order_by('id').values_list('id', flat=True))
+
+        self.members = {}
+        member_limit = len(self.profile_ids)
+        for community_id in self.communities:
+            size = self.skewed_size(member_limit, minimum=min(5, member_limit))
+            self.members[community_id] = self.rng.sample(self.profile_ids, size)
+        admin_counts = {community_id: self.rng.randint(1, 3) for community_id in self.communities}
+        memberships = self.bulk_create(CommunityMembership, (
+            CommunityMembership(community_id=community_id, profile_id=profile_id, role='admin' if i < admin_counts[community_id] else 'member')
+            for community_id, members in self.members.items() for i, profile_id in enumerate(members)
+        ))
+        admins = sum(min(count, len(self.members[community_id])) for community_id, count in admin_counts.items())
+        sizes = sorted(len(x) for x in self.members.values())
+        return f"Created {len(self.communities)} communities with {memberships} memberships and {admins} admins (largest {sizes[-1]}, median {sizes[len(sizes) // 2]})"
+
+    def create_challenges(self):
+        new_challenges = []
+        for community_id in self.communities:
+            for i in range(self.rng.randint(1, self.counts['challenges'] * 2 - 1)):
+                # Windows overlap within a community and a share of them is active today
+                start = self.today - timedelta(days=self.rng.randint(0, self.history_days))
+                end = min(start + timedelta(days=self.rng.randint(7, 60)), self.today + timedelta(days=30))
+                new_challenges.append(Challenge(community_id=community_id, name=f"Challenge {i}", description='Generated challenge',
+                                                start_date=start, end_date=max(start, end), date=start))
+        self.bulk_create(Challenge, new_challenges)
+        # auto_now_add overwrites start_date on insert, so the generated windows are written back
+        challenges = list(Challenge.objects.filter(community_id__in=self.communities).order_by('id'))
+        self.challenge_ids = [x.id for x in challenges]
+        for challenge, generated in zip(challenges, new_challenges):
+            challenge.start_date = generated.start_date
+        Challenge.objects.bulk_update(challenges, ['start_date'], batch_size=self.chunk_size)
+
+        type_ids = [x[0] for x in self.workout_types]
+        self.bulk_create(Challenge.workout_types.through, (
+            Challenge.workout_types.through(challenge_id=challenge.id, workouttype_id=type_id)
+            for challenge in challenges for type_id in self.rng.sample(type_ids, self.rng.randint(1, min(3, len(type_ids))))
+        ))
+        participants = self.bulk_create(ChallengeParticipant, (
+            ChallengeParticipant(challenge_id=challenge.id, profile_id=profile_id, username=self.usernames[profile_id], date_joined=challenge.start_date)
+            for challenge in challenges
+            for profile_id in self.rng.sample(self.members[challenge.community_id], max(1, int(len(self.members[challenge.community_id]) * self.rng.uniform(0.1, 0.6))))
+        ))
+        active = sum(1 for x in challenges if x.start_date <= self.today <= x.end_date)
+        return f"Created {len(challenges)} challenges ({active} active) with {participants} participants"
+
+    def create_workouts(self):
+        average = self.counts['workouts']
+        selfie = self.images['selfie']
+
+        def workouts():
+            for profile_id in self.profile_ids:
+                for _ in range(self.skewed_size(average * 20, alpha=1.5, minimum=max(average // 3, 1))):
+                    type_id, points_per_minute, calories_per_minute = self.rng.choice(self.workout_types)
+                    minutes = self.rng.randint(10, 90)
+                    yield Workout(
+                        profile_id=profile_id,
+                        workout_type_id=type_id,
+                        duration=minutes * 60,
+                        points=round(minutes * points_per_minute, 1),
+                        calories_burned=round(minutes * calories_per_minute, 1),
+                        img=selfie,
+                        date=self.today - timedelta(days=self.rng.randint(0, self.history_days)),
+                    )
+        created = self.bulk_create(Workout, workouts())
+        return f"Created {created} workouts"
+
+    def settle_leaderboards(self):
+        # Points and ranks are derived from the generated workouts, so the data
+        # is consistent with what createWorkout would have produced. Challenges
+        # that existed before the run are left alone.
+        call_command('recompute_challenge_points', challenges=self.challenge_ids, stdout=io.StringIO())
+        return "Computed challenge points and leaderboards"
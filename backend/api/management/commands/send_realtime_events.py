@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from api.metrics import registry
+from api.realtime import deliver_pending_events
+from api.utils import use_pusher, get_pusher_stats
+
+
+class Command(BaseCommand):
+    help = "Deliver queued realtime events to Pusher"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain the outbox once and exit")
+        parser.add_argument('--limit', type=int, default=100, help="Events to fetch per round")
+        parser.add_argument('--interval', type=float, default=0.5, help="Seconds to sleep when the outbox is empty")
+
+    def handle(self, *args, **options):
+        pusher_client = use_pusher()
+        while True:
+            delivered = deliver_pending_events(pusher_client, limit=options['limit'])
+            if options['once'] and delivered < options['limit']:
+                stats = get_pusher_stats()
+                self.stdout.write(f"Sent {stats['events_sent']} events in {stats['requests']} requests ({stats['events_failed']} failed)")
+                break
+            if not delivered:
+                # Samples recorded just before the outbox ran dry still reach /metrics
+                registry.flush()
+                time.sleep(options['interval'])
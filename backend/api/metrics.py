@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+EVENT_BUCKETS = (1, 2, 5, 10)
+HISTOGRAMS = {
+    'powerup_request_duration_seconds': ('Request wall time', LATENCY_BUCKETS),
+    'powerup_request_db_queries': ('Database queries per request', QUERY_BUCKETS),
+    'powerup_request_db_seconds': ('Time spent in database queries per request', LATENCY_BUCKETS),
+    'powerup_request_serialize_seconds': ('Time spent serializing and rendering the response', LATENCY_BUCKETS),
+    'powerup_request_external_seconds': ('Time spent calling an external service per request', LATENCY_BUCKETS),
+    'powerup_pusher_request_seconds': ('Pusher API request time', LATENCY_BUCKETS),
+    'powerup_pusher_request_events': ('Events per Pusher API request', EVENT_BUCKETS),
+}
+EXTERNAL_SERVICES = ['pusher', 'storage', 'smtp']
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.action = ''
+        self.db_queries = 0
+        self.timings = {}
+        self.active = set()
+
+    def add(self, kind:str, seconds:float):
+        self.timings[kind] = self.timings.get(kind, 0) + seconds
+
+    def get_server_timing(self, total:float):
+        entries = [f"total;dur={total * 1000:.2f}", f'db;dur={self.timings.get("db", 0) * 1000:.2f};desc="{self.db_queries} queries"']
+        entries += [f"{kind};dur={self.timings[kind] * 1000:.2f}" for kind in ['serialize', *EXTERNAL_SERVICES] if kind in self.timings]
+        return ', '.join(entries)
+
+
+@contextmanager
+def track(kind:str):
+    # Only the outermost block of a kind is counted, so nested calls are not timed twice
+    metrics = _current.get()
+    if metrics is None or kind in metrics.active:
+        yield
+        return
+    metrics.active.add(kind)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.active.discard(kind)
+        metrics.add(kind, time.perf_counter() - started)
+
+
+def record(kind:str, seconds:float):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(kind, seconds)
+
+
+def set_request_action(action):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.action = str(action)[:64]
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if metrics is not None:
+            metrics.db_queries += 1
+            metrics.add('db', time.perf_counter() - started)
+
+
+def install_query_recorder(sender=None, connection=None, **kwargs):
+    # Installed on every connection rather than per request, so queries that the
+    # async views run in other threads are counted too. Inserted first, so
+    # execute_wrapper() blocks that were entered before the connection opened
+    # still pop their own wrapper.
+    for connection in [connection] if connection else connections.all(initialized_only=True):
+        if record_query not in connection.execute_wrappers:
+            connection.execute_wrappers.insert(0, record_query)
+
+
+def instrument_serializers():
+    from rest_framework import serializers
+
+    def timed(fget):
+        def data(self):
+            with track('serialize'):
+                return fget(self)
+        return property(data)
+
+    for serializer_class in [serializers.Serializer, serializers.ListSerializer]:
+        serializer_class.data = timed(serializer_class.data.fget)
+
+
+class MetricsRegistry:
+    """
+    Histograms for the current process. Every process writes its own file to
+    METRICS_DIR, and the /metrics view merges all of them, so gunicorn workers
+    never share memory or lock each other.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.histograms = {}
+        self.last_flush = 0
+
+    def get_path(self):
+        return os.path.join(settings.METRICS_DIR, f"metrics_{self.pid}.json")
+
+    def observe(self, name:str, labels:dict, value:float):
+        buckets = HISTOGRAMS[name][1]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked from a process that already collected samples
+                self.pid, self.histograms = os.getpid(), {}
+            histogram = self.histograms.setdefault(key, {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0})
+            histogram['buckets'][next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def flush(self, force:bool=False):
+        with self.lock:
+            if self.pid != os.getpid() or (not force and time.monotonic() - self.last_flush < settings.METRICS_FLUSH_SECONDS):
+                return
+            self.last_flush = time.monotonic()
+            content = json.dumps([[name, dict(labels), value] for (name, labels), value in self.histograms.items()])
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        # Written to a temporary file first so a scrape never reads half a file
+        temporary_path = f"{self.get_path()}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_path, 'w') as file:
+            file.write(content)
+        os.replace(temporary_path, self.get_path())
+
+
+registry = MetricsRegistry()
+atexit.register(registry.flush, True)
+
+
+def observe_request(view:str, method:str, status:int, metrics:RequestMetrics, total:float):
+    labels = {'view': view, 'action': metrics.action, 'method': method}
+    registry.observe('powerup_request_duration_seconds', {**labels, 'status': str(status)}, total)
+    registry.observe('powerup_request_db_queries', labels, metrics.db_queries)
+    registry.observe('powerup_request_db_seconds', labels, metrics.timings.get('db', 0))
+    registry.observe('powerup_request_serialize_seconds', labels, metrics.timings.get('serialize', 0))
+    for service in EXTERNAL_SERVICES:
+        if service in metrics.timings:
+            registry.observe('powerup_request_external_seconds', {**labels, 'service': service}, metrics.timings[service])
+    registry.flush()
+
+
+def observe_pusher_request(events:int, failed:bool, latency:float):
+    # Recorded wherever Pusher is called, including the send_realtime_events worker
+    if not settings.METRICS_ENABLED:
+        return
+    labels = {'status': 'error' if failed else 'ok'}
+    registry.observe('powerup_pusher_request_seconds', labels, latency)
+    registry.observe('powerup_pusher_request_events', labels, events)
+    registry.flush()
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    # The async variant of a view keeps the sync view's label, so ASYNC_VIEWS does not rename the series
+    return getattr(match.func, 'view_class', match.func).__name__.removesuffix('_async')
+
+
+def collect_metrics():
+    registry.flush(force=True)
+    merged = {}
+    if not os.path.isdir(settings.METRICS_DIR):
+        return merged
+    for filename in os.listdir(settings.METRICS_DIR):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(settings.METRICS_DIR, filename)) as file:
+                histograms = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in histograms:
+            if name not in HISTOGRAMS:
+                continue
+            key = (name, tuple(sorted(labels.items())))
+            if key not in merged:
+                merged[key] = {'buckets': [0] * (len(HISTOGRAMS[name][1]) + 1), 'sum': 0.0, 'count': 0}
+            merged[key]['buckets'] = [x + y for x, y in zip(merged[key]['buckets'], value['buckets'])]
+            merged[key]['sum'] += value['sum']
+            merged[key]['count'] += value['count']
+    return merged
+
+
+def format_labels(labels):
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def render_metrics():
+    """
+    Returns every worker's histograms merged, in the Prometheus text format.
+    """
+    merged = collect_metrics()
+    lines = []
+    for name, (description, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+        for (metric, labels), value in sorted(merged.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip([*[str(x) for x in buckets], '+Inf'], value['buckets']):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels([*labels, ('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+class RequestMetricsMiddleware:
+    """
+    Times each request and reports database, serialization and external
+    service time in a Server-Timing header and in the /metrics histograms.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics:RequestMetrics):
+        total = time.perf_counter() - metrics.started
+        observe_request(get_view_name(request), request.method, response.status_code, metrics, total)
+        response['Server-Timing'] = metrics.get_server_timing(total)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns
+        started = time.perf_counter()
+        response.add_post_render_callback(lambda response: record('serialize', time.perf_counter() - started))
+        return response
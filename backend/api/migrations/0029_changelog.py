@@ -0,0 +1,26 @@
+# Generated by Django 5.0 on 2026-10-18 17:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0028_alter_workouttype_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(choices=[('workout', 'Workout'), ('community', 'Community'), ('challenge', 'Challenge'), ('challenge_participant', 'Challenge Participant'), ('community_member', 'Community Member'), ('community_admin', 'Community Admin')], max_length=50, verbose_name='Entity')),
+                ('entity_id', models.BigIntegerField(verbose_name='Entity ID')),
+                ('action', models.CharField(choices=[('upsert', 'Upsert'), ('delete', 'Delete')], max_length=20, verbose_name='Action')),
+                ('profile_ref', models.BigIntegerField(blank=True, db_index=True, null=True, verbose_name='Profile ID')),
+                ('community_ref', models.BigIntegerField(blank=True, db_index=True, null=True, verbose_name='Community ID')),
+                ('parent_ref', models.BigIntegerField(blank=True, null=True, verbose_name='Parent ID')),
+                ('date', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
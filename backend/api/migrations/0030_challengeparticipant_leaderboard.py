@@ -0,0 +1,46 @@
+# Generated by Django 5.0 on 2026-10-18 18:02
+
+from django.db import migrations, models
+
+
+def populate_leaderboards(apps, schema_editor):
+    ChallengeParticipant = apps.get_model('api', 'ChallengeParticipant')
+    participants = list(ChallengeParticipant.objects.select_related('profile__user').order_by('challenge_id', '-points', 'id'))
+    last_challenge, last_points, rank = None, None, 0
+    for participant in participants:
+        if participant.challenge_id != last_challenge:
+            last_challenge, last_points, rank = participant.challenge_id, None, 0
+        if participant.points != last_points:
+            last_points, rank = participant.points, rank + 1
+        participant.rank = rank
+        participant.username = participant.profile.user.username
+    ChallengeParticipant.objects.bulk_update(participants, ['rank', 'username'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0029_changelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='challengeparticipant',
+            name='rank',
+            field=models.PositiveIntegerField(default=1, verbose_name='Leaderboard Rank'),
+        ),
+        migrations.AddField(
+            model_name='challengeparticipant',
+            name='username',
+            field=models.CharField(blank=True, default='', max_length=150, verbose_name='Username'),
+        ),
+        migrations.AddIndex(
+            model_name='challengeparticipant',
+            index=models.Index(fields=['challenge', 'rank', 'id'], name='participant_leaderboard_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='challengeparticipant',
+            index=models.Index(fields=['challenge', 'points'], name='participant_points_idx'),
+        ),
+        migrations.RunPython(populate_leaderboards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0 on 2026-10-18 18:04
+
+import django.core.serializers.json
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0030_challengeparticipant_leaderboard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RealtimeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(max_length=200, verbose_name='Channel')),
+                ('name', models.CharField(max_length=200, verbose_name='Event Name')),
+                ('data', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Event Data')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Delivery Attempts')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next Attempt')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Last Error')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Sent At')),
+                ('failed_at', models.DateTimeField(blank=True, null=True, verbose_name='Failed At')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('failed_at__isnull', True), ('sent_at__isnull', True)), fields=['id'], name='realtime_event_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0 on 2026-10-18 18:06
+
+import api.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0031_realtimeevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userimagefile',
+            name='medium',
+            field=models.ImageField(blank=True, null=True, upload_to=api.models.user_folder, verbose_name='Medium Image'),
+        ),
+        migrations.AddField(
+            model_name='userimagefile',
+            name='thumb',
+            field=models.ImageField(blank=True, null=True, upload_to=api.models.user_folder, verbose_name='Thumbnail'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0032_userimagefile_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userimagefile',
+            name='spool_path',
+            field=models.CharField(blank=True, default='', max_length=500, verbose_name='Spooled File'),
+        ),
+        migrations.AddField(
+            model_name='userimagefile',
+            name='status',
+            field=models.CharField(choices=[('ready', 'Ready'), ('pending', 'Pending'), ('failed', 'Failed')], default='ready', max_length=20, verbose_name='Status'),
+        ),
+        migrations.AddField(
+            model_name='userimagefile',
+            name='upload_attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Upload Attempts'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.0 on 2026-10-18 18:14
+
+from django.db import migrations
+from django.db.models import Count
+from django.utils.crypto import get_random_string
+
+
+def remove_duplicate_participants(apps, schema_editor):
+    # Keeps the entry with the most points for each profile and challenge, then
+    # re-ranks the challenges that lost entries
+    ChallengeParticipant = apps.get_model('api', 'ChallengeParticipant')
+    duplicates = ChallengeParticipant.objects.values('profile_id', 'challenge_id').annotate(count=Count('id')).filter(count__gt=1).order_by()
+    challenge_ids = set()
+    for duplicate in duplicates:
+        entries = list(ChallengeParticipant.objects.filter(profile_id=duplicate['profile_id'], challenge_id=duplicate['challenge_id']).order_by('-points', 'id').values_list('id', flat=True))
+        ChallengeParticipant.objects.filter(id__in=entries[1:]).delete()
+        challenge_ids.add(duplicate['challenge_id'])
+
+    participants = list(ChallengeParticipant.objects.filter(challenge_id__in=challenge_ids).order_by('challenge_id', '-points', 'id'))
+    last_challenge, last_points, rank = None, None, 0
+    for participant in participants:
+        if participant.challenge_id != last_challenge:
+            last_challenge, last_points, rank = participant.challenge_id, None, 0
+        if participant.points != last_points:
+            last_points, rank = participant.points, rank + 1
+        participant.rank = rank
+    ChallengeParticipant.objects.bulk_update(participants, ['rank'], batch_size=1000)
+
+
+def replace_duplicate_join_codes(apps, schema_editor):
+    Community = apps.get_model('api', 'Community')
+    codes = set(Community.objects.exclude(join_code__isnull=True).values_list('join_code', flat=True).distinct())
+    duplicates = Community.objects.values('join_code').annotate(count=Count('id')).filter(count__gt=1, join_code__isnull=False).order_by()
+    for duplicate in duplicates:
+        for community in Community.objects.filter(join_code=duplicate['join_code']).order_by('id')[1:]:
+            code = get_random_string(6).upper()
+            while code in codes:
+                code = get_random_string(6).upper()
+            codes.add(code)
+            community.join_code = code
+            community.save(update_fields=['join_code'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0034_storagedeletion'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_participants, migrations.RunPython.noop),
+        migrations.RunPython(replace_duplicate_join_codes, migrations.RunPython.noop),
+    ]
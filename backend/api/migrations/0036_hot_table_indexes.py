@@ -0,0 +1,49 @@
+# Generated by Django 5.0 on 2026-10-18 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0035_dedupe_participants_and_join_codes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='challenge',
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name='community',
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name='profile',
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name='workout',
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name='workouttype',
+            options={},
+        ),
+        migrations.AddIndex(
+            model_name='challenge',
+            index=models.Index(fields=['end_date', 'start_date'], name='challenge_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workout',
+            index=models.Index(fields=['profile', '-date', '-id'], name='workout_history_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='challengeparticipant',
+            constraint=models.UniqueConstraint(fields=('profile', 'challenge'), name='challenge_participant_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='community',
+            constraint=models.UniqueConstraint(condition=models.Q(('join_code__isnull', False)), fields=('join_code',), name='community_join_code_unique'),
+        ),
+    ]
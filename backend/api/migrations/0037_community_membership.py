@@ -0,0 +1,77 @@
+# Generated by Django 5.0 on 2026-10-18 18:34
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def copy_memberships(apps, schema_editor):
+    # Admins were not always added as members, so every admin gets a row too
+    Community = apps.get_model('api', 'Community')
+    CommunityMembership = apps.get_model('api', 'CommunityMembership')
+    roles = {}
+    for pair in Community.members.through.objects.values_list('community_id', 'profile_id').iterator(chunk_size=5000):
+        roles[pair] = 'member'
+    for pair in Community.admins.through.objects.values_list('community_id', 'profile_id').iterator(chunk_size=5000):
+        roles[pair] = 'admin'
+    CommunityMembership.objects.bulk_create([
+        CommunityMembership(community_id=community_id, profile_id=profile_id, role=role)
+        for (community_id, profile_id), role in roles.items()
+    ], batch_size=5000)
+
+
+def restore_memberships(apps, schema_editor):
+    Community = apps.get_model('api', 'Community')
+    CommunityMembership = apps.get_model('api', 'CommunityMembership')
+    memberships = list(CommunityMembership.objects.values_list('community_id', 'profile_id', 'role'))
+    Community.members.through.objects.bulk_create([
+        Community.members.through(community_id=community_id, profile_id=profile_id) for community_id, profile_id, _ in memberships
+    ], batch_size=5000)
+    Community.admins.through.objects.bulk_create([
+        Community.admins.through(community_id=community_id, profile_id=profile_id) for community_id, profile_id, role in memberships if role == 'admin'
+    ], batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0036_hot_table_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommunityMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('member', 'Member'), ('admin', 'Admin')], default='member', max_length=10)),
+                ('date_joined', models.DateField(default=django.utils.timezone.now, verbose_name='Date Joined')),
+                ('community', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='api.community')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='api.profile')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['profile', 'role'], name='membership_profile_idx'),
+                    models.Index(fields=['community', 'role', 'profile'], name='membership_role_idx'),
+                ],
+                'constraints': [
+                    models.UniqueConstraint(fields=('community', 'profile'), name='community_membership_unique'),
+                ],
+            },
+        ),
+        migrations.RunPython(copy_memberships, restore_memberships),
+        # Django cannot switch an existing many-to-many field to a through model,
+        # so the old tables are dropped and the field is added back on top of the new one
+        migrations.RemoveField(
+            model_name='community',
+            name='admins',
+        ),
+        migrations.RemoveField(
+            model_name='community',
+            name='members',
+        ),
+        migrations.AddField(
+            model_name='community',
+            name='members',
+            field=models.ManyToManyField(blank=True, related_name='communities', through='api.CommunityMembership', to='api.profile', verbose_name='Community Members'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0 on 2026-10-18 19:48
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0037_community_membership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storagedeletion',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next Attempt'),
+        ),
+    ]
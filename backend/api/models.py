@@ -1,4 +1,5 @@
 from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.utils import timezone
@@ -13,12 +14,27 @@ def user_folder(instance, filename):
 class UserImageFile(models.Model):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, related_name="image_files", null=True)
     url = models.ImageField(verbose_name= 'Image', blank=False, upload_to=user_folder, null=True, storage=MediaCloudinaryStorage() if not settings.DEBUG else None)
+    thumb = models.ImageField(verbose_name='Thumbnail', blank=True, upload_to=user_folder, null=True, storage=MediaCloudinaryStorage() if not settings.DEBUG else None)
+    medium = models.ImageField(verbose_name='Medium Image', blank=True, upload_to=user_folder, null=True, storage=MediaCloudinaryStorage() if not settings.DEBUG else None)
     filename = models.CharField(max_length=255, verbose_name='Filename', blank=False, null=True)
+    status = models.CharField(max_length=20, choices=[('ready', 'Ready'), ('pending', 'Pending'), ('failed', 'Failed')], default='ready', verbose_name='Status')
+    spool_path = models.CharField(max_length=500, blank=True, default='', verbose_name='Spooled File')
+    upload_attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Upload Attempts')
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"{self.user}: {self.filename} : {self.url}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Names as loaded, so files replaced on save can be found without re-reading the row
+        instance._stored_files = {x: getattr(instance, x).name for x in ['url', 'thumb', 'medium'] if x in field_names}
+        return instance
+
+    def get_files(self):
+        return [x for x in [self.url, self.thumb, self.medium] if x]
+
 
 # Create your models here.
 class WorkoutType(models.Model):
@@ -30,9 +46,6 @@ class WorkoutType(models.Model):
     animation = models.FileField(upload_to='powerup/workout_types/animations/', blank=True, null=True, storage=VideoMediaCloudinaryStorage() if not settings.DEBUG else None)
     created_at = models.DateTimeField(auto_now_add=True)
 
-    class Meta:
-        ordering = ['-id']
-
     def __str__(self):
         return self.name
     
@@ -48,9 +61,6 @@ class Profile(models.Model):
     height = models.FloatField(blank=True, null=True, verbose_name="Height")
     weight = models.FloatField(blank=True, null=True, verbose_name="Weight")
     created_at = models.DateTimeField(default=timezone.now)
-    
-    class Meta:
-        ordering = ['-id']
 
     def __str__(self):
         return self.user.username if self.user else None
@@ -66,7 +76,9 @@ class Workout(models.Model):
     date = models.DateField(default=timezone.now, verbose_name="Date")
     
     class Meta:
-        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['profile', '-date', '-id'], name='workout_history_idx'),
+        ]
 
     def __str__(self):
         return f"{self.profile} - {self.workout_type} on {self.date}"
@@ -76,13 +88,14 @@ class Community(models.Model):
     name = models.CharField(max_length=255, verbose_name="Community Name")
     description = models.TextField(blank=True, null=True, verbose_name="Community Description")
     img = models.ForeignKey(UserImageFile, on_delete=models.SET_NULL, null=True, verbose_name="Community Profile Image", related_name="communities")
-    admins = models.ManyToManyField(Profile, related_name='admin_communities', blank=True, verbose_name="Community Admins")
-    members = models.ManyToManyField(Profile, related_name='communities', blank=True, verbose_name="Community Members")
+    members = models.ManyToManyField(Profile, through='CommunityMembership', related_name='communities', blank=True, verbose_name="Community Members")
     join_code = models.CharField(max_length=20, null=True, blank=True)
     date = models.DateField(default=timezone.now, verbose_name="Date Created")
 
     class Meta:
-        ordering = ['-id']
+        constraints = [
+            models.UniqueConstraint(fields=['join_code'], condition=models.Q(join_code__isnull=False), name='community_join_code_unique'),
+        ]
 
     def __str__(self):
         return self.name
@@ -100,6 +113,33 @@ class Community(models.Model):
                 return code
 
 
+class CommunityMembership(models.Model):
+    ROLES = [('member', 'Member'), ('admin', 'Admin')]
+    community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name="memberships")
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="memberships")
+    role = models.CharField(max_length=10, choices=ROLES, default='member')
+    date_joined = models.DateField(default=timezone.now, verbose_name="Date Joined")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['profile', 'role'], name='membership_profile_idx'),
+            models.Index(fields=['community', 'role', 'profile'], name='membership_role_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['community', 'profile'], name='community_membership_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.profile} - {self.community} ({self.role})"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Role as loaded, so a save that changes it can be told apart from other saves
+        instance._stored_role = instance.role if 'role' in field_names else None
+        return instance
+
+
 class Challenge(models.Model):
     name = models.CharField(max_length=255, verbose_name='Challenge Name')
     community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name="challenges")
@@ -110,17 +150,83 @@ class Challenge(models.Model):
     date = models.DateField(default=timezone.now, verbose_name="Date Created")
     
     class Meta:
-        ordering = ['-id']
+        indexes = [
+            # Finished challenges pile up behind today's date, so leading with end_date
+            # keeps the active-challenge range scan short
+            models.Index(fields=['end_date', 'start_date'], name='challenge_active_idx'),
+        ]
 
 
 class ChallengeParticipant(models.Model):
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="challenge_participants")
     challenge = models.ForeignKey(Challenge, on_delete=models.CASCADE, related_name="participants")
     points = models.FloatField(default=0, verbose_name="Points Earned")
+    rank = models.PositiveIntegerField(default=1, verbose_name="Leaderboard Rank")
+    username = models.CharField(max_length=150, blank=True, default='', verbose_name="Username")
     date_joined = models.DateField(default=timezone.now, verbose_name="Date Joined")
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['challenge', 'rank', 'id'], name='participant_leaderboard_idx'),
+            models.Index(fields=['challenge', 'points'], name='participant_points_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['profile', 'challenge'], name='challenge_participant_unique'),
+        ]
+
 
 class RemovedCommunityMember(models.Model):
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="removed_community_member")
     community = models.ForeignKey(Community, on_delete=models.CASCADE, related_name="removed_community_member")
     date = models.DateField(default=timezone.now, verbose_name="Date Joined")
+
+
+class ChangeLog(models.Model):
+    entity = models.CharField(max_length=50, choices=[
+        ('workout', 'Workout'),
+        ('community', 'Community'),
+        ('challenge', 'Challenge'),
+        ('challenge_participant', 'Challenge Participant'),
+        ('community_member', 'Community Member'),
+        ('community_admin', 'Community Admin'),
+    ], verbose_name="Entity")
+    entity_id = models.BigIntegerField(verbose_name="Entity ID")
+    action = models.CharField(max_length=20, choices=[('upsert', 'Upsert'), ('delete', 'Delete')], verbose_name="Action")
+    profile_ref = models.BigIntegerField(null=True, blank=True, db_index=True, verbose_name="Profile ID")
+    community_ref = models.BigIntegerField(null=True, blank=True, db_index=True, verbose_name="Community ID")
+    parent_ref = models.BigIntegerField(null=True, blank=True, verbose_name="Parent ID")
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.id}: {self.action} {self.entity} {self.entity_id}"
+
+
+class StorageDeletion(models.Model):
+    name = models.CharField(max_length=500, verbose_name="File Name")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Delete Attempts")
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name="Next Attempt")
+    last_error = models.TextField(blank=True, default='', verbose_name="Last Error")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
+class RealtimeEvent(models.Model):
+    channel = models.CharField(max_length=200, verbose_name="Channel")
+    name = models.CharField(max_length=200, verbose_name="Event Name")
+    data = models.JSONField(encoder=DjangoJSONEncoder, null=True, blank=True, verbose_name="Event Data")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Delivery Attempts")
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name="Next Attempt")
+    last_error = models.TextField(blank=True, default='', verbose_name="Last Error")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Sent At")
+    failed_at = models.DateTimeField(null=True, blank=True, verbose_name="Failed At")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], name='realtime_event_pending_idx', condition=models.Q(sent_at__isnull=True, failed_at__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f"{self.channel}: {self.name}"
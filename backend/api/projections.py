@@ -0,0 +1,227 @@
+import re
+from collections import defaultdict
+import cloudinary
+from django.core.files.storage import FileSystemStorage
+from django.utils.encoding import filepath_to_uri
+from api.models import *
+from api.serializer import get_default_image, get_file_url
+from api.storage import is_cloudinary
+
+# Read-only counterparts of the serializers for the largest payloads. They load
+# only the columns the payload needs with values() and build the same JSON as
+# the serializers with plain dicts, without model instances or DRF fields.
+
+IMAGE_FIELDS = ['url', 'thumb', 'medium']
+# Public ids that Cloudinary puts in the delivery URL as they are, behind a
+# v1/ version segment: nested, not versioned already, nothing to escape
+PLAIN_PUBLIC_ID = re.compile(r'(?!v\d+/)[\w.\-]+(/[\w.\-]+)+', re.ASCII)
+
+
+def get_cloudinary_base(storage):
+    """
+    Returns the delivery URL that MediaCloudinaryStorage.url() puts in front of
+    plain public ids, or None when the URL also depends on the id (signed URLs,
+    CDN subdomains picked per file).
+    """
+    config = cloudinary.config()
+    if getattr(config, 'sign_url', False) or getattr(config, 'cdn_subdomain', False) or getattr(config, 'secure_cdn_subdomain', False):
+        return None
+    bases = set()
+    for name in ['probe/a.webp', 'probe/b/c.jpg']:
+        public_id, url = storage._prepend_prefix(name), storage.url(name)
+        if not url.endswith(f"/v1/{public_id}"):
+            return None
+        bases.add(url.removesuffix(public_id))
+    return bases.pop() if len(bases) == 1 else None
+
+
+class ImageURLs:
+    """
+    Builds image URLs from the stored file names, the same way
+    get_image_url() does from a UserImageFile.
+    """
+    def __init__(self):
+        self.storages = {x: UserImageFile._meta.get_field(x).storage for x in IMAGE_FIELDS}
+        # FileSystemStorage.url() is the base URL followed by the quoted name
+        self.prefixes = {x: storage.base_url for x, storage in self.storages.items() if isinstance(storage, FileSystemStorage)}
+        self.cloudinary_prefixes = {}
+        for field, storage in self.storages.items():
+            if is_cloudinary(storage):
+                base = get_cloudinary_base(storage)
+                if base:
+                    self.cloudinary_prefixes[field] = (base, storage._prepend_prefix(''))
+
+    @staticmethod
+    def get_fields(relation:str):
+        return [relation, f"{relation}__status", *[f"{relation}__{x}" for x in IMAGE_FIELDS]]
+
+    def get_file_url(self, field:str, name:str):
+        if field in self.cloudinary_prefixes:
+            base, storage_prefix = self.cloudinary_prefixes[field]
+            public_id = name if name.startswith(storage_prefix) else storage_prefix + name
+            if PLAIN_PUBLIC_ID.fullmatch(public_id):
+                return get_file_url(base + public_id)
+            return get_file_url(self.storages[field].url(name))
+
+        prefix = self.prefixes.get(field)
+        uri = filepath_to_uri(name).lstrip('/')
+        # Dot segments are resolved by urljoin(), so those names go through the storage
+        if prefix is None or '/.' in f"/{uri}":
+            return get_file_url(self.storages[field].url(name))
+        return get_file_url(prefix + uri)
+
+    def get_image_url(self, row:dict, relation:str, rendition:str='url', default=None):
+        if not row[relation] or row[f"{relation}__status"] != 'ready':
+            return default
+        field = rendition if row[f"{relation}__{rendition}"] else 'url'
+        name = row[f"{relation}__{field}"]
+        return self.get_file_url(field, name) if name else default
+
+
+def get_workout_values(workouts):
+    return workouts.values(
+        'id', 'workout_type', 'workout_type__name', 'duration', 'calories_burned', 'points', 'date',
+        'img__filename', *ImageURLs.get_fields('img'),
+    )
+
+
+def get_workouts_data(rows):
+    """
+    Same output as WorkoutSerializerOne(many=True) for rows from get_workout_values().
+    """
+    urls = ImageURLs()
+    default_img = get_default_image('app_logo')
+    data = []
+    for row in rows:
+        img = default_img
+        if row['img']:
+            img = {
+                'url': urls.get_image_url(row, 'img', 'medium', default_img),
+                'filename': row['img__filename'],
+                'id': row['img'],
+                'status': row['img__status'],
+                'thumb': urls.get_image_url(row, 'img', 'thumb', default_img),
+            }
+        data.append({
+            'id': row['id'],
+            'img': img,
+            'workout_type': row['workout_type__name'],
+            'duration': row['duration'],
+            'calories_burned': row['calories_burned'],
+            'points': row['points'],
+            'date': row['date'].isoformat(),
+        })
+    return data
+
+
+def get_member_values(profiles, prefix:str='', *fields):
+    return profiles.values(*fields, *[f"{prefix}{x}" for x in [
+        'id', 'user__username', 'user__email', 'gender', 'bio', 'country', 'city', 'age', 'height', 'weight', *ImageURLs.get_fields('img'),
+    ]])
+
+
+def get_member_row_data(row:dict, urls:ImageURLs, default_img:str, prefix:str=''):
+    return {
+        'id': row[f"{prefix}id"],
+        'username': row[f"{prefix}user__username"],
+        'email': row[f"{prefix}user__email"],
+        'gender': row[f"{prefix}gender"],
+        'bio': row[f"{prefix}bio"],
+        'country': row[f"{prefix}country"],
+        'city': row[f"{prefix}city"],
+        'age': row[f"{prefix}age"],
+        'height': row[f"{prefix}height"],
+        'weight': row[f"{prefix}weight"],
+        'img': urls.get_image_url(row, f"{prefix}img", 'thumb', default_img),
+    }
+
+
+def get_members_data(rows):
+    """
+    Same output as get_member_data() for rows from get_member_values().
+    """
+    urls = ImageURLs()
+    default_img = get_default_image('staff_img')
+    return [get_member_row_data(row, urls, default_img) for row in rows]
+
+
+def get_challenge_values(challenges):
+    return challenges.values('id', 'community_id', 'name', 'description', 'start_date', 'end_date', 'date')
+
+
+def get_challenge_rows(rows):
+    """
+    Same output as get_challenge_data() for rows from get_challenge_values().
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    challenge_ids = [x['id'] for x in rows]
+    workout_types = defaultdict(list)
+    for challenge_id, name in Challenge.workout_types.through.objects.filter(challenge_id__in=challenge_ids).order_by('-workouttype_id').values_list('challenge_id', 'workouttype__name'):
+        workout_types[challenge_id].append(name)
+
+    participants = defaultdict(list)
+    for row in ChallengeParticipant.objects.filter(challenge_id__in=challenge_ids).order_by('rank', 'id').values('challenge_id', 'id', 'username', 'points', 'rank', 'date_joined'):
+        participants[row.pop('challenge_id')].append(row)
+
+    return [{
+        'id': row['id'],
+        'name': row['name'],
+        'description': row['description'],
+        'workout_types': workout_types[row['id']],
+        'start_date': row['start_date'],
+        'end_date': row['end_date'],
+        'date': row['date'],
+        'participants': participants[row['id']],
+    } for row in rows]
+
+
+def get_challenges_data(rows):
+    """
+    Same output as ChallengeSerializerOne for rows from get_challenge_values(),
+    plus the community id.
+    """
+    rows = list(rows)
+    return [{
+        'id': row['id'],
+        'participants': row['participants'],
+        'workout_types': row['workout_types'],
+        'name': row['name'],
+        'description': row['description'],
+        'start_date': row['start_date'].isoformat(),
+        'end_date': row['end_date'].isoformat(),
+        'date': row['date'].isoformat(),
+        'community': values['community_id'],
+    } for values, row in zip(rows, get_challenge_rows(rows))]
+
+
+def get_communities_data(communities):
+    """
+    Same output as CommunitySerializerOne(many=True) on get_community_queryset().
+    """
+    urls = ImageURLs()
+    member_img, community_img = get_default_image('staff_img'), get_default_image('app_logo')
+    rows = list(communities.order_by('-id').values('id', 'name', 'description', 'join_code', 'date', *ImageURLs.get_fields('img')))
+    community_ids = [x['id'] for x in rows]
+
+    memberships = defaultdict(list)
+    for row in get_member_values(CommunityMembership.objects.filter(community_id__in=community_ids).order_by('-profile_id'), 'profile__', 'community_id', 'role'):
+        memberships[row['community_id']].append(row)
+
+    challenges = defaultdict(list)
+    challenge_values = list(get_challenge_values(Challenge.objects.filter(community_id__in=community_ids).order_by('-id')))
+    for values, row in zip(challenge_values, get_challenge_rows(challenge_values)):
+        challenges[values['community_id']].append(row)
+
+    return [{
+        'id': row['id'],
+        'img': urls.get_image_url(row, 'img', 'medium', community_img),
+        'admins': [{'id': x['profile__id'], 'username': x['profile__user__username']} for x in memberships[row['id']] if x['role'] == 'admin'],
+        'members': [get_member_row_data(x, urls, member_img, 'profile__') for x in memberships[row['id']]],
+        'challenges': challenges[row['id']],
+        'name': row['name'],
+        'description': row['description'],
+        'join_code': row['join_code'],
+        'date': row['date'].isoformat(),
+    } for row in rows]
@@ -0,0 +1,36 @@
+from django.db.models import Q, Prefetch, Count, Exists, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from api.models import *
+
+
+def count_subquery(queryset, field:str):
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(count=Count('*')).values('count'),
+        output_field=IntegerField(),
+    ), 0)
+
+
+def get_challenge_queryset():
+    return Challenge.objects.prefetch_related(
+        Prefetch('workout_types', queryset=WorkoutType.objects.order_by('-id')),
+        Prefetch('participants', queryset=ChallengeParticipant.objects.order_by('rank', 'id')),
+    ).order_by('-id')
+
+
+def get_community_queryset():
+    return Community.objects.select_related('img').prefetch_related(
+        Prefetch('memberships', queryset=CommunityMembership.objects.select_related('profile__user', 'profile__img').order_by('-profile_id')),
+        Prefetch('challenges', queryset=get_challenge_queryset()),
+    ).order_by('-id')
+
+
+def get_community_summary_queryset(profile):
+    current_date = timezone.now().date()
+    return Community.objects.select_related('img').annotate(
+        member_count=count_subquery(CommunityMembership.objects.all(), 'community_id'),
+        admin_count=count_subquery(CommunityMembership.objects.filter(role='admin'), 'community_id'),
+        active_challenge_count=count_subquery(Challenge.objects.filter(start_date__lte=current_date, end_date__gte=current_date), 'community_id'),
+        is_admin=Exists(CommunityMembership.objects.filter(community_id=OuterRef('pk'), profile_id=profile.id, role='admin')),
+        is_member=Exists(CommunityMembership.objects.filter(community_id=OuterRef('pk'), profile_id=profile.id)),
+    ).order_by('-id')
@@ -0,0 +1,206 @@
+import sys
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from api.models import RealtimeEvent
+from api.utils import use_pusher, log_error
+from pusher.errors import PusherBadRequest
+
+# Pusher accepts at most 10 events per batch_events call
+PUSHER_BATCH_SIZE = 10
+# The client refuses a whole batch when the data of one event is larger than
+# this, measured with sys.getsizeof() on its JSON string
+PUSHER_MAX_EVENT_BYTES = 10240
+
+_collected_events = ContextVar('collected_events', default=None)
+
+
+def queue_event(channel:str, name:str, data):
+    # Written in the caller's transaction, so the event is only delivered if
+    # the change it describes is committed.
+    collected = _collected_events.get()
+    if collected is not None:
+        collected.append((channel, name, data))
+        return None
+    return RealtimeEvent.objects.create(channel=channel, name=name, data=data)
+
+
+def queue_events(events):
+    # events: (channel, name, data)
+    collected = _collected_events.get()
+    if collected is not None:
+        collected.extend(events)
+        return []
+    return RealtimeEvent.objects.bulk_create([RealtimeEvent(channel=channel, name=name, data=data) for channel, name, data in events])
+
+
+@contextmanager
+def collect_events():
+    """
+    Holds back the events queued inside the block and yields them as a list,
+    leaving it to the caller to queue them.
+    """
+    events = []
+    token = _collected_events.set(events)
+    try:
+        yield events
+    finally:
+        _collected_events.reset(token)
+
+
+def is_list_update(data):
+    return isinstance(data, dict) and set(data) == {'data', 'action'} and isinstance(data['data'], list)
+
+
+def coalesce_events(events):
+    """
+    Merges consecutive list updates with the same name and action on a channel,
+    so adding twenty members sends one community_members_update carrying
+    twenty profiles. Events on a channel keep their order. A merged event
+    stops growing at REALTIME_COALESCE_MAX_BYTES and the next item starts a
+    new one, which also splits a list update that is too large on its own.
+    """
+    merged, last_on_channel = [], {}
+    for channel, name, data in events:
+        if not is_list_update(data) or not data['data']:
+            last_on_channel[channel] = len(merged)
+            merged.append((channel, name, data))
+            continue
+        for item in data['data']:
+            previous = merged[last_on_channel[channel]] if channel in last_on_channel else None
+            if previous and previous[1] == name and is_list_update(previous[2]) and previous[2]['action'] == data['action'] \
+                    and get_event_size({**previous[2], 'data': [*previous[2]['data'], item]}) <= settings.REALTIME_COALESCE_MAX_BYTES:
+                previous[2]['data'].append(item)
+                continue
+            last_on_channel[channel] = len(merged)
+            merged.append((channel, name, {**data, 'data': [item]}))
+    return merged
+
+
+def get_event_size(data):
+    return sys.getsizeof(data if isinstance(data, str) else json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False))
+
+
+def get_retry_delay(attempts:int):
+    delay = settings.REALTIME_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0))
+    return timedelta(seconds=min(delay, settings.REALTIME_RETRY_MAX_SECONDS))
+
+
+def claim_pending_events(limit:int):
+    """
+    Claims up to `limit` events that are due, leasing them to the caller by
+    moving next_attempt_at past the claim timeout. The claim commits before
+    anything is sent, so no rows stay locked during delivery.
+    """
+    now = timezone.now()
+    pending = RealtimeEvent.objects.filter(sent_at__isnull=True, failed_at__isnull=True)
+    # A channel is blocked from its first event that waits for a retry or is leased to another worker
+    waiting = pending.filter(channel=OuterRef('channel'), id__lt=OuterRef('id'), next_attempt_at__gt=now)
+    with transaction.atomic():
+        events = list(pending.select_for_update(skip_locked=True).filter(~Exists(waiting), next_attempt_at__lte=now).order_by('id')[:limit])
+        if not events:
+            return []
+
+        # Rows skipped because another worker is still claiming them are not
+        # leased yet, so the later events of their channels are left for the next run
+        claimed = {x.id for x in events}
+        first_skipped = {}
+        for channel, event_id in pending.filter(channel__in={x.channel for x in events}, id__lt=events[-1].id).exclude(id__in=claimed).order_by('id').values_list('channel', 'id'):
+            first_skipped.setdefault(channel, event_id)
+        events = [x for x in events if x.id < first_skipped.get(x.channel, x.id + 1)]
+
+        # Pusher would never accept these, and they would fail every batch they are sent in
+        oversized = [x.id for x in events if get_event_size(x.data) > PUSHER_MAX_EVENT_BYTES]
+        if oversized:
+            log_error(f"Realtime events {oversized} are too large to deliver")
+            RealtimeEvent.objects.filter(id__in=oversized).update(failed_at=now, last_error='Too much data')
+            events = [x for x in events if x.id not in oversized]
+
+        lease = now + timedelta(seconds=settings.REALTIME_CLAIM_SECONDS)
+        RealtimeEvent.objects.filter(id__in=[x.id for x in events]).update(next_attempt_at=lease)
+    return events
+
+
+def trigger_events(pusher_client, events):
+    pusher_client.trigger_batch([{'channel': x.channel, 'name': x.name, 'data': x.data} for x in events])
+
+
+def send_batch(pusher_client, batch):
+    """
+    Sends a batch and returns the events that were sent and the (event, error)
+    pairs that failed. A batch that Pusher rejects because of its content is
+    sent again one event at a time, so only the events at fault are charged
+    an attempt. Later events on the channel of a failed event are left out of
+    both lists.
+    """
+    try:
+        trigger_events(pusher_client, batch)
+        return batch, []
+    except Exception as e:
+        log_error(f"Realtime batch delivery failed: {e}")
+        if len(batch) == 1 or not isinstance(e, (ValueError, PusherBadRequest)):
+            return [], [(x, e) for x in batch]
+
+    sent, failed = [], []
+    for i, event in enumerate(batch):
+        if event.channel in {x.channel for x, _ in failed}:
+            continue
+        try:
+            trigger_events(pusher_client, [event])
+            sent.append(event)
+        except Exception as e:
+            log_error(f"Realtime event {event.id} delivery failed: {e}")
+            failed.append((event, e))
+            if not isinstance(e, (ValueError, PusherBadRequest)):
+                # Pusher itself is failing, so the rest of the batch is not tried
+                failed += [(x, e) for x in batch[i + 1:] if x.channel not in {y.channel for y, _ in failed}]
+                break
+    return sent, failed
+
+
+def deliver_pending_events(pusher_client=None, limit:int=100):
+    """
+    Sends up to `limit` pending events through Pusher's batch API and returns
+    the number delivered. Events on a channel are never sent ahead of an
+    earlier event on the same channel that is still waiting for a retry.
+    """
+    pusher_client = pusher_client or use_pusher()
+    delivered = 0
+    blocked_channels, ready = set(), claim_pending_events(limit)
+    while ready:
+        batch, released = [], []
+        for event in ready[:PUSHER_BATCH_SIZE]:
+            (released if event.channel in blocked_channels else batch).append(event)
+        ready = ready[PUSHER_BATCH_SIZE:]
+        sent, failed = send_batch(pusher_client, batch) if batch else ([], [])
+        done = {x.id for x in sent} | {x.id for x, _ in failed}
+        released += [x for x in batch if x.id not in done]
+        if released:
+            # Stay behind the failed event of their channel instead of waiting for the lease to run out
+            RealtimeEvent.objects.filter(id__in=[x.id for x in released]).update(next_attempt_at=timezone.now())
+
+        now = timezone.now()
+        for event, error in failed:
+            event.attempts += 1
+            event.last_error = str(error)[:1000]
+            if event.attempts >= settings.REALTIME_MAX_ATTEMPTS:
+                event.failed_at = now
+            else:
+                event.next_attempt_at = now + get_retry_delay(event.attempts)
+                blocked_channels.add(event.channel)
+        if failed:
+            RealtimeEvent.objects.bulk_update([x for x, _ in failed], ['attempts', 'last_error', 'failed_at', 'next_attempt_at'])
+        for event in sent:
+            event.attempts += 1
+            event.sent_at = now
+        if sent:
+            RealtimeEvent.objects.bulk_update(sent, ['attempts', 'sent_at'])
+            delivered += len(sent)
+
+    return delivered
@@ -0,0 +1,71 @@
+import orjson
+import msgpack
+from django.utils.cache import patch_vary_headers
+from rest_framework import renderers, parsers
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder
+
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+
+# Types neither library handles natively (Decimal, lazy strings, querysets,
+# timedelta) are encoded the way DRF's JSONEncoder does
+encoder = JSONEncoder()
+
+
+def vary_on_accept(renderer_context):
+    # The same URL now answers with JSON or MessagePack depending on Accept
+    response = (renderer_context or {}).get('response')
+    if response is not None:
+        patch_vary_headers(response, ['Accept'])
+
+
+class ORJSONRenderer(renderers.JSONRenderer):
+    """
+    Renders DRF's JSON with orjson. Dates and datetimes are encoded natively,
+    so a datetime that was not formatted by a serializer field keeps its
+    microseconds where DRF would trim them to milliseconds. Indented output,
+    used by the browsable API, is left to DRF.
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        vary_on_accept(renderer_context)
+        try:
+            content = orjson.dumps(data, default=encoder.default, option=orjson.OPT_UTC_Z)
+        except TypeError:
+            # Non-string keys are rare and make every dict slower to encode, so they are only allowed when needed
+            content = orjson.dumps(data, default=encoder.default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+        # Escaped like DRF does, so the output is valid JavaScript as well
+        if b'\xe2\x80\xa8' in content or b'\xe2\x80\xa9' in content:
+            content = content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return content
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    """
+    MessagePack for clients that send "Accept: application/msgpack". Dates and
+    other non-native values are strings, exactly as in the JSON responses.
+    """
+    media_type = MSGPACK_MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        vary_on_accept(renderer_context)
+        return msgpack.packb(data, default=encoder.default, use_bin_type=True, datetime=False)
+
+
+class MessagePackParser(parsers.BaseParser):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise ParseError(f"MessagePack parse error - {e}")
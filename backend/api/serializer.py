@@ -31,14 +31,23 @@ def get_file_url(url):
     return url
 
 
+def get_image_url(image, rendition:str='url', default=None):
+    # Falls back to the stored image for files uploaded before renditions existed,
+    # and to the default while a deferred upload has not reached the storage yet
+    if not image or image.status != 'ready':
+        return default
+    file = getattr(image, rendition) or image.url
+    return get_file_url(file.url) if file else default
+
+
 class UserImageFileSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserImageFile
-        fields = ('url', 'filename', 'id')
+        fields = ('url', 'filename', 'id', 'status')
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        data['url'] = get_file_url(data['url'])
+        data['url'] = get_file_url(data['url']) if instance.status == 'ready' else None
         
         return data
 
@@ -55,6 +64,8 @@ class ProfileSerializer(serializers.ModelSerializer):
         data = super().to_representation(instance)
         if not data['img']:
             data['img'] = get_default_image('staff_img')
+        else:
+            data['img']['url'] = get_image_url(instance.img, 'medium', get_default_image('staff_img'))
                
         return data
 
@@ -78,7 +89,7 @@ class ProfileSerializerOne(serializers.ModelSerializer):
         if not data['img']:
             data['img'] = get_default_image('staff_img')
         else:
-            data['img'] = data['img']['url']
+            data['img'] = get_image_url(instance.img, 'thumb', get_default_image('staff_img'))
 
         return {
             'id': data['id'],
@@ -148,11 +159,49 @@ class WorkoutSerializerOne(serializers.ModelSerializer):
         data = super().to_representation(instance)
         if not data['img']:
             data['img'] = get_default_image('app_logo')
+        else:
+            data['img']['url'] = get_image_url(instance.img, 'medium', get_default_image('app_logo'))
+            data['img']['thumb'] = get_image_url(instance.img, 'thumb', get_default_image('app_logo'))
                
         return data
 
 
 # Community Serializers
+def get_member_data(profile):
+    return {
+        'id': profile.id,
+        'username': profile.user.username,
+        'email': profile.user.email,
+        'gender': profile.gender,
+        'bio': profile.bio,
+        'country': profile.country,
+        'city': profile.city,
+        'age': profile.age,
+        'height': profile.height,
+        'weight': profile.weight,
+        'img': get_image_url(profile.img, 'thumb', get_default_image('staff_img')),
+    }
+
+
+def get_challenge_data(challenge):
+    return {
+        'id': challenge.id,
+        'name': challenge.name,
+        'description': challenge.description,
+        'workout_types': [x.name for x in challenge.workout_types.all()],
+        'start_date': challenge.start_date,
+        'end_date': challenge.end_date,
+        'date': challenge.date,
+        'participants': [{
+            'id': participant.id,
+            'username': participant.username,
+            'points': participant.points,
+            'rank': participant.rank,
+            'date_joined': participant.date_joined,
+        } for participant in challenge.participants.all()]
+    }
+
+
 class CommunitySerializerOne(serializers.ModelSerializer):
     img = serializers.SerializerMethodField()
     admins = serializers.SerializerMethodField()
@@ -165,44 +214,38 @@ class CommunitySerializerOne(serializers.ModelSerializer):
     
     def get_admins(self, obj):
         return [{
-            'id': item.id,
-            'username': item.user.username,
-        } for item in obj.admins.all()]
+            'id': item.profile.id,
+            'username': item.profile.user.username,
+        } for item in obj.memberships.all() if item.role == 'admin']
     
     def get_members(self, obj):
-        return [{
-            'id': item.id,
-            'username': item.user.username,
-            'email': item.user.email,
-            'gender': item.gender,
-            'bio': item.bio,
-            'country': item.country,
-            'city': item.city,
-            'age': item.age,
-            'height': item.height,
-            'weight': item.weight,
-            'img': UserImageFileSerializer(item.img).data['url'] if item.img else get_default_image('staff_img'),
-        } for item in obj.members.all()]
+        return [get_member_data(item.profile) for item in obj.memberships.all()]
     
     def get_img(self, obj):
-        return UserImageFileSerializer(obj.img).data['url'] if obj.img else get_default_image('app_logo')
+        return get_image_url(obj.img, 'medium', get_default_image('app_logo'))
     
     def get_challenges(self, obj):
-        return [{
-            'id': challenge.id,
-            'name': challenge.name,
-            'description': challenge.description,
-            'workout_types': [x.name for x in challenge.workout_types.all()],
-            'start_date': challenge.start_date,
-            'end_date': challenge.end_date,
-            'date': challenge.date,
-            'participants': [{
-                'id': participant.id,
-                'username': participant.profile.user.username,
-                'points': participant.points,
-                'date_joined': participant.date_joined,
-            } for participant in challenge.participants.all()]
-        } for challenge in obj.challenges.all()]
+        return [get_challenge_data(challenge) for challenge in obj.challenges.all()]
+
+
+class CommunitySerializerTwo(serializers.ModelSerializer):
+    img = serializers.SerializerMethodField()
+    member_count = serializers.IntegerField(read_only=True)
+    admin_count = serializers.IntegerField(read_only=True)
+    active_challenge_count = serializers.IntegerField(read_only=True)
+    role = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Community
+        fields = ('id', 'name', 'description', 'img', 'join_code', 'date', 'member_count', 'admin_count', 'active_challenge_count', 'role')
+
+    def get_img(self, obj):
+        return get_image_url(obj.img, 'medium', get_default_image('app_logo'))
+
+    def get_role(self, obj):
+        if obj.is_admin:
+            return 'admin'
+        return 'member' if obj.is_member else None
 
 
 # Challenge Serializers
@@ -220,8 +263,9 @@ class ChallengeSerializerOne(serializers.ModelSerializer):
     def get_participants(self, obj):
         return [{
             'id': participant.id,
-            'username': participant.profile.user.username,
+            'username': participant.username,
             'points': participant.points,
+            'rank': participant.rank,
             'date_joined': participant.date_joined,
         } for participant in obj.participants.all()]
 
@@ -235,7 +279,7 @@ class ChallengeParticipantSerializerOne(serializers.ModelSerializer):
         exclude = ["challenge"]
     
     def get_profile(self, obj):
-        return obj.profile.user.username
+        return obj.username or obj.profile.user.username
     
     def to_representation(self, instance):
         data = super().to_representation(instance)
@@ -245,5 +289,6 @@ class ChallengeParticipantSerializerOne(serializers.ModelSerializer):
             'username': data['profile'],
             'date_joined': data['date_joined'],
             'points': data['points'],
+            'rank': data['rank'],
         }
 
@@ -1,108 +1,186 @@
-from django.db.models.signals import post_delete, pre_save, m2m_changed, post_save
+import os
+from django.db.models.signals import post_delete, pre_delete, pre_save, m2m_changed, post_save
 from django.dispatch import receiver
 from api.models import *
 from django.db import transaction
-from api.utils import use_pusher, log_error
+from api.realtime import queue_event, queue_events
 from api.serializer import ProfileSerializerOne, ProfileSerializerTwo, ChallengeParticipantSerializerOne
-import traceback
+from api.sync import log_change, log_membership_changes
+from api.catalogue import bump_workout_types_version
+from api.storage import queue_file_deletions, get_replaced_files
+from api.authentication import revoke_user_tokens
+from django.contrib.auth.models import User
 
 
-def delete_file_from_storage(file_instance):
-    storage = file_instance.url.storage
-    file_path = file_instance.url.name
-    if storage.exists(file_path):
-        storage.delete(file_path)
+def deleted_with(origin, *models):
+    # Rows removed by a parent's cascade are covered by the parent's own
+    # tombstone and realtime event, so per-row work can be skipped
+    return isinstance(origin, models) or getattr(origin, 'model', None) in models
+
+
+# User
+# Access tokens carry the user and profile ids and are trusted without a
+# lookup, so they are revoked when the account goes away
+@receiver(post_save, sender=User)
+def user_deactivated(sender, instance, **kwargs):
+    if not instance.is_active:
+        revoke_user_tokens(instance.id)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    revoke_user_tokens(instance.id)
+
+
+@receiver(post_delete, sender=Profile)
+def profile_deleted(sender, instance, **kwargs):
+    revoke_user_tokens(instance.user_id)
 
 
 # Community
-@receiver(m2m_changed, sender=Community.members.through)
-def update_community_on_members_change(sender, instance, action, reverse, model, pk_set, **kwargs):
-    if action in ['post_add', 'post_remove']:
-        channel = f"community_{instance.id}"
-        def send_data():
-            pusher = use_pusher()
-            change_type = 'add' if action == 'post_add' else 'remove'
-            data = ProfileSerializerOne(Profile.objects.filter(id__in=pk_set), many=True).data
-            try:
-                pusher.trigger(channel, 'community_members_update', {'data': data, 'action': change_type})
-            except Exception:
-                log_error(traceback.format_exc())
-                pass
-
-        transaction.on_commit(send_data)
-
-
-@receiver(m2m_changed, sender=Community.admins.through)
-def update_community_on_admin_change(sender, instance, action, reverse, model, pk_set, **kwargs):
-    if action in ['post_add', 'post_remove']:
-        channel = f"community_{instance.id}"
-        def send_data():
-            pusher = use_pusher()
-            change_type = 'add' if action == 'post_add' else 'remove'
-            data = ProfileSerializerTwo(Profile.objects.filter(id__in=pk_set), many=True).data
-            try:
-                pusher.trigger(channel, 'community_admins_update', {'data': data, 'action': change_type})
-            except Exception:
-                log_error(traceback.format_exc())
-                pass
-
-        transaction.on_commit(send_data)
+def membership_changed(membership, member_action=None, admin_action=None):
+    channel, pairs = f"community_{membership.community_id}", [(membership.community_id, membership.profile_id)]
+    if member_action:
+        data = ProfileSerializerOne(Profile.objects.select_related('user', 'img').filter(id=membership.profile_id), many=True).data
+        queue_event(channel, 'community_members_update', {'data': data, 'action': member_action})
+        log_membership_changes('community_member', 'upsert' if member_action == 'add' else 'delete', pairs)
+    if admin_action:
+        data = ProfileSerializerTwo(Profile.objects.select_related('user').filter(id=membership.profile_id), many=True).data
+        queue_event(channel, 'community_admins_update', {'data': data, 'action': admin_action})
+        log_membership_changes('community_admin', 'upsert' if admin_action == 'add' else 'delete', pairs)
+
+
+@receiver(post_save, sender=CommunityMembership)
+def community_membership_saved(sender, instance, created, **kwargs):
+    was_admin = not created and getattr(instance, '_stored_role', None) == 'admin'
+    is_admin = instance.role == 'admin'
+    admin_action = None if was_admin == is_admin else 'add' if is_admin else 'remove'
+    membership_changed(instance, 'add' if created else None, admin_action)
+    instance._stored_role = instance.role
+
+
+@receiver(post_delete, sender=CommunityMembership)
+def community_membership_deleted(sender, instance, origin=None, **kwargs):
+    if deleted_with(origin, Community):
+        return
+    membership_changed(instance, 'remove', 'remove' if instance.role == 'admin' else None)
+
+
+# Workout Type
+@receiver(post_save, sender=WorkoutType)
+@receiver(post_delete, sender=WorkoutType)
+def workout_types_changed(sender, instance, **kwargs):
+    transaction.on_commit(bump_workout_types_version)
 
 
 # Challenge Participant
 @receiver(post_save, sender=ChallengeParticipant)
 def challenge_participant_added(sender, instance, **kwargs):
-    channel = f"community_{instance.challenge.community.id}"
-    challenge_id = instance.challenge.id
+    channel = f"community_{instance.challenge.community_id}"
+    challenge_id = instance.challenge_id
     data = ChallengeParticipantSerializerOne(instance).data
-    def send_data():
-        try:
-            pusher = use_pusher()
-            pusher.trigger(channel, 'challenge_participants_update', {'data': data, 'action': 'add', 'challenge_id': challenge_id})
-        except Exception:
-            log_error(traceback.format_exc())
-            pass
-
-    transaction.on_commit(send_data)
+    queue_event(channel, 'challenge_participants_update', {'data': data, 'action': 'add', 'challenge_id': challenge_id})
+
+
+def challenge_participants_updated(participants):
+    # Points are applied with a set-based update(), which sends no post_save,
+    # so the change log and realtime updates are produced here instead.
+    ChangeLog.objects.bulk_create([ChangeLog(
+        entity='challenge_participant',
+        entity_id=participant.id,
+        action='upsert',
+        community_ref=participant.challenge.community_id,
+        parent_ref=participant.challenge_id,
+    ) for participant in participants])
+    queue_events([(
+        f"community_{participant.challenge.community_id}",
+        'challenge_participants_update',
+        {'data': ChallengeParticipantSerializerOne(participant).data, 'action': 'add', 'challenge_id': participant.challenge_id},
+    ) for participant in participants])
 
 
 @receiver(post_delete, sender=ChallengeParticipant)
-def challenge_participant_removed(sender, instance, **kwargs):
-    channel = f"community_{instance.challenge.community.id}"
-    challenge_id = instance.challenge.id
+def challenge_participant_removed(sender, instance, origin=None, **kwargs):
+    if deleted_with(origin, Challenge, Community):
+        return
+    channel = f"community_{instance.challenge.community_id}"
+    challenge_id = instance.challenge_id
     data = ChallengeParticipantSerializerOne(instance).data
-    def send_data():
-        try:
-            pusher = use_pusher()
-            pusher.trigger(channel, 'challenge_participants_update', {'data': data, 'action': 'remove', 'challenge_id': challenge_id})
-        except Exception:
-            log_error(traceback.format_exc())
-            pass
+    queue_event(channel, 'challenge_participants_update', {'data': data, 'action': 'remove', 'challenge_id': challenge_id})
+
+
+# Change Log
+@receiver(post_save, sender=Workout)
+def log_workout_saved(sender, instance, **kwargs):
+    log_change('workout', instance.id, 'upsert', profile_ref=instance.profile_id)
+
+
+@receiver(post_delete, sender=Workout)
+def log_workout_deleted(sender, instance, **kwargs):
+    log_change('workout', instance.id, 'delete', profile_ref=instance.profile_id)
+
+
+@receiver(post_save, sender=Community)
+def log_community_saved(sender, instance, **kwargs):
+    log_change('community', instance.id, 'upsert', community_ref=instance.id)
 
-    transaction.on_commit(send_data)
+
+@receiver(pre_delete, sender=Community)
+def log_community_deleted(sender, instance, **kwargs):
+    # Membership rows removed by the cascade skip their own receivers, so record
+    # a tombstone for every member while they can still be looked up
+    log_membership_changes('community_member', 'delete', [(instance.id, x) for x in instance.members.values_list('id', flat=True)])
+    log_change('community', instance.id, 'delete', community_ref=instance.id)
+
+
+@receiver(post_save, sender=Challenge)
+def log_challenge_saved(sender, instance, **kwargs):
+    log_change('challenge', instance.id, 'upsert', community_ref=instance.community_id, parent_ref=instance.community_id)
+
+
+@receiver(post_delete, sender=Challenge)
+def log_challenge_deleted(sender, instance, origin=None, **kwargs):
+    if deleted_with(origin, Community):
+        return
+    log_change('challenge', instance.id, 'delete', community_ref=instance.community_id, parent_ref=instance.community_id)
+
+
+@receiver(m2m_changed, sender=Challenge.workout_types.through)
+def log_challenge_workout_types_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        challenges = Challenge.objects.filter(id__in=pk_set or []) if reverse else [instance]
+        for challenge in challenges:
+            log_change('challenge', challenge.id, 'upsert', community_ref=challenge.community_id, parent_ref=challenge.community_id)
+
+
+@receiver(post_save, sender=ChallengeParticipant)
+def log_challenge_participant_saved(sender, instance, **kwargs):
+    log_change('challenge_participant', instance.id, 'upsert', community_ref=instance.challenge.community_id, parent_ref=instance.challenge_id)
+
+
+@receiver(post_delete, sender=ChallengeParticipant)
+def log_challenge_participant_deleted(sender, instance, origin=None, **kwargs):
+    if deleted_with(origin, Challenge, Community):
+        return
+    log_change('challenge_participant', instance.id, 'delete', community_ref=instance.challenge.community_id, parent_ref=instance.challenge_id)
 
 
 # User Image File
+# Storage files are queued for the process_storage_deletions worker
 @receiver(post_delete, sender=UserImageFile)
 def auto_delete_staff_image_file_post_delete(sender, instance, **kwargs):
-    transaction.on_commit(lambda: delete_file_from_storage(instance))
+    queue_file_deletions([x.name for x in instance.get_files()])
+    spool_path = instance.spool_path
+    if spool_path:
+        transaction.on_commit(lambda: os.path.exists(spool_path) and os.remove(spool_path))
 
 
 @receiver(pre_save, sender=UserImageFile)
 def auto_delete_old_staff_image_file_on_change(sender, instance, **kwargs):
-    if not instance.pk:
-        return
-    try:
-        old_file = UserImageFile.objects.get(pk=instance.pk).url
-        storage = old_file.storage
-        old_file_path = old_file.name
-    except UserImageFile.DoesNotExist:
-        return
+    if instance.pk:
+        queue_file_deletions(get_replaced_files(instance))
 
-    def delete_old_file():
-        if storage.exists(old_file_path):
-            storage.delete(old_file_path)
-    new_file = instance.url
-    if old_file and old_file != new_file:
-        transaction.on_commit(delete_old_file)
 
+@receiver(post_save, sender=UserImageFile)
+def remember_stored_image_files(sender, instance, **kwargs):
+    instance._stored_files = {x: getattr(instance, x).name for x in ['url', 'thumb', 'medium']}
@@ -0,0 +1,170 @@
+import os
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import cloudinary.api
+from cloudinary_storage.storage import MediaCloudinaryStorage
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from api.metrics import track
+from api.models import UserImageFile, StorageDeletion
+from api.utils import log_error
+
+# Cloudinary's delete_resources accepts at most 100 public ids per call
+DELETE_BATCH_SIZE = 100
+IMAGE_FIELDS = ['url', 'thumb', 'medium']
+
+
+def get_image_storage():
+    return UserImageFile._meta.get_field('url').storage
+
+
+def is_cloudinary(storage):
+    return isinstance(storage, MediaCloudinaryStorage)
+
+
+def chunked(items, size:int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def delete_stored_files(names):
+    """
+    Deletes the named files from the image storage and returns the names that
+    could not be deleted. Files that are already gone count as deleted.
+    """
+    storage = get_image_storage()
+    names = list(dict.fromkeys(x for x in names if x))
+
+    def delete_batch(batch):
+        try:
+            if is_cloudinary(storage):
+                response = cloudinary.api.delete_resources(batch, resource_type='image', invalidate=True)
+                return [x for x in batch if response['deleted'].get(x) not in ('deleted', 'not_found')]
+            storage.delete(batch[0])
+            return []
+        except Exception:
+            log_error(traceback.format_exc())
+            return batch
+
+    # Other storages delete one file per call, so those calls run side by side instead
+    batches = list(chunked(names, DELETE_BATCH_SIZE if is_cloudinary(storage) else 1))
+    with track('storage'), ThreadPoolExecutor(max_workers=settings.STORAGE_DELETE_WORKERS) as executor:
+        return [x for failed in executor.map(delete_batch, batches) for x in failed]
+
+
+def delete_file(File):
+    # Used when the transaction that created the image is rolled back, so a
+    # queued deletion would be rolled back with it
+    if hasattr(File, 'get_files'):
+        delete_stored_files([x.name for x in File.get_files()])
+    if getattr(File, 'spool_path', '') and os.path.exists(File.spool_path):
+        os.remove(File.spool_path)
+
+
+def queue_file_deletions(names):
+    # Written in the caller's transaction, so files are only removed once the
+    # change that orphaned them is committed
+    StorageDeletion.objects.bulk_create([StorageDeletion(name=x) for x in dict.fromkeys(names) if x])
+
+
+def get_replaced_files(image):
+    stored = getattr(image, '_stored_files', {})
+    return [name for field, name in stored.items() if name and name != getattr(image, field).name]
+
+
+def claim_storage_deletions(limit:int):
+    """
+    Claims up to `limit` queued deletions, leasing them to the caller by
+    moving next_attempt_at past the claim timeout. The claim commits before
+    any file is deleted, so no rows stay locked during the storage calls.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        deletions = list(StorageDeletion.objects.select_for_update(skip_locked=True).filter(
+            attempts__lt=settings.STORAGE_DELETE_MAX_ATTEMPTS, next_attempt_at__lte=now).order_by('id')[:limit])
+        lease = now + timedelta(seconds=settings.STORAGE_DELETE_CLAIM_SECONDS)
+        StorageDeletion.objects.filter(id__in=[x.id for x in deletions]).update(next_attempt_at=lease)
+    return deletions
+
+
+def process_storage_deletions(limit:int=500):
+    """
+    Deletes up to `limit` queued files in batches and returns the number removed.
+    """
+    deletions = claim_storage_deletions(limit)
+    if not deletions:
+        return 0
+
+    failed = set(delete_stored_files([x.name for x in deletions]))
+    StorageDeletion.objects.filter(id__in=[x.id for x in deletions if x.name not in failed]).delete()
+    if failed:
+        # Retried on the next run instead of waiting for the lease to run out
+        StorageDeletion.objects.filter(id__in=[x.id for x in deletions if x.name in failed]).update(
+            attempts=F('attempts') + 1, last_error='Delete failed', next_attempt_at=timezone.now())
+
+    return len(deletions) - len([x for x in deletions if x.name in failed])
+
+
+def get_storage_prefix(prefix:str):
+    # MediaCloudinaryStorage stores names under its configured prefix
+    storage = get_image_storage()
+    return storage._prepend_prefix(prefix) if is_cloudinary(storage) else prefix
+
+
+def list_stored_files(prefix:str):
+    """
+    Returns {name: created_at} for every image in the storage under the prefix.
+    """
+    storage, files = get_image_storage(), {}
+    if is_cloudinary(storage):
+        next_cursor = None
+        while True:
+            response = cloudinary.api.resources(type='upload', resource_type='image', prefix=prefix, max_results=500, next_cursor=next_cursor)
+            for resource in response['resources']:
+                files[resource['public_id']] = resource['created_at']
+            next_cursor = response.get('next_cursor')
+            if not next_cursor:
+                return files
+
+    def walk(path):
+        if not storage.exists(path):
+            return
+        directories, names = storage.listdir(path)
+        for name in names:
+            name = os.path.join(path, name).replace('\\', '/')
+            files[name] = storage.get_modified_time(name)
+        for directory in directories:
+            walk(os.path.join(path, directory))
+    walk(prefix)
+    return files
+
+
+def find_orphans(prefix:str, grace_period:timedelta):
+    """
+    Returns the stored files no UserImageFile points at, and the ids of ready
+    UserImageFile rows whose original file is missing from the storage. Anything
+    newer than the grace period is left alone so in-flight uploads are not touched.
+    """
+    cutoff = timezone.now() - grace_period
+    prefix = get_storage_prefix(prefix)
+    stored = list_stored_files(prefix)
+    referenced = set()
+    missing = []
+    for image in UserImageFile.objects.values('id', 'status', 'uploaded_at', *IMAGE_FIELDS).iterator(chunk_size=2000):
+        referenced.update(image[x] for x in IMAGE_FIELDS if image[x])
+        if image['status'] == 'ready' and image['url'] and image['url'].startswith(prefix) and image['url'] not in stored and image['uploaded_at'] < cutoff:
+            missing.append(image['id'])
+
+    orphans = []
+    for name, created_at in stored.items():
+        if isinstance(created_at, str):
+            created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+        if timezone.is_naive(created_at):
+            created_at = timezone.make_aware(created_at)
+        if name not in referenced and created_at < cutoff:
+            orphans.append(name)
+
+    return sorted(orphans), missing
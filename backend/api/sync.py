@@ -0,0 +1,139 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q, Max, Min
+from django.utils import timezone
+from api.models import *
+from api.queries import get_community_summary_queryset
+from api.serializer import CommunitySerializerTwo, ChallengeParticipantSerializerOne, ProfileSerializerTwo
+from api.projections import get_workout_values, get_workouts_data, get_member_values, get_members_data, get_challenge_values, get_challenges_data
+from api.entities import get_normalized_workouts, get_normalized_community, get_normalized_challenges, get_normalized_participant, get_participant_values
+
+
+def log_change(entity:str, entity_id:int, action:str, profile_ref=None, community_ref=None, parent_ref=None):
+    ChangeLog.objects.create(
+        entity=entity,
+        entity_id=entity_id,
+        action=action,
+        profile_ref=profile_ref,
+        community_ref=community_ref,
+        parent_ref=parent_ref,
+    )
+
+
+def log_membership_changes(entity:str, action:str, pairs):
+    # pairs: (community_id, profile_id)
+    ChangeLog.objects.bulk_create([ChangeLog(
+        entity=entity,
+        entity_id=profile_id,
+        action=action,
+        profile_ref=profile_id,
+        community_ref=community_id,
+        parent_ref=community_id,
+    ) for community_id, profile_id in pairs])
+
+
+def get_sync_token():
+    # Only hand out tokens for entries old enough that every transaction which
+    # allocated a lower id has committed. Newer entries are simply re-sent on
+    # the next sync, which is harmless since upserts and tombstones are idempotent.
+    settled = timezone.now() - timedelta(seconds=settings.SYNC_SETTLE_SECONDS)
+    return ChangeLog.objects.filter(date__lt=settled).aggregate(token=Max('id'))['token'] or 0
+
+
+def parse_sync_token(value):
+    try:
+        token = int(value)
+    except (TypeError, ValueError):
+        return None
+    return token if token >= 0 else None
+
+
+def get_sync_changes(profile, since:int, token:int, entities=None):
+    """
+    Returns the changes visible to the profile since the given token, or None
+    when the log can no longer serve that window and the client must reset.
+    With an EntityMap the changes are in the normalized shape.
+    """
+    bounds = ChangeLog.objects.aggregate(first=Min('id'), last=Max('id'))
+    if since > (bounds['last'] or 0) or (bounds['first'] and since < bounds['first'] - 1):
+        return None
+
+    community_ids = list(profile.communities.values_list('id', flat=True))
+    if entities:
+        entities.community_ids = set(community_ids)
+    entries = list(ChangeLog.objects.filter(id__gt=since).filter(
+        Q(profile_ref=profile.id, entity__in=['workout', 'community_member']) | Q(community_ref__in=community_ids)
+    ).order_by('id').values('entity', 'entity_id', 'action', 'profile_ref', 'community_ref', 'parent_ref')[:settings.SYNC_MAX_CHANGES + 1])
+    if len(entries) > settings.SYNC_MAX_CHANGES:
+        return None
+
+    # Collapse the log to the final action per entity
+    latest = {}
+    for entry in entries:
+        latest[(entry['entity'], entry['entity_id'], entry['community_ref'])] = entry
+
+    changed = {key: {'updated': set(), 'deleted': {}} for key in ['workout', 'community', 'challenge', 'challenge_participant', 'community_member', 'community_admin']}
+    for (entity, entity_id, community_ref), entry in latest.items():
+        if entity == 'community_member' and entity_id == profile.id:
+            # The caller joined or left the community
+            entity, entity_id = 'community', community_ref
+        if entry['action'] == 'upsert':
+            changed[entity]['updated'].add(entity_id)
+        else:
+            changed[entity]['deleted'][entity_id] = entry['parent_ref']
+
+    communities_deleted = set(changed['community']['deleted']) - changed['community']['updated']
+    communities_updated = changed['community']['updated'] & set(community_ids)
+    communities_deleted |= changed['community']['updated'] - set(community_ids)
+    skip_communities = communities_deleted | communities_updated
+
+    workouts = Workout.objects.filter(id__in=changed['workout']['updated'], profile=profile).order_by('-id')
+    workouts_data = get_normalized_workouts(get_workout_values(workouts), entities) if entities else get_workouts_data(get_workout_values(workouts))
+    workouts_deleted = set(changed['workout']['deleted']) | (changed['workout']['updated'] - {x['id'] for x in workouts_data})
+
+    communities = get_community_summary_queryset(profile).filter(id__in=communities_updated)
+    communities_data = [get_normalized_community(x, entities) for x in communities] if entities else CommunitySerializerTwo(communities, many=True).data
+
+    challenges = Challenge.objects.filter(
+        id__in=changed['challenge']['updated'], community_id__in=community_ids).exclude(community_id__in=skip_communities).order_by('-id')
+    challenges_data = get_normalized_challenges(get_challenge_values(challenges), entities) if entities else get_challenges_data(get_challenge_values(challenges))
+
+    participants = ChallengeParticipant.objects.filter(
+        id__in=changed['challenge_participant']['updated'], challenge__community_id__in=community_ids).exclude(challenge__community_id__in=skip_communities).order_by('id')
+    if entities:
+        participants_data = [{**get_normalized_participant(x, entities), 'challenge': x['challenge_id']} for x in get_participant_values(participants)]
+    else:
+        participants_data = [{**ChallengeParticipantSerializerOne(participant).data, 'challenge': participant.challenge_id} for participant in participants]
+
+    members_data, admins_data = [], []
+    for community_id in set(community_ids) - skip_communities:
+        members = [x for x in changed['community_member']['updated'] if latest.get(('community_member', x, community_id), {}).get('action') == 'upsert']
+        admins = [x for x in changed['community_admin']['updated'] if latest.get(('community_admin', x, community_id), {}).get('action') == 'upsert']
+        if members:
+            rows = get_member_values(Profile.objects.filter(id__in=members, communities=community_id).order_by('-id'))
+            if entities:
+                members_data += [{'id': entities.add_profile(x), 'community': community_id} for x in rows]
+            else:
+                members_data += [{**x, 'community': community_id} for x in get_members_data(rows)]
+        if admins:
+            profiles = Profile.objects.filter(id__in=admins, memberships__community_id=community_id, memberships__role='admin').order_by('-id')
+            if entities:
+                admins_data += [{'id': entities.ref_profile(x), 'community': community_id} for x in profiles.values_list('id', flat=True)]
+            else:
+                admins_data += [{**x, 'community': community_id} for x in ProfileSerializerTwo(profiles.select_related('user'), many=True).data]
+
+    def tombstones(entity, parent):
+        return [{'id': key[1], parent: entry['parent_ref']} for key, entry in latest.items()
+                if key[0] == entity and entry['action'] == 'delete' and key[2] not in skip_communities
+                and not (entity == 'community_member' and key[1] == profile.id)]
+
+    return {
+        'sync_token': token,
+        'reset': False,
+        'workouts': {'updated': workouts_data, 'deleted': sorted(workouts_deleted)},
+        'communities': {'updated': communities_data, 'deleted': sorted(communities_deleted)},
+        'challenges': {'updated': challenges_data, 'deleted': tombstones('challenge', 'community')},
+        'challenge_participants': {'updated': participants_data, 'deleted': tombstones('challenge_participant', 'challenge')},
+        'community_members': {'updated': members_data, 'deleted': tombstones('community_member', 'community')},
+        'community_admins': {'updated': admins_data, 'deleted': tombstones('community_admin', 'community')},
+    }
@@ -1,3 +1,1468 @@
-from django.test import TestCase
+import io
+import os
+import json
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+import msgpack
+import cloudinary
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from cloudinary_storage.storage import MediaCloudinaryStorage
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.urls import ResolverMatch
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.serializer_helpers import ReturnDict
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+from rest_framework_simplejwt.tokens import RefreshToken, AccessToken
+from api.authentication import CachedRefreshToken, is_blacklisted
+from api.catalogue import get_workout_type_catalogue
+from api.images import create_renditions, process_pending_uploads
+from api.metrics import registry, get_view_name, collect_metrics
+from api.projections import ImageURLs, get_communities_data, get_workout_values, get_workouts_data, get_member_values, get_members_data, get_challenge_values, get_challenge_rows, get_challenges_data
+from api.queries import get_community_queryset, get_challenge_queryset
+from api.serializer import CommunitySerializerOne, WorkoutSerializerOne, ChallengeSerializerOne, ProfileSerializerOne, get_member_data, get_challenge_data
+from api.leaderboard import move_on_leaderboard, rebuild_leaderboard
+from api.models import ChangeLog, RealtimeEvent, Profile, WorkoutType, Workout, UserImageFile, StorageDeletion, Community, CommunityMembership, Challenge, ChallengeParticipant
+from api.storage import claim_storage_deletions, process_storage_deletions, queue_file_deletions, find_orphans, get_image_storage
+from api.sync import get_sync_token
+from api.renderers import ORJSONRenderer
+from api.realtime import queue_event, queue_events, claim_pending_events, coalesce_events, deliver_pending_events, get_event_size
+from api.utils import use_pusher, reset_pusher_client, get_pusher_stats
+from api.views import UserAuthSerializer, register_user_async, get_user_workout_data, get_user_workout_data_async
+from backend.asgi import serve_static_first, get_static_application
+
 
 # Create your tests here.
+class FakePusherHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        if server.fail_requests:
+            server.fail_requests -= 1
+            self.send_response(500)
+            self.end_headers()
+            return
+        if any('"reject"' in x['data'] for x in body['batch']):
+            self.send_response(400)
+            self.end_headers()
+            return
+        server.batches.append(body['batch'])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class RealtimeOutboxTests(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakePusherHandler)
+        self.server.batches, self.server.fail_requests = [], 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        reset_pusher_client()
+        self.addCleanup(reset_pusher_client)
+        with override_settings(PUSHER_APP_ID='1', PUSHER_KEY='key', PUSHER_SECRET='secret', PUSHER_HOST='127.0.0.1', PUSHER_PORT=self.server.server_port, PUSHER_SSL=False):
+            self.pusher_client = use_pusher()
+
+    def sent_events(self):
+        return [(x['channel'], x['name'], json.loads(x['data'])) for batch in self.server.batches for x in batch]
+
+    def test_events_are_sent_in_batches_of_ten(self):
+        for i in range(12):
+            queue_event('community_1', 'update', {'n': i})
+
+        self.assertEqual(deliver_pending_events(self.pusher_client), 12)
+        self.assertEqual([len(x) for x in self.server.batches], [10, 2])
+        self.assertEqual([x[2]['n'] for x in self.sent_events()], list(range(12)))
+        self.assertFalse(RealtimeEvent.objects.filter(sent_at__isnull=True).exists())
+
+    def test_pusher_client_is_reused_and_counts_deliveries(self):
+        self.assertIs(use_pusher(), self.pusher_client)
+        stats = get_pusher_stats()
+        queue_event('community_1', 'update', {'n': 1})
+        queue_event('community_2', 'update', {'n': 2})
+        self.server.fail_requests = 1
+        deliver_pending_events(self.pusher_client)
+        RealtimeEvent.objects.update(next_attempt_at=timezone.now())
+        deliver_pending_events(self.pusher_client)
+
+        new_stats = get_pusher_stats()
+        self.assertEqual(new_stats['requests'] - stats['requests'], 2)
+        self.assertEqual(new_stats['events_sent'] - stats['events_sent'], 2)
+        self.assertEqual(new_stats['events_failed'] - stats['events_failed'], 2)
+
+    def test_pusher_requests_are_published_as_metrics(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir, True)
+        counts = lambda: {key: value['count'] for key, value in collect_metrics().items() if key[0] == 'powerup_pusher_request_events'}
+        with override_settings(METRICS_DIR=metrics_dir):
+            before = counts()
+            queue_event('community_1', 'update', {'n': 1})
+            queue_event('community_2', 'update', {'n': 2})
+            self.server.fail_requests = 1
+            deliver_pending_events(self.pusher_client)
+            RealtimeEvent.objects.update(next_attempt_at=timezone.now())
+            deliver_pending_events(self.pusher_client)
+            after = counts()
+        for status in ['ok', 'error']:
+            key = ('powerup_pusher_request_events', (('status', status),))
+            self.assertEqual(after[key] - before.get(key, 0), 1)
+
+    def test_failed_events_are_retried_with_backoff(self):
+        queue_event('community_1', 'update', {'n': 1})
+        self.server.fail_requests = 1
+
+        self.assertEqual(deliver_pending_events(self.pusher_client), 0)
+        event = RealtimeEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertGreater(event.next_attempt_at, timezone.now())
+
+        RealtimeEvent.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(deliver_pending_events(self.pusher_client), 1)
+        self.assertEqual(self.sent_events(), [('community_1', 'update', {'n': 1})])
+
+    def test_channel_order_is_kept_while_an_event_waits_for_retry(self):
+        queue_event('community_1', 'update', {'n': 1})
+        RealtimeEvent.objects.update(attempts=1, next_attempt_at=timezone.now() + timedelta(minutes=1))
+        queue_event('community_1', 'update', {'n': 2})
+        queue_event('community_2', 'update', {'n': 3})
+
+        self.assertEqual(deliver_pending_events(self.pusher_client), 1)
+        self.assertEqual(self.sent_events(), [('community_2', 'update', {'n': 3})])
+
+    def test_a_channel_waiting_for_retry_does_not_hold_back_other_channels(self):
+        queue_events([('community_1', 'update', {'n': i}) for i in range(5)])
+        RealtimeEvent.objects.update(attempts=1, next_attempt_at=timezone.now() + timedelta(minutes=1))
+        queue_event('community_2', 'update', {'n': 5})
+
+        self.assertEqual(deliver_pending_events(self.pusher_client, limit=3), 1)
+        self.assertEqual(self.sent_events(), [('community_2', 'update', {'n': 5})])
+
+    def test_claimed_events_are_leased_until_delivered(self):
+        queue_event('community_1', 'update', {'n': 1})
+        queue_event('community_1', 'update', {'n': 2})
+        queue_event('community_2', 'update', {'n': 3})
+
+        claimed = claim_pending_events(limit=1)
+        self.assertEqual([x.data for x in claimed], [{'n': 1}])
+        self.assertGreater(RealtimeEvent.objects.get(id=claimed[0].id).next_attempt_at, timezone.now())
+        # The rest of the leased channel waits for the worker holding the claim
+        self.assertEqual(deliver_pending_events(self.pusher_client), 1)
+        self.assertEqual(self.sent_events(), [('community_2', 'update', {'n': 3})])
+
+    def test_oversized_events_are_failed_on_their_own(self):
+        queue_event('community_1', 'update', {'text': 'x' * 20000})
+        queue_event('community_2', 'update', {'n': 1})
+
+        self.assertEqual(deliver_pending_events(self.pusher_client), 1)
+        self.assertEqual(self.sent_events(), [('community_2', 'update', {'n': 1})])
+        event = RealtimeEvent.objects.get(channel='community_1')
+        self.assertEqual((event.attempts, event.last_error), (0, 'Too much data'))
+        self.assertIsNotNone(event.failed_at)
+
+    def test_a_rejected_batch_is_retried_one_event_at_a_time(self):
+        queue_event('community_1', 'update', {'reject': True})
+        queue_event('community_1', 'update', {'n': 2})
+        queue_event('community_2', 'update', {'n': 3})
+
+        self.assertEqual(deliver_pending_events(self.pusher_client), 1)
+        self.assertEqual(self.sent_events(), [('community_2', 'update', {'n': 3})])
+        attempts = dict(RealtimeEvent.objects.filter(channel='community_1').values_list('data__n', 'attempts'))
+        self.assertEqual(attempts, {None: 1, 2: 0})
+
+    @override_settings(REALTIME_MAX_ATTEMPTS=1)
+    def test_events_are_given_up_after_max_attempts(self):
+        queue_event('community_1', 'update', {'n': 1})
+        queue_event('community_1', 'update', {'n': 2})
+        self.server.fail_requests = 1
+
+        deliver_pending_events(self.pusher_client)
+        self.assertEqual(RealtimeEvent.objects.filter(failed_at__isnull=False).count(), 2)
+        self.assertEqual(deliver_pending_events(self.pusher_client), 0)
+
+
+class DeferredUploadTests(TestCase):
+    def setUp(self):
+        # The file system storage stands in for Cloudinary
+        self.media_root, self.spool_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        self.addCleanup(shutil.rmtree, self.spool_dir, True)
+        settings_override = override_settings(MEDIA_UPLOAD_MODE='deferred', MEDIA_ROOT=self.media_root, MEDIA_SPOOL_DIR=self.spool_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='runner', password='password123')
+        Profile.objects.create(user=self.user)
+        self.workout_type = WorkoutType.objects.create(name='Running')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_workout(self):
+        output = io.BytesIO()
+        Image.new('RGB', (1200, 900), 'red').save(output, format='JPEG')
+        return self.client.post('/workout/data', {
+            'type': 'createWorkout',
+            'selfie': SimpleUploadedFile('selfie.jpg', output.getvalue(), content_type='image/jpeg'),
+            'workoutType': self.workout_type.id,
+            'pointsEarned': 10,
+            'caloriesBurned': 50,
+            'duration': 20,
+        }, format='multipart')
+
+    def test_workout_is_saved_before_the_image_is_stored(self):
+        response = self.create_workout()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['img']['status'], 'pending')
+        self.assertEqual(os.listdir(self.media_root), [])
+
+        image = Workout.objects.get(id=response.data['id']).img
+        self.assertTrue(os.path.exists(image.spool_path))
+        spool_path = image.spool_path
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(process_pending_uploads(), 1)
+        image.refresh_from_db()
+        self.assertEqual(image.status, 'ready')
+        self.assertTrue(all(x.storage.exists(x.name) for x in [image.url, image.thumb, image.medium]))
+        self.assertFalse(os.path.exists(spool_path))
+
+    @override_settings(MEDIA_UPLOAD_MAX_ATTEMPTS=2)
+    def test_unreadable_spool_file_is_given_up_after_max_attempts(self):
+        response = self.create_workout()
+        image = Workout.objects.get(id=response.data['id']).img
+        with open(image.spool_path, 'wb') as spool:
+            spool.write(b'not an image')
+
+        self.assertEqual(process_pending_uploads(), 0)
+        self.assertEqual(UserImageFile.objects.get(id=image.id).status, 'pending')
+        self.assertEqual(process_pending_uploads(), 0)
+        self.assertEqual(UserImageFile.objects.get(id=image.id).status, 'failed')
+
+
+class UploadTicketTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(UPLOAD_BACKEND='local', MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='runner', password='password123')
+        Profile.objects.create(user=self.user)
+        self.workout_type = WorkoutType.objects.create(name='Running')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload_image(self):
+        ticket = self.client.post('/upload/ticket', {'filename': 'selfie.png'}).data
+        output = io.BytesIO()
+        Image.new('RGB', (64, 64), 'blue').save(output, format='PNG')
+        response = APIClient().post(ticket['upload_url'], {**ticket['fields'], 'file': SimpleUploadedFile('selfie.png', output.getvalue())}, format='multipart')
+        self.assertEqual(response.status_code, 204)
+        return ticket
+
+    def test_uploaded_image_is_confirmed_and_attached_to_a_workout(self):
+        ticket = self.upload_image()
+        response = self.client.post('/upload/confirm', {'ticket': ticket['ticket']})
+        self.assertEqual(response.status_code, 201)
+        image_id = response.data['id']
+
+        response = self.client.post('/workout/data', {
+            'type': 'createWorkout',
+            'selfieId': image_id,
+            'workoutType': self.workout_type.id,
+            'pointsEarned': 10,
+            'caloriesBurned': 50,
+            'duration': 20,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['img']['id'], image_id)
+
+        # An attached image cannot be reused for another workout
+        response = self.client.post('/workout/data', {
+            'type': 'createWorkout', 'selfieId': image_id, 'workoutType': self.workout_type.id,
+            'pointsEarned': 10, 'caloriesBurned': 50, 'duration': 20,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+    def test_confirmed_upload_gets_renditions_without_metadata(self):
+        ticket = self.client.post('/upload/ticket', {'filename': 'selfie.jpg'}).data
+        exif = Image.Exif()
+        exif[0x8825] = {2: (51.0, 30.0, 0.0)}
+        output = io.BytesIO()
+        Image.new('RGB', (3000, 1500), 'blue').save(output, format='JPEG', exif=exif)
+        APIClient().post(ticket['upload_url'], {**ticket['fields'], 'file': SimpleUploadedFile('selfie.jpg', output.getvalue())}, format='multipart')
+
+        response = self.client.post('/upload/confirm', {'ticket': ticket['ticket']})
+        self.assertEqual(response.status_code, 201)
+        image = UserImageFile.objects.get(id=response.data['id'])
+        with Image.open(image.url) as original, Image.open(image.thumb) as thumb:
+            self.assertEqual((original.size, thumb.size), ((2048, 1024), (160, 80)))
+            self.assertNotIn('exif', original.info)
+        self.assertEqual(image.filename, 'selfie.jpg')
+        # Confirming again returns the same image, and the file as uploaded is queued for deletion
+        self.assertEqual(self.client.post('/upload/confirm', {'ticket': ticket['ticket']}).data['id'], image.id)
+        self.assertEqual(StorageDeletion.objects.count(), 1)
+
+    def test_ticket_is_bound_to_its_user(self):
+        ticket = self.upload_image()
+        other_user = User.objects.create_user(username='walker', password='password123')
+        client = APIClient()
+        client.force_authenticate(other_user)
+        self.assertEqual(client.post('/upload/confirm', {'ticket': ticket['ticket']}).status_code, 400)
+        self.assertEqual(self.client.post('/upload/confirm', {'ticket': ticket['ticket'] + 'x'}).status_code, 400)
+
+    def test_ticket_cannot_be_used_twice(self):
+        ticket = self.upload_image()
+        output = io.BytesIO()
+        Image.new('RGB', (64, 64), 'green').save(output, format='PNG')
+        response = APIClient().post(ticket['upload_url'], {**ticket['fields'], 'file': SimpleUploadedFile('other.png', output.getvalue())}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+
+class ImageRenditionTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_UPLOAD_MODE='sync')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='runner', password='password123')
+        Profile.objects.create(user=self.user)
+        self.workout_type = WorkoutType.objects.create(name='Running')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_workout(self, content, name='selfie.jpg'):
+        return self.client.post('/workout/data', {
+            'type': 'createWorkout',
+            'selfie': SimpleUploadedFile(name, content, content_type='image/jpeg'),
+            'workoutType': self.workout_type.id, 'pointsEarned': 10, 'caloriesBurned': 50, 'duration': 20,
+        }, format='multipart')
+
+    def create_photo(self, size, exif_tags=None):
+        exif = Image.Exif()
+        exif.update(exif_tags or {})
+        output = io.BytesIO()
+        Image.new('RGB', size, 'blue').save(output, format='JPEG', exif=exif)
+        return output.getvalue()
+
+    def test_renditions_are_stored_at_the_configured_sizes(self):
+        response = self.create_workout(self.create_photo((3000, 1500)))
+        self.assertEqual(response.status_code, 200)
+        image = Workout.objects.get(id=response.data['id']).img
+        sizes = {}
+        for name, field in [('original', image.url), ('medium', image.medium), ('thumb', image.thumb)]:
+            with Image.open(field) as rendition:
+                sizes[name] = (rendition.format, rendition.size)
+        self.assertEqual(sizes, {'original': ('WEBP', (2048, 1024)), 'medium': ('WEBP', (720, 360)), 'thumb': ('WEBP', (160, 80))})
+
+    def test_small_images_are_not_enlarged(self):
+        renditions = create_renditions(SimpleUploadedFile('small.jpg', self.create_photo((100, 50))))
+        for name, rendition in renditions.items():
+            with Image.open(rendition) as image:
+                self.assertEqual(image.size, (100, 50), name)
+
+    def test_metadata_is_stripped_after_applying_the_orientation(self):
+        # GPS coordinates and a 90 degree rotation
+        photo = self.create_photo((3000, 1500), {0x8825: {1: 'N', 2: (51.0, 30.0, 0.0)}, 0x0112: 6})
+        for name, rendition in create_renditions(SimpleUploadedFile('selfie.jpg', photo)).items():
+            rendition.seek(0)
+            with Image.open(rendition) as image:
+                self.assertEqual(dict(image.getexif()), {}, name)
+                self.assertNotIn('exif', image.info, name)
+                self.assertEqual(image.size, {'original': (1024, 2048), 'medium': (360, 720), 'thumb': (80, 160)}[name])
+
+    def test_undecodable_upload_is_rejected(self):
+        content = self.create_photo((640, 480))
+        response = self.create_workout(content[:len(content) // 4])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(UserImageFile.objects.exists())
+        self.assertFalse(Workout.objects.exists())
+
+    def test_oversized_upload_is_rejected(self):
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            response = self.create_workout(self.create_photo((640, 480)))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(UserImageFile.objects.exists())
+        self.assertFalse(Workout.objects.exists())
+
+
+@override_settings(STORAGE_DELETE_WORKERS=2)
+class StorageGarbageCollectionTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='runner', password='password123')
+        self.storage = get_image_storage()
+
+    def create_image(self):
+        return UserImageFile.objects.create(user=self.user, url=ContentFile(b'image', name='a.png'), thumb=ContentFile(b'thumb', name='a_thumb.png'), filename='a.png')
+
+    def test_replaced_files_are_queued_without_reading_the_row(self):
+        image = UserImageFile.objects.select_related('user').get(id=self.create_image().id)
+        old_name = image.url.name
+        image.url = ContentFile(b'new image', name='b.png')
+        with self.assertNumQueries(2):
+            image.save()
+        self.assertEqual(list(StorageDeletion.objects.values_list('name', flat=True)), [old_name])
+
+        self.assertEqual(process_storage_deletions(), 1)
+        self.assertFalse(self.storage.exists(old_name))
+        self.assertTrue(self.storage.exists(image.url.name))
+        self.assertFalse(StorageDeletion.objects.exists())
+
+    def test_deleted_images_are_removed_in_one_pass(self):
+        images = [self.create_image() for _ in range(3)]
+        names = [x.name for image in images for x in image.get_files()]
+        UserImageFile.objects.filter(id__in=[x.id for x in images]).delete()
+
+        self.assertEqual(process_storage_deletions(), 6)
+        self.assertFalse(any(self.storage.exists(x) for x in names))
+
+    def test_files_are_deleted_after_the_claim_commits(self):
+        queue_file_deletions([self.create_image().url.name])
+        deleting = {}
+
+        def delete(names):
+            deleting['atomic_blocks'] = len(connection.atomic_blocks)
+            deleting['claimed'] = claim_storage_deletions(500)
+            return names
+
+        atomic_blocks = len(connection.atomic_blocks)
+        with mock.patch('api.storage.delete_stored_files', side_effect=delete):
+            self.assertEqual(process_storage_deletions(), 0)
+        # The lease keeps another worker off the row while the storage call runs
+        self.assertEqual(deleting, {'atomic_blocks': atomic_blocks, 'claimed': []})
+        deletion = StorageDeletion.objects.get()
+        self.assertEqual((deletion.attempts, deletion.last_error), (1, 'Delete failed'))
+
+        self.assertEqual(process_storage_deletions(), 1)
+        self.assertFalse(StorageDeletion.objects.exists())
+
+    def test_reconcile_removes_orphaned_files_and_rows(self):
+        image = self.create_image()
+        orphan = self.storage.save('powerup/users/runner/orphan.png', ContentFile(b'orphan'))
+        missing = self.create_image()
+        self.storage.delete(missing.url.name)
+
+        self.assertEqual(find_orphans('powerup/users', timedelta(0)), ([orphan], [missing.id]))
+        call_command('reconcile_storage', '--grace-hours=0', stdout=io.StringIO())
+        self.assertFalse(self.storage.exists(orphan))
+        self.assertEqual(list(UserImageFile.objects.values_list('id', flat=True)), [image.id])
+        self.assertTrue(self.storage.exists(image.url.name))
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, True)
+        settings_override = override_settings(METRICS_DIR=self.metrics_dir, METRICS_TOKEN='secret')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='runner', password='password123')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def scrape(self):
+        response = APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_server_timing_reports_queries_and_serialization(self):
+        response = self.client.get('/workout/data')
+        timings = {x.split(';')[0]: x for x in response['Server-Timing'].split(', ')}
+        self.assertIn('total', timings)
+        self.assertIn('serialize', timings)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/workout/data')
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+
+    def test_workout_data_posts_are_labelled_by_action(self):
+        community = Community.objects.create(name='Runners')
+        CommunityMembership.objects.create(community=community, profile=self.profile)
+        self.client.post('/workout/data', {'type': 'exitCommunity', 'communityId': community.id}, format='multipart')
+        content = self.scrape()
+        self.assertIn('powerup_request_duration_seconds_count{action="exitCommunity",method="POST",status="204",view="get_user_workout_data"}', content)
+        self.assertIn('powerup_request_db_queries_bucket{action="exitCommunity",method="POST",view="get_user_workout_data",le="+Inf"}', content)
+
+    def test_unknown_actions_share_one_label(self):
+        self.client.post('/workout/data', {'type': 'made-up-action'}, format='multipart')
+        content = self.scrape()
+        self.assertIn('powerup_request_duration_seconds_count{action="unknown",method="POST",status="400",view="get_user_workout_data"}', content)
+        self.assertNotIn('made-up-action', content)
+
+    def test_async_views_keep_the_sync_view_label(self):
+        request = RequestFactory().get('/workout/data')
+        for view in [get_user_workout_data, get_user_workout_data_async]:
+            request.resolver_match = ResolverMatch(view, (), {})
+            self.assertEqual(get_view_name(request), 'get_user_workout_data')
+
+    def test_histograms_from_other_workers_are_merged(self):
+        labels = {'view': 'get_app_data', 'action': '', 'method': 'GET', 'status': '200'}
+        with open(os.path.join(self.metrics_dir, 'metrics_1.json'), 'w') as file:
+            json.dump([['powerup_request_duration_seconds', labels, {'buckets': [1] + [0] * 11, 'sum': 0.001, 'count': 1}]], file)
+        key = ('powerup_request_duration_seconds', tuple(sorted(labels.items())))
+        self.client.get('/app/data')
+        own = registry.histograms[key]['count']
+        self.assertIn(f'powerup_request_duration_seconds_count{{action="",method="GET",status="200",view="get_app_data"}} {own + 1}', self.scrape())
+
+    def test_metrics_require_the_token(self):
+        self.assertEqual(APIClient().get('/metrics').status_code, 401)
+        self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 404)
+
+
+class WorkoutBatchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='admin', password='password123')
+        self.profile = Profile.objects.create(user=self.user)
+        self.community = Community.objects.create(name='Runners')
+        CommunityMembership.objects.create(community=self.community, profile=self.profile, role='admin')
+        self.members = [Profile.objects.create(user=User.objects.create_user(username=f"member{i}")) for i in range(3)]
+        RealtimeEvent.objects.all().delete()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def run_batch(self, actions, **options):
+        return self.client.post('/workout/batch', {'actions': actions, **options}, format='json')
+
+    def test_actions_get_their_own_results_and_merged_events(self):
+        response = self.run_batch([
+            {'type': 'addCommunityMember', 'username': 'member0', 'communityId': self.community.id},
+            {'type': 'addCommunityMember', 'username': 'nobody', 'communityId': self.community.id},
+            {'type': 'addCommunityMember', 'username': 'member1', 'communityId': self.community.id},
+            {'type': 'addCommunityAdmin', 'memberId': self.members[0].id, 'communityId': self.community.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x['status'] for x in response.data['results']], [200, 400, 200, 204])
+        self.assertEqual(set(self.community.members.values_list('id', flat=True)), {self.profile.id, self.members[0].id, self.members[1].id})
+
+        events = list(RealtimeEvent.objects.order_by('id').values_list('name', 'data'))
+        self.assertEqual([x[0] for x in events], ['community_members_update', 'community_admins_update'])
+        self.assertEqual({x['id'] for x in events[0][1]['data']}, {self.members[0].id, self.members[1].id})
+
+    def test_merged_events_stay_under_the_pusher_size_limit(self):
+        profiles = [{'id': i, 'username': f"member{i}", 'bio': 'ü' * 200} for i in range(60)]
+        events = coalesce_events([('community_1', 'community_members_update', {'data': [x], 'action': 'add'}) for x in profiles[:50]] + [
+            ('community_1', 'community_members_update', {'data': profiles[50:], 'action': 'add'}),
+        ])
+        self.assertGreater(len(events), 1)
+        self.assertTrue(all(get_event_size(data) <= settings.REALTIME_COALESCE_MAX_BYTES for _, _, data in events))
+        self.assertEqual([x for _, _, data in events for x in data['data']], profiles)
+
+    def test_atomic_batch_is_rolled_back_on_failure(self):
+        response = self.run_batch([
+            {'type': 'addCommunityMember', 'username': 'member0', 'communityId': self.community.id},
+            {'type': 'addCommunityAdmin', 'memberId': self.members[0].id, 'communityId': self.community.id},
+            {'type': 'removeCommunityAdmin', 'adminId': self.profile.id, 'communityId': self.community.id},
+            {'type': 'addCommunityAdmin', 'memberId': self.members[0].id, 'communityId': self.community.id},
+        ], atomic=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([x['status'] for x in response.data['results']], [200, 204, 204, 400])
+        self.assertFalse(self.community.members.filter(id=self.members[0].id).exists())
+        self.assertTrue(self.community.memberships.filter(profile=self.profile, role='admin').exists())
+        self.assertFalse(RealtimeEvent.objects.exists())
+
+    def test_a_community_keeps_at_least_one_admin(self):
+        response = self.run_batch([
+            {'type': 'removeCommunityAdmin', 'adminId': self.members[0].id, 'communityId': self.community.id},
+            {'type': 'exitCommunity', 'communityId': self.community.id},
+            {'type': 'removeCommunityAdmin', 'adminId': self.profile.id, 'communityId': self.community.id},
+            {'type': 'addCommunityMember', 'username': 'member0', 'communityId': self.community.id},
+            {'type': 'removeCommunityAdmin', 'adminId': self.members[0].id, 'communityId': self.community.id},
+            {'type': 'addCommunityAdmin', 'memberId': self.members[0].id, 'communityId': self.community.id},
+            {'type': 'exitCommunity', 'communityId': self.community.id},
+        ])
+        self.assertEqual([x['status'] for x in response.data['results']], [400, 400, 400, 200, 400, 204, 204])
+        self.assertEqual(response.data['results'][0]['data']['message'], 'The person you selected is not a member of the community')
+        self.assertEqual(list(self.community.memberships.values_list('profile_id', 'role')), [(self.members[0].id, 'admin')])
+
+    def test_profile_and_roles_are_looked_up_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.run_batch([{'type': 'addCommunityMember', 'username': x.user.username, 'communityId': self.community.id} for x in self.members])
+        lookups = [x['sql'] for x in queries.captured_queries if '"api_communitymembership"."role" FROM' in x['sql']]
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(len([x for x in queries.captured_queries if '"api_profile"."user_id" = %s' % self.user.id in x['sql']]), 1)
+
+
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_UPLOAD_MODE='sync')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        cache.clear()
+        self.today = timezone.now().date()
+        self.workout_type = WorkoutType.objects.create(name='Run')
+        self.community = Community.objects.create(name='Runners')
+        self.challenge = Challenge.objects.create(name='Challenge', community=self.community, end_date=self.today + timedelta(days=7))
+        self.challenge.workout_types.set([self.workout_type])
+
+    def add_participants(self, points):
+        participants = []
+        for value in points:
+            profile = Profile.objects.create(user=User.objects.create_user(username=f"runner{len(participants)}"))
+            participants.append(ChallengeParticipant.objects.create(profile=profile, challenge=self.challenge, username=profile.user.username, points=value, date_joined=self.today))
+        rebuild_leaderboard(self.challenge.id)
+        return participants
+
+    def move(self, participant, points):
+        participant.refresh_from_db()
+        old_points, participant.points = participant.points, points
+        move_on_leaderboard(participant, old_points)
+        participant.save()
+
+    def get_ranks(self, participants):
+        return [ChallengeParticipant.objects.get(id=x.id).rank for x in participants]
+
+    def test_fractional_points_keep_ties(self):
+        first, second, third = self.add_participants([0.1, 0.1, 0])
+        output = io.BytesIO()
+        Image.new('RGB', (32, 32), 'red').save(output, format='PNG')
+        client = APIClient()
+        client.force_authenticate(first.profile.user)
+        response = client.post('/workout/data', {
+            'type': 'createWorkout',
+            'selfie': SimpleUploadedFile('selfie.png', output.getvalue()),
+            'workoutType': self.workout_type.id,
+            'pointsEarned': 0.2,
+            'caloriesBurned': 50,
+            'duration': 20,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ChallengeParticipant.objects.get(id=first.id).points, 0.1 + 0.2)
+        self.assertEqual(self.get_ranks([first, second, third]), [1, 2, 3])
+        self.assertEqual(rebuild_leaderboard(self.challenge.id), 0)
+
+    def test_move_updates_only_the_rows_it_passes(self):
+        participants = self.add_participants([10, 8, 6, 4, 2])
+        RealtimeEvent.objects.all().delete()
+        ChangeLog.objects.all().delete()
+        with CaptureQueriesContext(connection) as queries:
+            self.move(participants[3], 9)
+        self.assertEqual(self.get_ranks(participants), [1, 3, 4, 2, 5])
+        self.assertEqual(len([x for x in queries.captured_queries if x['sql'].startswith('UPDATE "api_challengeparticipant" SET "rank"')]), 1)
+
+        # Only the moved participant is logged, by its own save
+        self.assertEqual(set(ChangeLog.objects.values_list('entity_id', flat=True)), {participants[3].id})
+        event = RealtimeEvent.objects.get(name='challenge_ranks_update')
+        self.assertEqual(event.data, {'challenge_id': self.challenge.id, 'shifts': [[2, 3, 1]]})
+
+    def test_rank_shifts_are_one_range_per_band(self):
+        participants = self.add_participants([10, 8, 6, 4, 2])
+        RealtimeEvent.objects.all().delete()
+        self.move(participants[1], 5)
+        self.assertEqual(self.get_ranks(participants), [1, 3, 2, 4, 5])
+        self.assertEqual(RealtimeEvent.objects.get(name='challenge_ranks_update').data['shifts'], [[3, 3, -1]])
+
+        # A score that disappears into a tie moves both the passed band and everyone below it
+        RealtimeEvent.objects.all().delete()
+        self.move(participants[0], 5)
+        self.assertEqual(self.get_ranks(participants), [2, 2, 1, 3, 4])
+        self.assertEqual(RealtimeEvent.objects.get(name='challenge_ranks_update').data['shifts'], [[2, 3, -1], [4, 5, -1]])
+
+    def test_seeding_leaves_existing_challenges_alone(self):
+        participant = self.add_participants([5])[0]
+        ChallengeParticipant.objects.filter(id=participant.id).update(points=99)
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        with override_settings(MEDIA_ROOT=media_root):
+            call_command('seed_powerup', '--preset', 'tiny', '--factor', '0.1', '--history-days', '30', stdout=io.StringIO())
+        self.assertEqual(ChallengeParticipant.objects.get(id=participant.id).points, 99)
+        seeded = ChallengeParticipant.objects.exclude(challenge=self.challenge)
+        self.assertTrue(seeded.exists())
+        self.assertEqual(sum(rebuild_leaderboard(x) for x in seeded.values_list('challenge_id', flat=True).distinct()), 0)
+
+    def test_moves_keep_dense_ranks(self):
+        participants = self.add_participants([5, 5, 3, 3, 1, 0])
+        for index, points in [(0, 7), (2, 5), (4, 3), (1, 0), (3, 5), (5, 9), (2, 2), (0, 2), (4, 4)]:
+            self.move(participants[index], points)
+            self.assertEqual(rebuild_leaderboard(self.challenge.id), 0, (index, points))
+
+
+class CatalogueTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_UPLOAD_MODE='sync')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='runner', password='password123')
+        Profile.objects.create(user=self.user)
+        self.workout_type = WorkoutType.objects.create(name='Running')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_workout(self, workout_type):
+        output = io.BytesIO()
+        Image.new('RGB', (64, 64), 'red').save(output, format='PNG')
+        return self.client.post('/workout/data', {
+            'type': 'createWorkout',
+            'selfie': SimpleUploadedFile('selfie.png', output.getvalue(), content_type='image/png'),
+            'workoutType': workout_type.id, 'pointsEarned': 10, 'caloriesBurned': 50, 'duration': 20,
+        }, format='multipart')
+
+    def test_matching_etag_is_answered_with_not_modified(self):
+        response = self.client.get('/app/data')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual([x['name'] for x in json.loads(response.content)['workout_types']], ['Running'])
+
+        for header in [etag, f'W/{etag}', f'"other", {etag}']:
+            response = self.client.get('/app/data', HTTP_IF_NONE_MATCH=header)
+            self.assertEqual((response.status_code, response.content, response['ETag']), (304, b'', etag))
+        self.assertEqual(self.client.get('/app/data', HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_editing_a_workout_type_bumps_the_version(self):
+        etag = self.client.get('/app/data')['ETag']
+        version = get_workout_type_catalogue()['version']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.workout_type.name = 'Trail running'
+            self.workout_type.save()
+        self.assertNotEqual(get_workout_type_catalogue()['version'], version)
+        response = self.client.get('/app/data', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([x['name'] for x in json.loads(response.content)['workout_types']], ['Trail running'])
+
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            WorkoutType.objects.create(name='Cycling')
+        response = self.client.get('/app/data', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([x['name'] for x in json.loads(response.content)['workout_types']], ['Cycling', 'Trail running'])
+
+    def test_workouts_are_created_with_the_cached_types(self):
+        get_workout_type_catalogue()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.create_workout(self.workout_type).status_code, 200)
+        self.assertFalse([x['sql'] for x in queries if WorkoutType._meta.db_table in x['sql'].split(' WHERE ')[0]])
+
+        # A type added since the catalogue was cached is found after the version bump
+        with self.captureOnCommitCallbacks(execute=True):
+            cycling = WorkoutType.objects.create(name='Cycling')
+        response = self.create_workout(cycling)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Workout.objects.get(id=response.data['id']).workout_type, cycling)
+
+
+class RendererTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='admin', password='password123')
+        self.profile = Profile.objects.create(user=self.user)
+        self.community = Community.objects.create(name='Runners')
+        CommunityMembership.objects.create(community=self.community, profile=self.profile, role='admin')
+        Profile.objects.create(user=User.objects.create_user(username='member0'))
+        Workout.objects.create(profile=self.profile, workout_type=WorkoutType.objects.create(name='Run'), duration=20, points=10.5)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_json_matches_drf_output(self):
+        data = ReturnDict({
+            'date': timezone.now().date(),
+            'time': datetime(2024, 5, 1, 8, 30, 15, tzinfo=dt_timezone.utc),
+            'amount': Decimal('1.50'),
+            'label': gettext_lazy('Name'),
+            'text': 'line\u2028break ü',
+            'ids': Profile.objects.values_list('id', flat=True),
+            'nested': [{1: None}],
+        }, serializer=None)
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render({'time': datetime(2024, 5, 1, 8, 30, 15, 123456, tzinfo=dt_timezone.utc)}), b'{"time":"2024-05-01T08:30:15.123456Z"}')
+
+    def test_msgpack_is_negotiated_from_accept(self):
+        json_response = self.client.get('/workout/data')
+        response = self.client.get('/workout/data', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertIn('Accept', response['Vary'])
+        self.assertEqual(msgpack.unpackb(response.content), json.loads(json_response.content))
+
+    def test_msgpack_request_body_is_parsed(self):
+        body = msgpack.packb({'actions': [{'type': 'addCommunityMember', 'username': 'member0', 'communityId': self.community.id}]})
+        response = self.client.post('/workout/batch', body, content_type='application/msgpack', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x['status'] for x in msgpack.unpackb(response.content)['results']], [200])
+        self.assertEqual(self.client.post('/workout/batch', b'\xc1', content_type='application/msgpack').status_code, 400)
+
+
+class NormalizedShapeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, SYNC_SETTLE_SECONDS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        today = timezone.now().date()
+        self.workout_type = WorkoutType.objects.create(name='Run')
+        self.profiles = []
+        for i in range(4):
+            user = User.objects.create_user(username=f"member{i}")
+            img = UserImageFile.objects.create(user=user, url=ContentFile(b'image', name='a.png'), filename='a.png')
+            self.profiles.append(Profile.objects.create(user=user, img=img))
+        self.user = self.profiles[0].user
+        self.communities = [Community.objects.create(name=f"Runners {i}") for i in range(2)]
+        for community in self.communities:
+            for i, profile in enumerate(self.profiles):
+                CommunityMembership.objects.create(community=community, profile=profile, role='admin' if i < 2 else 'member')
+        self.challenge = Challenge.objects.create(name='Challenge', community=self.communities[0], end_date=today + timedelta(days=7))
+        self.challenge.workout_types.set([self.workout_type])
+        for rank, profile in enumerate(self.profiles, 1):
+            ChallengeParticipant.objects.create(profile=profile, challenge=self.challenge, username=profile.user.username, rank=rank, date_joined=today)
+        Workout.objects.create(profile=self.profiles[0], workout_type=self.workout_type, img=self.profiles[0].img, date=today)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {UserAuthSerializer.get_token(self.user).access_token}")
+
+    def assertReferencesResolve(self, data):
+        entities = data['entities']
+        for profile in entities['profiles'].values():
+            if 'img' in profile:
+                self.assertIn(str(profile['img']), entities['images'])
+        return entities
+
+    def test_participants_who_left_the_community_only_get_a_username(self):
+        former = self.profiles[3]
+        CommunityMembership.objects.filter(community=self.communities[0], profile=former).delete()
+        data = self.client.get(f"/community/{self.communities[0].id}", {'shape': 'normalized'}).json()
+        profiles = self.assertReferencesResolve(data)['profiles']
+        self.assertIn(former.id, [x['profile'] for x in data['challenges'][0]['participants']])
+        self.assertEqual(profiles[str(former.id)], {'id': former.id, 'username': 'member3'})
+        self.assertEqual(profiles[str(self.profiles[2].id)]['email'], '')
+
+    def test_community_references_each_profile_once(self):
+        data = self.client.get(f"/community/{self.communities[0].id}", {'shape': 'normalized', 'page_size': 1}).json()
+        entities = self.assertReferencesResolve(data)
+        participants = data['challenges'][0]['participants']
+        self.assertEqual([x['profile'] for x in participants], [x.id for x in self.profiles])
+        self.assertEqual(set(entities['profiles']), {str(x.id) for x in self.profiles})
+        self.assertEqual(data['admins'], [self.profiles[0].id, self.profiles[1].id])
+        self.assertEqual(data['members'], [self.profiles[0].id])
+        self.assertEqual(list(entities['workout_types']), [str(self.workout_type.id)])
+        self.assertEqual(entities['profiles'][str(self.profiles[2].id)]['username'], 'member2')
+
+    def test_workout_data_references_workout_types_and_images(self):
+        default = self.client.get('/workout/data', {'shape': 'summary'}).json()
+        data = self.client.get('/workout/data', {'shape': 'normalized'}).json()
+        entities = self.assertReferencesResolve(data)
+        workout = data['workouts'][0]
+        self.assertEqual(entities['workout_types'][str(workout['workout_type'])]['name'], default['workouts'][0]['workout_type'])
+        self.assertEqual(entities['images'][str(workout['img'])]['medium'], default['workouts'][0]['img']['url'])
+        self.assertEqual([x['role'] for x in data['communities']], [x['role'] for x in default['communities']])
+        self.assertEqual(data['default_images']['community'], default['communities'][0]['img'])
+        self.assertNotIn('entities', default)
+
+    @override_settings(WORKOUT_PAGE_SIZE=1)
+    def test_workout_data_keeps_the_full_shape_by_default(self):
+        Workout.objects.create(profile=self.profiles[0], workout_type=self.workout_type, date=timezone.now().date())
+        data = self.client.get('/workout/data').json()
+        self.assertEqual(len(data['workouts']), 2)
+        community = next(x for x in data['communities'] if x['id'] == self.communities[0].id)
+        self.assertEqual(community, json.loads(ORJSONRenderer().render(get_communities_data(Community.objects.filter(id=self.communities[0].id))[0])))
+        self.assertEqual({x['username'] for x in community['admins']}, {'member0', 'member1'})
+        self.assertEqual(len(community['members']), 4)
+        self.assertEqual([len(x['participants']) for x in community['challenges']], [4])
+
+    def test_sync_changes_reference_profiles(self):
+        since = self.client.get('/workout/data').json()['sync_token']
+        user = User.objects.create_user(username='newcomer')
+        newcomer = Profile.objects.create(user=user)
+        for community in self.communities:
+            CommunityMembership.objects.create(community=community, profile=newcomer, role='admin')
+        ChallengeParticipant.objects.create(profile=newcomer, challenge=self.challenge, username='newcomer', rank=5, date_joined=timezone.now().date())
+
+        data = self.client.get('/workout/data', {'since': since, 'shape': 'normalized'}).json()
+        self.assertFalse(data['reset'])
+        self.assertEqual(sorted(x['community'] for x in data['community_members']['updated'] if x['id'] == newcomer.id), sorted(x.id for x in self.communities))
+        self.assertEqual(sorted(x['community'] for x in data['community_admins']['updated'] if x['id'] == newcomer.id), sorted(x.id for x in self.communities))
+        self.assertEqual([x['profile'] for x in data['challenge_participants']['updated']], [newcomer.id])
+        self.assertEqual(list(data['entities']['profiles']), [str(newcomer.id)])
+        self.assertIsNone(data['entities']['profiles'][str(newcomer.id)]['img'])
+
+
+@override_settings(AUTH_TRUST_TOKEN_CLAIMS=True)
+class ProfileAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='runner', password='password123')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client = APIClient()
+
+    def test_login_token_carries_profile_claims(self):
+        response = self.client.post('/login', {'username': 'runner', 'password': 'password123'})
+        token = AccessToken(response.data['access'])
+        self.assertEqual((token['profile_id'], token['username']), (self.profile.id, 'runner'))
+
+        refreshed = self.client.post('/api/token/refresh/')
+        self.assertEqual(AccessToken(refreshed.data['access'])['profile_id'], self.profile.id)
+
+    def test_requests_skip_user_and_profile_lookups(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {UserAuthSerializer.get_token(self.user).access_token}")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/workout/history')
+        self.assertEqual(response.status_code, 200)
+        tables = ' '.join(x['sql'] for x in queries.captured_queries)
+        self.assertNotIn('FROM "auth_user"', tables)
+        self.assertNotIn('FROM "api_profile"', tables)
+
+        response = self.client.get('/user/data')
+        self.assertEqual((response.data['username'], response.data['email']), ('runner', ''))
+
+    def test_deactivated_and_deleted_users_lose_access(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {UserAuthSerializer.get_token(self.user).access_token}")
+        self.assertEqual(self.client.get('/workout/history').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/workout/history').status_code, 401)
+
+        other = User.objects.create_user(username='walker', password='password123')
+        Profile.objects.create(user=other)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {UserAuthSerializer.get_token(other).access_token}")
+        other.delete()
+        self.assertEqual(self.client.get('/workout/history').status_code, 401)
+
+    @override_settings(AUTH_TRUST_TOKEN_CLAIMS=False)
+    def test_users_are_looked_up_without_a_shared_cache(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {UserAuthSerializer.get_token(self.user).access_token}")
+        self.assertEqual(self.client.get('/workout/history').status_code, 200)
+        # Sends no signal, so nothing is revoked in the cache
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        self.assertEqual(self.client.get('/workout/history').status_code, 401)
+
+    def test_tokens_without_profile_claims_still_work(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {RefreshToken.for_user(self.user).access_token}")
+        self.assertEqual(self.client.get('/workout/history').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/workout/history').status_code, 401)
+
+
+class TokenBlacklistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='runner', password='password123')
+        Profile.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.post('/login', {'username': 'runner', 'password': 'password123'})
+
+    def test_rotated_tokens_are_rejected_from_the_cache(self):
+        old_token = self.client.cookies['refresh_token'].value
+        self.assertEqual(self.client.post('/api/token/refresh/').status_code, 200)
+        replay = APIClient()
+        replay.cookies['refresh_token'] = old_token
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(replay.post('/api/token/refresh/').status_code, 401)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(self.client.post('/api/token/refresh/').status_code, 200)
+
+    @override_settings(AUTH_BLACKLIST_MISS_SECONDS=300)
+    def test_misses_are_cached_until_the_token_is_blacklisted(self):
+        token = CachedRefreshToken(self.client.cookies['refresh_token'].value)
+        jti, exp = token['jti'], token['exp']
+        self.assertFalse(is_blacklisted(jti, exp))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(is_blacklisted(jti, exp))
+        self.assertEqual(len(queries), 0)
+        token.blacklist()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(is_blacklisted(jti, exp))
+        self.assertEqual(len(queries), 0)
+
+    def test_misses_are_not_cached_without_a_shared_cache(self):
+        token = CachedRefreshToken(self.client.cookies['refresh_token'].value)
+        self.assertFalse(is_blacklisted(token['jti'], token['exp']))
+        BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=token['jti']))
+        self.assertTrue(is_blacklisted(token['jti'], token['exp']))
+
+    def test_prune_removes_only_expired_tokens(self):
+        self.client.post('/api/token/refresh/')
+        self.client.post('/api/token/refresh/')
+        self.client.post('/api/token/refresh/')
+        self.assertEqual((OutstandingToken.objects.count(), BlacklistedToken.objects.count()), (3, 3))
+        OutstandingToken.objects.filter(id__in=OutstandingToken.objects.order_by('id').values('id')[:2]).update(expires_at=timezone.now() - timedelta(seconds=1))
+        output = io.StringIO()
+        call_command('prune_tokens', '--chunk-size', '1', stdout=output)
+        self.assertEqual(output.getvalue().strip(), 'Deleted 2 outstanding and 2 blacklisted tokens')
+        self.assertEqual((OutstandingToken.objects.count(), BlacklistedToken.objects.count()), (1, 1))
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_UPLOAD_MODE='sync')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        environ = mock.patch.dict(os.environ, {'EMAIL_HOST_USER': 'team@example.com', 'EMAIL_SENDER_NAME': 'PowerUp'})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.factory = APIRequestFactory()
+
+    def create_image(self, name='image.png'):
+        output = io.BytesIO()
+        Image.new('RGB', (64, 64), 'red').save(output, format='PNG')
+        return SimpleUploadedFile(name, output.getvalue(), content_type='image/png')
+
+    def call(self, view, method, path, data=None, user=None):
+        request = getattr(self.factory, method)(path, data, format='multipart' if method == 'post' else None)
+        if user:
+            force_authenticate(request, user)
+        response = async_to_sync(view)(request)
+        response.render()
+        return response
+
+    def register(self, **fields):
+        return self.call(register_user_async, 'post', '/register', {'userImage': self.create_image(), 'dataObj': json.dumps({
+            'email': 'runner@example.com', 'username': 'runner', 'password': 'password123', 'age': 30, 'gender': 'other', 'country': 'Ghana', 'city': 'Accra', **fields,
+        })})
+
+    def test_register_uploads_the_image_and_sends_the_email(self):
+        response = self.register()
+        self.assertEqual(response.status_code, 201)
+        profile = Profile.objects.select_related('user', 'img').get(user__username='runner')
+        self.assertTrue(os.path.exists(profile.img.url.path))
+        self.assertEqual(mail.outbox[0].to, ['runner@example.com'])
+        self.assertEqual(self.register(username='other').data['message'], 'A user with that email address already exists. Please login if you already have an account.')
+
+    def test_register_is_undone_when_the_email_fails(self):
+        with mock.patch('api.views.send_welcome_email', side_effect=OSError):
+            response = self.register()
+        self.assertEqual(response.data['message'], 'A network error occurred. Please check your internet connection and try again.')
+        self.assertFalse(User.objects.filter(username='runner').exists())
+        self.assertFalse(any(files for _, _, files in os.walk(self.media_root)))
+
+    def test_workout_data_actions(self):
+        user = User.objects.create_user(username='runner')
+        Profile.objects.create(user=user)
+        workout_type = WorkoutType.objects.create(name='Running')
+        response = self.call(get_user_workout_data_async, 'post', '/workout/data', {
+            'type': 'createWorkout', 'selfie': self.create_image('selfie.png'), 'workoutType': workout_type.id, 'pointsEarned': 10, 'caloriesBurned': 50, 'duration': 20,
+        }, user)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertTrue(Workout.objects.filter(id=response.data['id'], img__isnull=False).exists())
+        self.assertEqual([x['id'] for x in self.call(get_user_workout_data_async, 'get', '/workout/data', user=user).data['workouts']], [response.data['id']])
+
+        # The image is uploaded before the action rejects the request, so it is removed again
+        response = self.call(get_user_workout_data_async, 'post', '/workout/data', {
+            'type': 'createCommunity', 'communityImage': self.create_image(), 'communityImageId': 999, 'dataObj': json.dumps({'name': 'Runners', 'description': ''}),
+        }, user)
+        self.assertEqual(response.data['message'], 'Invalid image')
+        self.assertEqual(UserImageFile.objects.count(), 1)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(self.media_root)), 3)
+
+    def test_static_files_are_served_before_django(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root, True)
+        with open(os.path.join(static_root, 'app.css'), 'w') as file:
+            file.write('body {}')
+        django_paths = []
+
+        async def django_application(scope, receive, send):
+            django_paths.append(scope['path'])
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def get(application, path):
+            communicator = ApplicationCommunicator(application, {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [], 'server': ('testserver', 80)})
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            start = await communicator.receive_output()
+            body = await communicator.receive_output()
+            return start['status'], body['body']
+
+        with override_settings(STATIC_ROOT=static_root):
+            application = serve_static_first(django_application, get_static_application())
+            self.assertEqual(async_to_sync(get)(application, '/static/app.css'), (200, b'body {}'))
+            self.assertEqual(async_to_sync(get)(application, '/app/data')[0], 204)
+        self.assertEqual(django_paths, ['/app/data'])
+
+
+class ProjectionTests(TestCase):
+    """
+    The values() projections must render exactly what the serializers render.
+    """
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        today = timezone.now().date()
+        workout_types = WorkoutType.objects.bulk_create([WorkoutType(name=f"Type {i}") for i in range(3)])
+        self.profiles = []
+        for i, img in enumerate(['ready', 'pending', 'no thumb', None]):
+            user = User.objects.create_user(username=f"member {i}", email=f"member{i}@example.com")
+            self.profiles.append(Profile.objects.create(user=user, img=self.create_image(user, img), bio='Runs', age=30 + i, height=1.8, weight=70.5))
+        for community_img in ['ready', None]:
+            community = Community.objects.create(name='Runners', description='Early mornings', img=self.create_image(self.profiles[0].user, community_img))
+            for i, profile in enumerate(self.profiles):
+                CommunityMembership.objects.create(community=community, profile=profile, role='admin' if i % 2 else 'member')
+            for end in [3, 10]:
+                challenge = Challenge.objects.create(name='Challenge', description='Most points', community=community, end_date=today + timedelta(days=end))
+                challenge.workout_types.set(workout_types[:end // 3])
+                for rank, profile in enumerate(self.profiles[:end // 3 + 1], 1):
+                    ChallengeParticipant.objects.create(profile=profile, challenge=challenge, username=profile.user.username, points=rank * 2.5, rank=rank, date_joined=today)
+        Challenge.objects.create(name='Empty', community=community, end_date=today)
+        for img in ['ready', 'pending', 'no thumb', None]:
+            Workout.objects.create(profile=self.profiles[0], workout_type=workout_types[0], img=self.create_image(self.profiles[0].user, img), duration=20, calories_burned=50.5, points=10, date=today)
+
+    def create_image(self, user, kind):
+        if kind is None:
+            return None
+        return UserImageFile.objects.create(
+            user=user, url=ContentFile(b'image', name='a b.png'), thumb=None if kind == 'no thumb' else ContentFile(b'thumb', name='a_thumb.png'),
+            filename='a b.png', status='pending' if kind == 'pending' else 'ready')
+
+    def assertSameJSON(self, first, second):
+        self.assertEqual(JSONRenderer().render(first), JSONRenderer().render(second))
+
+    def test_communities(self):
+        self.assertSameJSON(get_communities_data(Community.objects.all()), CommunitySerializerOne(get_community_queryset(), many=True).data)
+
+    def test_workouts(self):
+        workouts = Workout.objects.order_by('-id')
+        self.assertSameJSON(get_workouts_data(get_workout_values(workouts)), WorkoutSerializerOne(workouts.select_related('img', 'workout_type'), many=True).data)
+
+    def test_challenges(self):
+        challenges = get_challenge_queryset()
+        self.assertSameJSON(get_challenges_data(get_challenge_values(challenges)), [{**ChallengeSerializerOne(x).data, 'community': x.community_id} for x in challenges])
+        self.assertSameJSON(get_challenge_rows(get_challenge_values(challenges)), [get_challenge_data(x) for x in challenges])
+
+    def test_members(self):
+        profiles = Profile.objects.order_by('id')
+        self.assertSameJSON(get_members_data(get_member_values(profiles)), [get_member_data(x) for x in profiles.select_related('user', 'img')])
+        self.assertSameJSON(get_members_data(get_member_values(profiles)), ProfileSerializerOne(profiles.select_related('user', 'img'), many=True).data)
+
+    def test_cloudinary_urls_match_the_storage(self):
+        config = cloudinary.config()
+        names = ['media/powerup/users/runner/a_thumb.webp', 'powerup/users/runner/a b.png', 'powerup/users/runner/a%20b.png', 'v12/a.png', 'a.png', 'powerup/../a.png', 'powerup/a?.png']
+        for options in [{}, {'secure': True}, {'cdn_subdomain': True}]:
+            with mock.patch.multiple(config, create=True, cloud_name='demo', **options):
+                storage = MediaCloudinaryStorage()
+                with mock.patch.multiple(UserImageFile._meta.get_field('url'), storage=storage):
+                    urls = ImageURLs()
+                self.assertEqual('url' in urls.cloudinary_prefixes, not options.get('cdn_subdomain'), options)
+                self.assertEqual([urls.get_file_url('url', x) for x in names], [storage.url(x) for x in names], options)
+
+
+class QueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        today = timezone.now().date()
+        cls.today = today
+        cls.workout_types = WorkoutType.objects.bulk_create([WorkoutType(name=f"Type {i}") for i in range(5)])
+        users = User.objects.bulk_create([User(username=f"user{i}") for i in range(20)])
+        cls.profiles = Profile.objects.bulk_create([Profile(user=x) for x in users])
+        cls.community = Community.objects.create(name='Runners')
+        communities = [cls.community, *Community.objects.bulk_create([Community(name=f"Community {i}") for i in range(19)])]
+        CommunityMembership.objects.bulk_create([
+            CommunityMembership(community=community, profile=profile, role='admin' if i < 2 else 'member')
+            for community in communities for i, profile in enumerate(cls.profiles)
+        ])
+        Workout.objects.bulk_create([
+            Workout(profile=profile, workout_type=cls.workout_types[i % 5], date=today - timedelta(days=i % 60))
+            for profile in cls.profiles for i in range(50)
+        ])
+        challenges = Challenge.objects.bulk_create([
+            Challenge(name=f"Challenge {i}", community=cls.community, end_date=today - timedelta(days=i - 3)) for i in range(100)
+        ])
+        for i, challenge in enumerate(challenges):
+            challenge.workout_types.add(cls.workout_types[i % 5])
+        ChallengeParticipant.objects.bulk_create([
+            ChallengeParticipant(profile=profile, challenge=challenge, date_joined=today)
+            for profile in cls.profiles for challenge in challenges[::5]
+        ])
+
+    def get_plan(self, queryset):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            if connection.vendor == 'postgresql':
+                # Seeded tables are small enough that a sequential scan would win
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def assertUsesIndex(self, queryset, tables, index=None):
+        plan = self.get_plan(queryset)
+        if index:
+            self.assertIn(index, plan)
+        for table in tables:
+            self.assertNotRegex(plan, rf"SCAN {table}(\s|$)")
+            self.assertNotIn('Seq Scan on ' + table, plan)
+        return plan
+
+    def test_workout_history_uses_index_order(self):
+        plan = self.assertUsesIndex(Workout.objects.filter(profile=self.profiles[0]).order_by('-date', '-id')[:51], ['api_workout'], 'workout_history_idx')
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_active_challenges_for_workout_type_use_index(self):
+        challenges = Challenge.objects.filter(workout_types=self.workout_types[0], start_date__lte=self.today, end_date__gte=self.today)
+        # Either the date range or the workout type join may lead, but neither table is scanned
+        self.assertUsesIndex(challenges, ['api_challenge', 'api_challenge_workout_types'])
+        participants = ChallengeParticipant.objects.filter(challenge__in=challenges, profile=self.profiles[0])
+        # SQLite names the index behind a unique constraint itself, so only the scan is checked
+        self.assertUsesIndex(participants, ['api_challengeparticipant'])
+        self.assertUsesIndex(Challenge.objects.filter(start_date__lte=self.today, end_date__gte=self.today), ['api_challenge'], 'challenge_active_idx')
+
+    def test_join_code_lookup_uses_index(self):
+        self.assertUsesIndex(Community.objects.filter(join_code=self.community.join_code), ['api_community'], 'community_join_code_unique')
+
+    def test_role_lookups_use_membership_indexes(self):
+        # The unique constraint answers the caller's role in a single lookup
+        self.assertUsesIndex(CommunityMembership.objects.filter(community=self.community, profile=self.profiles[0]).values('role'), ['api_communitymembership'])
+        self.assertUsesIndex(CommunityMembership.objects.filter(community=self.community, role='admin'), ['api_communitymembership'], 'membership_role_idx')
+        self.assertUsesIndex(CommunityMembership.objects.filter(profile=self.profiles[0], role='admin'), ['api_communitymembership'], 'membership_profile_idx')
+
+    def test_unordered_queries_are_not_sorted(self):
+        self.assertNotIn('ORDER BY', str(Workout.objects.filter(profile=self.profiles[0]).query))
+        self.assertNotIn('ORDER BY', str(Profile.objects.filter(communities=self.community).query))
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Every endpoint is measured twice, with more rows seeded in between. The
+    query count must not change between runs and must stay within budget.
+    """
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        # Measured as deployed, with the shared cache that lets tokens skip the user lookup
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_UPLOAD_MODE='sync', SYNC_SETTLE_SECONDS=0, AUTH_TRUST_TOKEN_CLAIMS=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.today = timezone.now().date()
+        self.scale = 0
+        self.workout_types = WorkoutType.objects.bulk_create([WorkoutType(name=f"Type {i}") for i in range(3)])
+        # Measured warm, as it is between catalogue changes
+        get_workout_type_catalogue()
+        self.user = User.objects.create_user(username='runner', password='password123')
+        self.profile = Profile.objects.create(user=self.user, img=self.create_image(self.user))
+        self.community = self.create_community(admin=self.profile)
+        # The challenges the user takes part in stay fixed; only the rows around them grow
+        self.challenges = [self.create_challenge(self.community) for _ in range(2)]
+        for challenge in self.challenges:
+            self.join(self.profile, challenge)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {UserAuthSerializer.get_token(self.user).access_token}")
+        self.grow()
+
+    def create_image(self, user):
+        return UserImageFile.objects.create(user=user, url=ContentFile(b'image', name='a.png'), thumb=ContentFile(b'thumb', name='a_thumb.png'), filename='a.png')
+
+    def create_profile(self):
+        user = User.objects.create_user(username=f"member{User.objects.count()}")
+        return Profile.objects.create(user=user, img=self.create_image(user))
+
+    def create_community(self, admin, members=()):
+        community = Community.objects.create(name='Runners', img=self.create_image(admin.user))
+        CommunityMembership.objects.create(community=community, profile=admin, role='admin')
+        for member in members:
+            CommunityMembership.objects.create(community=community, profile=member)
+        return community
+
+    def create_challenge(self, community, participants=()):
+        challenge = Challenge.objects.create(name='Challenge', community=community, end_date=self.today + timedelta(days=7))
+        challenge.workout_types.set(self.workout_types)
+        for profile in participants:
+            self.join(profile, challenge)
+        return challenge
+
+    def join(self, profile, challenge):
+        return ChallengeParticipant.objects.create(profile=profile, challenge=challenge, username=profile.user.username, date_joined=self.today)
+
+    def grow(self):
+        self.scale += 3
+        profiles = [self.create_profile() for _ in range(self.scale)]
+        for i, profile in enumerate(profiles):
+            CommunityMembership.objects.create(community=self.community, profile=profile, role='admin' if i == 0 else 'member')
+        for challenge in self.challenges:
+            for profile in profiles:
+                self.join(profile, challenge)
+        self.create_challenge(self.community, profiles)
+        Workout.objects.bulk_create([Workout(profile=self.profile, workout_type=self.workout_types[0], img=self.create_image(self.user), date=self.today) for _ in range(self.scale)])
+
+    def post(self, data, client=None):
+        return (client or self.client).post('/workout/data', data, format='multipart')
+
+    def assertQueryBudget(self, budget, prepare):
+        counts, sql = [], []
+        for _ in range(2):
+            request = prepare()
+            with CaptureQueriesContext(connection) as queries:
+                response = request()
+            self.assertLess(response.status_code, 300, getattr(response, 'data', None))
+            counts.append(len(queries))
+            sql.append('\n'.join(x['sql'] for x in queries.captured_queries))
+            self.grow()
+        self.assertEqual(counts[0], counts[1], f"Query count grows with the number of rows:\n{sql[1]}")
+        self.assertLessEqual(counts[0], budget, sql[0])
+
+    def test_workout_data(self):
+        self.assertQueryBudget(3, lambda: lambda: self.client.get('/workout/data', {'shape': 'summary'}))
+
+    def test_workout_data_full(self):
+        self.assertQueryBudget(7, lambda: lambda: self.client.get('/workout/data'))
+
+    def test_workout_data_sync(self):
+        def prepare():
+            since = get_sync_token()
+            Workout.objects.create(profile=self.profile, workout_type=self.workout_types[0], date=self.today)
+            self.create_challenge(self.community, [self.profile])
+            CommunityMembership.objects.create(community=self.community, profile=self.create_profile())
+            return lambda: self.client.get('/workout/data', {'since': since})
+        self.assertQueryBudget(10, prepare)
+
+    def test_workout_data_normalized(self):
+        self.assertQueryBudget(3, lambda: lambda: self.client.get('/workout/data', {'shape': 'normalized'}))
+
+    def test_workout_data_sync_normalized(self):
+        def prepare():
+            since = get_sync_token()
+            Workout.objects.create(profile=self.profile, workout_type=self.workout_types[0], date=self.today)
+            self.create_challenge(self.community, [self.profile])
+            CommunityMembership.objects.create(community=self.community, profile=self.create_profile())
+            return lambda: self.client.get('/workout/data', {'since': since, 'shape': 'normalized'})
+        # One more than the nested shape, for the participants' profiles
+        self.assertQueryBudget(11, prepare)
+
+    def test_community_data(self):
+        self.assertQueryBudget(6, lambda: lambda: self.client.get(f"/community/{self.community.id}"))
+
+    def test_community_data_normalized(self):
+        # Participants outside the members page are loaded together, in one query
+        self.assertQueryBudget(7, lambda: lambda: self.client.get(f"/community/{self.community.id}", {'shape': 'normalized', 'page_size': 2}))
+
+    def test_create_workout(self):
+        def request():
+            output = io.BytesIO()
+            Image.new('RGB', (32, 32), 'red').save(output, format='PNG')
+            return self.post({
+                'type': 'createWorkout',
+                'selfie': SimpleUploadedFile('selfie.png', output.getvalue()),
+                'workoutType': self.workout_types[0].id,
+                'pointsEarned': 10,
+                'caloriesBurned': 50,
+                'duration': 20,
+            })
+        # A first workout settles the leaderboard and the workout type cache, so
+        # both measured runs take the same path
+        self.assertQueryBudget(22, lambda: (request(), request)[1])
+
+    def test_create_community(self):
+        self.assertQueryBudget(15, lambda: lambda: self.post({
+            'type': 'createCommunity', 'communityImage': 'null', 'dataObj': json.dumps({'name': 'Walkers', 'description': 'Walking'}),
+        }))
+
+    def test_add_and_remove_community_admin(self):
+        def prepare_add():
+            member = self.create_profile()
+            CommunityMembership.objects.create(community=self.community, profile=member)
+            return lambda: self.post({'type': 'addCommunityAdmin', 'memberId': member.id, 'communityId': self.community.id})
+        self.assertQueryBudget(8, prepare_add)
+
+        def prepare_remove():
+            admin = self.create_profile()
+            CommunityMembership.objects.create(community=self.community, profile=admin, role='admin')
+            return lambda: self.post({'type': 'removeCommunityAdmin', 'adminId': admin.id, 'communityId': self.community.id})
+        self.assertQueryBudget(9, prepare_remove)
+
+    def test_add_and_remove_community_member(self):
+        def prepare_add():
+            member = self.create_profile()
+            return lambda: self.post({'type': 'addCommunityMember', 'username': member.user.username, 'communityId': self.community.id})
+        self.assertQueryBudget(9, prepare_add)
+
+        def prepare_remove():
+            member = self.create_profile()
+            CommunityMembership.objects.create(community=self.community, profile=member)
+            return lambda: self.post({'type': 'removeCommunityMember', 'memberId': member.id, 'communityId': self.community.id})
+        self.assertQueryBudget(9, prepare_remove)
+
+    def test_join_and_exit_community(self):
+        def prepare_join():
+            admin = self.create_profile()
+            community = self.create_community(admin, [self.create_profile() for _ in range(self.scale)])
+            self.create_challenge(community, [admin])
+            return lambda: self.post({'type': 'joinCommunity', 'dataObj': json.dumps({'join_code': community.join_code})})
+        self.assertQueryBudget(14, prepare_join)
+
+        def prepare_exit():
+            community = self.create_community(self.create_profile(), [self.profile])
+            return lambda: self.post({'type': 'exitCommunity', 'communityId': community.id})
+        self.assertQueryBudget(8, prepare_exit)
+
+    def test_delete_community(self):
+        def prepare():
+            members = [self.create_profile() for _ in range(self.scale)]
+            community = self.create_community(self.profile, members)
+            for _ in range(self.scale):
+                self.create_challenge(community, members)
+            return lambda: self.post({'type': 'deleteCommunity', 'itemId': community.id})
+        self.assertQueryBudget(22, prepare)
+
+    def test_create_challenge(self):
+        self.assertQueryBudget(13, lambda: lambda: self.post({
+            'type': 'createChallenge',
+            'communityId': self.community.id,
+            'dataObj': json.dumps({'name': 'Plank', 'description': 'Hold it', 'start_date': str(self.today), 'end_date': str(self.today + timedelta(days=3)), 'workout_types': [x.id for x in self.workout_types]}),
+        }))
+
+    def test_join_exit_and_delete_challenge(self):
+        def prepare_join():
+            challenge = self.create_challenge(self.community, [self.create_profile() for _ in range(self.scale)])
+            return lambda: self.post({'type': 'joinChallenge', 'challengeId': challenge.id})
+        self.assertQueryBudget(8, prepare_join)
+
+        def prepare_exit():
+            challenge = self.create_challenge(self.community, [self.profile, *[self.create_profile() for _ in range(self.scale)]])
+            return lambda: self.post({'type': 'exitChallenge', 'challengeId': challenge.id})
+        self.assertQueryBudget(10, prepare_exit)
+
+        def prepare_delete():
+            challenge = self.create_challenge(self.community, [self.create_profile() for _ in range(self.scale)])
+            return lambda: self.post({'type': 'deleteChallenge', 'itemId': challenge.id})
+        self.assertQueryBudget(10, prepare_delete)
+
+    def test_app_and_user_data(self):
+        self.assertQueryBudget(0, lambda: (self.client.get('/app/data'), lambda: self.client.get('/app/data'))[1])
+        self.assertQueryBudget(1, lambda: lambda: self.client.get('/user/data'))
+
+    def test_login_and_refresh(self):
+        client = APIClient()
+        self.assertQueryBudget(4, lambda: lambda: client.post('/login', {'username': 'runner', 'password': 'password123'}))
+        self.assertQueryBudget(6, lambda: (client.post('/login', {'username': 'runner', 'password': 'password123'}), lambda: client.post('/api/token/refresh/'))[1])
@@ -0,0 +1,184 @@
+import os
+import time
+import uuid
+import imghdr
+import cloudinary
+import cloudinary.api
+import cloudinary.exceptions
+import cloudinary.utils
+import cloudinary.uploader
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.urls import reverse
+from PIL import Image
+from api.images import create_renditions
+from api.metrics import track
+from api.models import UserImageFile, user_folder
+from api.storage import get_image_storage, queue_file_deletions
+from api.utils import ErrorMessageException
+
+TICKET_SALT = 'api.uploads.ticket'
+ALLOWED_FORMATS = ['jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff']
+
+
+class LocalUploadBackend:
+    """
+    Implements the ticket protocol against the configured Django storage, with
+    the API itself receiving the upload. Used in development and tests.
+    """
+    name = 'local'
+
+    def get_upload_params(self, request, key:str, ticket:str):
+        return {'upload_url': request.build_absolute_uri(reverse('upload_direct')), 'fields': {'ticket': ticket}}
+
+    def receive(self, key:str, file):
+        if file.size > settings.UPLOAD_MAX_BYTES:
+            raise ErrorMessageException('The image is too large')
+        if not imghdr.what(file):
+            raise ErrorMessageException('Invalid image format')
+        storage = get_image_storage()
+        if storage.exists(key):
+            raise ErrorMessageException('This upload ticket has already been used')
+        if storage.save(key, file) != key:
+            storage.delete(key)
+            raise ErrorMessageException('The image could not be stored')
+
+    def verify(self, key:str):
+        storage = get_image_storage()
+        if not storage.exists(key):
+            raise ErrorMessageException('The image has not been uploaded')
+        with storage.open(key) as file:
+            valid = bool(imghdr.what(file))
+        if not valid or storage.size(key) > settings.UPLOAD_MAX_BYTES:
+            storage.delete(key)
+            raise ErrorMessageException('Invalid image format')
+
+
+class CloudinaryUploadBackend:
+    """
+    Hands the client signed parameters for Cloudinary's upload API, so the
+    file goes straight to Cloudinary, then checks the stored resource on confirm.
+    """
+    name = 'cloudinary'
+
+    def get_storage_name(self, key:str):
+        # Cloudinary drops the extension from the public id and MediaCloudinaryStorage
+        # resolves names against its prefix, so the stored name must carry both rules
+        return get_image_storage()._prepend_prefix(os.path.splitext(key)[0])
+
+    def get_upload_params(self, request, key:str, ticket:str):
+        config = settings.CLOUDINARY_STORAGE
+        params = {
+            'public_id': self.get_storage_name(key),
+            'timestamp': int(time.time()),
+            'allowed_formats': ','.join(ALLOWED_FORMATS),
+        }
+        params['signature'] = cloudinary.utils.api_sign_request(params, config['API_SECRET'])
+        params['api_key'] = config['API_KEY']
+        return {'upload_url': f"https://api.cloudinary.com/v1_1/{config['CLOUD_NAME']}/image/upload", 'fields': params}
+
+    def receive(self, key:str, file):
+        raise ErrorMessageException('Uploads go directly to Cloudinary')
+
+    def verify(self, key:str):
+        public_id = self.get_storage_name(key)
+        try:
+            resource = cloudinary.api.resource(public_id)
+        except cloudinary.exceptions.NotFound:
+            raise ErrorMessageException('The image has not been uploaded')
+        if resource['bytes'] > settings.UPLOAD_MAX_BYTES or resource['format'] not in ALLOWED_FORMATS:
+            cloudinary.uploader.destroy(public_id, invalidate=True)
+            raise ErrorMessageException('Invalid image format')
+        return public_id
+
+
+UPLOAD_BACKENDS = {
+    'local': LocalUploadBackend,
+    'cloudinary': CloudinaryUploadBackend,
+}
+
+
+def get_upload_backend():
+    return UPLOAD_BACKENDS[settings.UPLOAD_BACKEND]()
+
+
+def create_upload_ticket(request, filename:str):
+    backend = get_upload_backend()
+    extension = os.path.splitext(filename)[1].lower()
+    if extension.lstrip('.') not in ALLOWED_FORMATS:
+        raise ErrorMessageException('Invalid image format')
+
+    key = user_folder(UserImageFile(user=request.user), f"{uuid.uuid4().hex}{extension}")
+    ticket = signing.dumps({'user': request.user.id, 'key': key, 'filename': filename, 'backend': backend.name}, salt=TICKET_SALT)
+    return {
+        'ticket': ticket,
+        'backend': backend.name,
+        'expires_in': settings.UPLOAD_TICKET_MAX_AGE,
+        **backend.get_upload_params(request, key, ticket),
+    }
+
+
+def read_upload_ticket(ticket:str, user=None):
+    try:
+        values = signing.loads(ticket, salt=TICKET_SALT, max_age=settings.UPLOAD_TICKET_MAX_AGE)
+    except signing.SignatureExpired:
+        raise ErrorMessageException('The upload ticket has expired')
+    except signing.BadSignature:
+        raise ErrorMessageException('Invalid upload ticket')
+    if values['backend'] != settings.UPLOAD_BACKEND or (user is not None and values['user'] != user.id):
+        raise ErrorMessageException('Invalid upload ticket')
+    return values
+
+
+def receive_upload(ticket:str, file):
+    values = read_upload_ticket(ticket)
+    with track('storage'):
+        get_upload_backend().receive(values['key'], file)
+
+
+def confirm_upload(user, ticket:str):
+    """
+    Turns a verified upload into a UserImageFile with the same renditions as
+    images posted to the API: metadata stripped, size capped, thumb and medium
+    added. The file as uploaded is deleted once the image is saved.
+    """
+    values = read_upload_ticket(ticket, user)
+    # Renditions are named after the ticket's key, so a repeated confirm finds them
+    stem = os.path.splitext(os.path.basename(values['key']))[0]
+    image = UserImageFile.objects.filter(user=user, url__contains=f"{stem}_original").first()
+    if image:
+        return image
+
+    storage = get_image_storage()
+    with track('storage'):
+        name = get_upload_backend().verify(values['key']) or values['key']
+        try:
+            with storage.open(name) as file:
+                renditions = create_renditions(File(file, name=os.path.basename(values['key'])))
+        except (OSError, ValueError, Image.DecompressionBombError):
+            storage.delete(name)
+            raise ErrorMessageException('Invalid image format')
+        image = UserImageFile.objects.create(
+            user=user,
+            url=renditions['original'],
+            thumb=renditions['thumb'],
+            medium=renditions['medium'],
+            filename=values['filename'],
+        )
+    queue_file_deletions([name])
+    return image
+
+
+def get_confirmed_image(user, image_id):
+    """
+    Returns the user's confirmed upload with the given id, provided it is not
+    attached to anything yet, otherwise None.
+    """
+    try:
+        image_id = int(image_id)
+    except (TypeError, ValueError):
+        return None
+    return UserImageFile.objects.filter(
+        id=image_id, user=user, status='ready', workout_images__isnull=True, communities__isnull=True, profile_images__isnull=True,
+    ).first()
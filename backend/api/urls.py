@@ -9,16 +9,25 @@ urlpatterns = [
     path('', root, name='root'),
     path('server_time', get_current_server_time),
     path('refresh_server', refresh_server),
+    path('metrics', get_metrics),
     path('login', UserAuthView.as_view(), name='token_obtain_pair'),
     path('logout', logout_user),
     path('api/token/refresh/', CookieTokenRefreshView.as_view(), name='token_refresh'),
     path('user/data', get_user_data),
     path('user/reset-password', reset_user_password),
+    path('upload/ticket', get_upload_ticket),
+    path('upload/direct', upload_image_file, name='upload_direct'),
+    path('upload/confirm', confirm_image_upload),
 
     # App Data
     path('app/data', get_app_data),
-    path('register', register_user),
-    path('workout/data', get_user_workout_data),
+    path('register', register_user_async if settings.ASYNC_VIEWS else register_user),
+    path('workout/data', get_user_workout_data_async if settings.ASYNC_VIEWS else get_user_workout_data),
+    path('workout/batch', run_workout_actions),
+    path('workout/history', get_workout_history),
+    path('community/<int:community_id>', get_community_data),
+    path('challenge/<int:challenge_id>/leaderboard', get_challenge_leaderboard),
+    path('challenge/<int:challenge_id>/leaderboard/me', get_challenge_leaderboard_position),
 
     # query
     # path('query', query),
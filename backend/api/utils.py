@@ -1,5 +1,9 @@
 import os
 import sys
+import json
+import time
+import base64
+import threading
 from datetime import datetime, timedelta
 
 # django
@@ -9,10 +13,13 @@ from django.conf import settings
 import phonenumbers
 from phonenumbers import NumberParseException
 import pusher
+from pusher.requests import RequestsBackend
+from requests.adapters import HTTPAdapter
 from timezonefinder import TimezoneFinder
 import pytz
 from haversine import haversine, Unit
 import logging
+from api.metrics import record, observe_pusher_request
 
 
 logger = logging.getLogger(__name__)
@@ -89,14 +96,79 @@ def log_error(error_message:str):
     logger.info(error_message)
 
 
+class PooledRequestsBackend(RequestsBackend):
+    """
+    Pusher HTTP backend that keeps TLS connections to the Pusher API alive in
+    a pooled session and records delivery counters.
+    """
+    def __init__(self, client, **options):
+        super().__init__(client, **options)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.PUSHER_POOL_SIZE, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def send_request(self, request):
+        params = request.params or {}
+        events = len(params['batch']) if 'batch' in params else 1
+        started = time.perf_counter()
+        try:
+            response = super().send_request(request)
+        except Exception:
+            record_pusher_request(0, events, time.perf_counter() - started)
+            raise
+        record_pusher_request(events, 0, time.perf_counter() - started)
+        return response
+
+
+PUSHER_STATS = {'requests': 0, 'events_sent': 0, 'events_failed': 0, 'latency_seconds_total': 0.0, 'latency_seconds_max': 0.0}
+_pusher_stats_lock = threading.Lock()
+_pusher_client_lock = threading.Lock()
+_pusher_client = None
+_pusher_client_pid = None
+
+
+def record_pusher_request(events_sent:int, events_failed:int, latency:float):
+    record('pusher', latency)
+    observe_pusher_request(events_sent or events_failed, bool(events_failed), latency)
+    with _pusher_stats_lock:
+        PUSHER_STATS['requests'] += 1
+        PUSHER_STATS['events_sent'] += events_sent
+        PUSHER_STATS['events_failed'] += events_failed
+        PUSHER_STATS['latency_seconds_total'] += latency
+        PUSHER_STATS['latency_seconds_max'] = max(PUSHER_STATS['latency_seconds_max'], latency)
+
+
+def get_pusher_stats():
+    with _pusher_stats_lock:
+        return dict(PUSHER_STATS)
+
+
 def use_pusher():
-    pusher_client = pusher.Pusher(
-        app_id=settings.PUSHER_APP_ID,
-        key=settings.PUSHER_KEY,
-        secret=settings.PUSHER_SECRET,
-        cluster=settings.PUSHER_CLUSTER,
-    )
-    return pusher_client
+    # One client per worker process. The pid check makes sure a client
+    # created before a gunicorn fork is not shared with the children.
+    global _pusher_client, _pusher_client_pid
+    if _pusher_client is None or _pusher_client_pid != os.getpid():
+        with _pusher_client_lock:
+            if _pusher_client is None or _pusher_client_pid != os.getpid():
+                _pusher_client = pusher.Pusher(
+                    app_id=settings.PUSHER_APP_ID,
+                    key=settings.PUSHER_KEY,
+                    secret=settings.PUSHER_SECRET,
+                    cluster=settings.PUSHER_CLUSTER,
+                    host=getattr(settings, 'PUSHER_HOST', None),
+                    port=getattr(settings, 'PUSHER_PORT', None),
+                    ssl=getattr(settings, 'PUSHER_SSL', True),
+                    timeout=settings.PUSHER_TIMEOUT,
+                    backend=PooledRequestsBackend,
+                )
+                _pusher_client_pid = os.getpid()
+    return _pusher_client
+
+
+def reset_pusher_client():
+    global _pusher_client, _pusher_client_pid
+    with _pusher_client_lock:
+        _pusher_client, _pusher_client_pid = None, None
 
 
 class ErrorMessageException(Exception):
@@ -107,6 +179,31 @@ class ErrorMessageException(Exception):
         return self.message 
 
 
+# Cursor pagination
+def encode_cursor(values:dict):
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor:str):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except Exception:
+        raise ErrorMessageException('Invalid cursor')
+    if not isinstance(values, dict):
+        raise ErrorMessageException('Invalid cursor')
+    return values
+
+
+def get_page_size(value, default:int, maximum:int):
+    try:
+        page_size = int(value) if value else default
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, maximum))
+
+
 # Convert datetime
 def format_relative_date_time(utc_date, day_name, time):
     # Convert the UTC string to a datetime object
@@ -173,12 +270,4 @@ def get_current_user_utc_datetime(user_timezone):
     return utc_datetime
 
 
-def delete_file(File):
-    if hasattr(File, 'url') and hasattr(File.url, 'name') and hasattr(File.url, 'storage'):
-        storage = File.url.storage
-        path = File.url.name
-        if storage.exists(path):
-            storage.delete(path)
-
-
 
@@ -5,6 +5,7 @@ from django.utils import timezone
 from django.contrib.auth.hashers import check_password
 from django.conf import settings
 from django.db import transaction, IntegrityError
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import EmailMessage
 from email.utils import formataddr
 from email.mime.image import MIMEImage
@@ -16,18 +17,34 @@ from django.db.models import Q, Prefetch
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 from rest_framework.exceptions import AuthenticationFailed
-from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.permissions import AllowAny
 
 # Other
 from api.models import *
 from api.serializer import *
-from api.utils import log_error, delete_file, use_pusher, valid_email
+from api.images import store_user_image, prepare_user_image
+from api.uploads import create_upload_ticket, receive_upload, confirm_upload, get_confirmed_image
+from api.catalogue import get_app_data_payload, get_workout_type, get_workout_types
+from api.queries import get_community_summary_queryset, get_challenge_queryset
+from api.projections import get_workout_values, get_workouts_data, get_member_values, get_members_data, get_challenge_values, get_challenge_rows, get_communities_data
+from api.entities import EntityMap, get_default_images, get_normalized_workouts, get_normalized_community, get_normalized_challenges
+from api.leaderboard import lock_leaderboards, place_on_leaderboard, remove_from_leaderboard, move_on_leaderboard, get_leaderboard_top, get_leaderboard_neighbours
+from api.sync import get_sync_token, parse_sync_token, get_sync_changes
+from api.signal import challenge_participants_updated
+from api.realtime import queue_event, queue_events, collect_events, coalesce_events
+from api.storage import delete_file
+from api.metrics import track, set_request_action, render_metrics
+from api.authentication import add_profile_claims, get_profile_ref, get_request_profile, CachedRefreshToken
+from api.async_api import async_api_view
+from asgiref.sync import sync_to_async
+from api.utils import log_error, valid_email, encode_cursor, decode_cursor, get_page_size, ErrorMessageException
 from datetime import datetime
 import json
+import asyncio
+import hmac
 import imghdr
 import traceback
 
@@ -36,6 +53,16 @@ def root(request):
     return HttpResponse("<h1>PowerUp</h1>")
 
 
+def get_metrics(request):
+    # A plain Django view, since DRF would read the bearer token as a JWT
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not settings.METRICS_TOKEN:
+        return HttpResponse(status=404)
+    if not hmac.compare_digest(token, settings.METRICS_TOKEN):
+        return HttpResponse(status=401)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @api_view(['GET'])
 def get_current_server_time(request):
     return Response({'timestamp': timezone.now().timestamp(), 'current_date': timezone.now().date()}, status=200)
@@ -51,6 +78,7 @@ class UserAuthSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user):
         token = super().get_token(user)
+        add_profile_claims(token, user)
         
         return token
 
@@ -77,7 +105,13 @@ class UserAuthView(TokenObtainPairView):
 
 
 # Refresh Token
+class CookieTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = CachedRefreshToken
+
+
 class CookieTokenRefreshView(TokenRefreshView):
+    serializer_class = CookieTokenRefreshSerializer
+
     def post(self, request, *args, **kwargs):
         refresh_token = request.COOKIES.get("refresh_token")
 
@@ -112,7 +146,7 @@ def logout_user(request):
         return Response({'message': 'Missing refresh token'}, status=401)
     
     try:
-        token = RefreshToken(refresh_token)
+        token = CachedRefreshToken(refresh_token)
         token.blacklist()
     except Exception:
         return Response({'message': 'Invalid refresh token'}, status=400)
@@ -131,22 +165,55 @@ def reset_user_password(request):
     if check_password(user.username, user.password):
         return Response({'message': "The password cannot be the same as the username"}, status=400)
     
-    user.save()
+    user.save(update_fields=['password'])
     
     return Response(status=204)
 
 
+# Direct uploads
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def get_upload_ticket(request):
+    try:
+        return Response(create_upload_ticket(request, str(request.data.get('filename', ''))), status=200)
+    except ErrorMessageException as e:
+        return Response({'message': e.message}, status=400)
+
+
+# Stands in for the storage provider when UPLOAD_BACKEND is 'local'; the signed ticket is the credential
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def upload_image_file(request):
+    file = request.FILES.get('file')
+    if not file:
+        return Response({'message': 'No file was uploaded'}, status=400)
+    try:
+        receive_upload(str(request.data.get('ticket', '')), file)
+    except ErrorMessageException as e:
+        return Response({'message': e.message}, status=400)
+    return Response(status=204)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def confirm_image_upload(request):
+    try:
+        image = confirm_upload(request.user, str(request.data.get('ticket', '')))
+    except ErrorMessageException as e:
+        return Response({'message': e.message}, status=400)
+    return Response(UserImageFileSerializer(image).data, status=201)
+
+
 # User Data
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_user_data(request):
-    user = request.user
+    profile = get_request_profile(request.user)
     user_data = {
-        'username': user.username,
-        'last_login': user.last_login,
-        'email': user.email,
+        'username': profile.user.username,
+        'last_login': profile.user.last_login,
+        'email': profile.user.email,
     }
-    profile = Profile.objects.select_related('img').get(user=user)
     user_data.update(ProfileSerializer(profile).data)
         
     return Response(user_data, status=200)
@@ -154,13 +221,166 @@ def get_user_data(request):
 
 @api_view(['GET'])
 def get_app_data(request):
-    workout_types = WorkoutTypeSerializerOne(WorkoutType.objects.all(), many=True)
-    current_year = timezone.now().year
+    content, etag = get_app_data_payload()
+    if etag in [x.strip().removeprefix('W/') for x in request.headers.get('If-None-Match', '').split(',')]:
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+
+    return response
+
+
+def get_response_entities(request):
+    # Opt-in normalized shape: profiles, images and workout types are sent once
+    # in 'entities' and referenced by id everywhere else
+    return EntityMap() if request.query_params.get('shape') == 'normalized' else None
+
+
+def get_workouts_page(profile, cursor=None, page_size=None, entities=None):
+    page_size = get_page_size(page_size, settings.WORKOUT_PAGE_SIZE, settings.WORKOUT_MAX_PAGE_SIZE)
+    workouts = Workout.objects.filter(profile=profile)
+    if cursor:
+        values = decode_cursor(cursor)
+        try:
+            last_date, last_id = datetime.fromisoformat(values['d']).date(), int(values['i'])
+        except (KeyError, TypeError, ValueError):
+            raise ErrorMessageException('Invalid cursor')
+        workouts = workouts.filter(Q(date__lt=last_date) | Q(date=last_date, id__lt=last_id))
+
+    items = list(get_workout_values(workouts.order_by('-date', '-id'))[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor({'d': items[-1]['date'].isoformat(), 'i': items[-1]['id']})
+
+    return get_normalized_workouts(items, entities) if entities else get_workouts_data(items), next_cursor
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_workout_history(request):
+    profile = get_profile_ref(request.user)
+    entities = get_response_entities(request)
+    try:
+        workouts_data, next_cursor = get_workouts_page(profile, request.query_params.get('cursor'), request.query_params.get('page_size'), entities)
+    except ErrorMessageException as e:
+        return Response({'message': e.message}, status=400)
+
+    data = {
+        'workouts': workouts_data,
+        'next': next_cursor,
+    }
+    if entities:
+        data['entities'] = entities.get_entities()
+        data['default_images'] = get_default_images()
+    return Response(data, status=200)
+
+
+def get_community_members_page(community, cursor=None, page_size=None, entities=None):
+    members = Profile.objects.filter(communities=community)
+    if cursor:
+        try:
+            members = members.filter(id__gt=int(decode_cursor(cursor)['i']))
+        except (KeyError, TypeError, ValueError):
+            raise ErrorMessageException('Invalid cursor')
+
+    items = list(get_member_values(members.order_by('id'))[:page_size + 1])
+    next_cursor = encode_cursor({'i': items[page_size - 1]['id']}) if len(items) > page_size else None
+    if entities:
+        return [entities.add_profile(x) for x in items[:page_size]], next_cursor
+    return get_members_data(items[:page_size]), next_cursor
+
+
+def get_community_challenges_page(community, cursor=None, page_size=None, entities=None):
+    challenges = Challenge.objects.filter(community=community)
+    if cursor:
+        try:
+            challenges = challenges.filter(id__lt=int(decode_cursor(cursor)['i']))
+        except (KeyError, TypeError, ValueError):
+            raise ErrorMessageException('Invalid cursor')
+
+    items = list(get_challenge_values(challenges.order_by('-id'))[:page_size + 1])
+    next_cursor = encode_cursor({'i': items[page_size - 1]['id']}) if len(items) > page_size else None
+    if entities:
+        return get_normalized_challenges(items[:page_size], entities), next_cursor
+    return get_challenge_rows(items[:page_size]), next_cursor
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_community_data(request, community_id):
+    profile = get_profile_ref(request.user)
+    community = get_community_summary_queryset(profile).filter(id=community_id).first()
+    if not community or not community.is_member:
+        return Response({'message': 'You are not a member of this community'}, status=400)
+
+    params = request.query_params
+    section = params.get('section')
+    page_size = get_page_size(params.get('page_size'), settings.COMMUNITY_PAGE_SIZE, settings.COMMUNITY_MAX_PAGE_SIZE)
+    entities = get_response_entities(request)
+    if entities:
+        entities.community_ids = {community.id}
+    community_data = get_normalized_community(community, entities) if entities else CommunitySerializerTwo(community).data
+    try:
+        if section != 'challenges':
+            community_data['members'], community_data['members_next'] = get_community_members_page(community, params.get('members_cursor'), page_size, entities)
+        if section != 'members':
+            community_data['challenges'], community_data['challenges_next'] = get_community_challenges_page(community, params.get('challenges_cursor'), page_size, entities)
+    except ErrorMessageException as e:
+        return Response({'message': e.message}, status=400)
+
+    admins = Profile.objects.filter(memberships__community=community, memberships__role='admin').order_by('id')
+    if not section and entities:
+        community_data['admins'] = [entities.ref_profile(x) for x in admins.values_list('id', flat=True)]
+    elif not section:
+        community_data['admins'] = ProfileSerializerTwo(admins.select_related('user'), many=True).data
+    if entities:
+        community_data['entities'] = entities.get_entities()
+        community_data['default_images'] = get_default_images()
+
+    return Response(community_data, status=200)
+
+
+def get_member_challenge(request, challenge_id):
+    profile = get_profile_ref(request.user)
+    challenge = Challenge.objects.filter(id=challenge_id, community__members=profile).first()
+    return profile, challenge
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_challenge_leaderboard(request, challenge_id):
+    profile, challenge = get_member_challenge(request, challenge_id)
+    if not challenge:
+        return Response({'message': 'You are not a member of this community'}, status=400)
+
+    limit = get_page_size(request.query_params.get('limit'), settings.LEADERBOARD_SIZE, settings.LEADERBOARD_MAX_SIZE)
+    return Response({
+        'challenge_id': challenge.id,
+        'participants': ChallengeParticipantSerializerOne(get_leaderboard_top(challenge.id, limit), many=True).data,
+    }, status=200)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_challenge_leaderboard_position(request, challenge_id):
+    profile, challenge = get_member_challenge(request, challenge_id)
+    if not challenge:
+        return Response({'message': 'You are not a member of this community'}, status=400)
 
+    participant = ChallengeParticipant.objects.filter(challenge=challenge, profile=profile).first()
+    if not participant:
+        return Response({'challenge_id': challenge.id, 'me': None, 'above': [], 'below': []}, status=200)
+
+    count = get_page_size(request.query_params.get('neighbours'), settings.LEADERBOARD_NEIGHBOURS, settings.LEADERBOARD_MAX_SIZE)
+    above, below = get_leaderboard_neighbours(participant, count)
     return Response({
-        'workout_types': workout_types.data,
-        'current_year_start_date': datetime(current_year, 1, 1).strftime("%Y-%m-%d"),
-        'current_year_end_date': datetime(current_year, 12, 31).strftime("%Y-%m-%d"),
+        'challenge_id': challenge.id,
+        'me': ChallengeParticipantSerializerOne(participant).data,
+        'above': ChallengeParticipantSerializerOne(above, many=True).data,
+        'below': ChallengeParticipantSerializerOne(below, many=True).data,
     }, status=200)
 
 
@@ -169,360 +389,537 @@ def get_app_data(request):
 def get_user_workout_data(request):
     user = request.user
     if request.method == 'GET':
-        profile = Profile.objects.get(user=request.user)
-        workouts_data = WorkoutSerializerOne(Workout.objects.filter(profile=profile), many=True).data
-        communities = CommunitySerializerOne(Community.objects.select_related('img').prefetch_related(
-            Prefetch('admins', queryset=Profile.objects.select_related('user', 'img').all()), 
-            Prefetch('members', queryset=Profile.objects.select_related('user', 'img').all()),
-            Prefetch('challenges', queryset=Challenge.objects.prefetch_related('workout_types', Prefetch('participants', queryset=ChallengeParticipant.objects.select_related('profile__user').all()),).all()),
-        ).filter(members=profile), many=True).data
-
-        return Response({
-            'workouts': workouts_data,
-            'communities': communities,
-        }, status=200)
+        return get_workout_data(request)
     
     else:
-        data = request.data
-        if data['type'] == 'createWorkout':
-            selfie = data['selfie']
-            profile = Profile.objects.get(user=user)
-            if not imghdr.what(selfie):
-                return Response({'message': 'Invalid image format'}, status=400)
-            
-            workout_type = WorkoutType.objects.get(id=int(data['workoutType']))
-            points_earned, calories_burned, duration = float(data['pointsEarned']), float(data['caloriesBurned']), float(data['duration'])
+        set_request_action(get_action_name(request.data))
+        return perform_workout_action(user, request.data, ActionContext(user))
 
-            with transaction.atomic():
-                try:
-                    selfie = UserImageFile.objects.create(user=user, url=selfie, filename=selfie.name,)
-                    workout = Workout.objects.create(
-                        profile=profile,
-                        workout_type=workout_type,
-                        duration=duration,
-                        img=selfie,
-                        date=timezone.now().date(),
-                        calories_burned=calories_burned,
-                        points=points_earned,
-                    )
-                    current_date = timezone.now().date()
-                    challenges = Challenge.objects.filter(workout_types=workout_type, start_date__lte=current_date, end_date__gte=current_date)
-                    challenge_participants = ChallengeParticipant.objects.filter(challenge__in=challenges, profile=profile)
-                    for challenge_participant in challenge_participants:
-                        challenge_participant.points += points_earned
-                        challenge_participant.save()
-                    return Response(WorkoutSerializerOne(workout).data, status=200)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    delete_file(selfie)
-                    return Response(status=400)
-                
-        elif data['type'] == 'createCommunity':
-            profile = Profile.objects.get(user=user)
-            community_image = data['communityImage'] if data['communityImage'] and data['communityImage'] != 'null' else ''
-            data_obj = json.loads(data['dataObj'])
-            name, description = data_obj.get('name').strip(), data_obj.get('description').strip()
-            if community_image and not imghdr.what(community_image):
-                return Response({'message': 'Invalid image format'}, status=400)
-       
-            with transaction.atomic():
-                try:
-                    if community_image:
-                        community_image = UserImageFile.objects.create(
-                            user=user,
-                            url=community_image,
-                            filename=community_image.name,
-                        )
-                    item_to_create = Community.objects.create(
-                        name=name,
-                        description=description,
-                        img=community_image if community_image else None,
-                    )
-                    item_to_create.admins.add(profile)
-                    item_to_create.members.add(profile)
-                    return Response(CommunitySerializerOne(Community.objects.select_related('img').prefetch_related(
-                        Prefetch('admins', queryset=Profile.objects.select_related('user', 'img').all()), 
-                        Prefetch('members', queryset=Profile.objects.select_related('user', 'img').all()),
-                        Prefetch('challenges', queryset=Challenge.objects.prefetch_related('workout_types', Prefetch('participants', queryset=ChallengeParticipant.objects.select_related('profile__user').all()),).all()),
-                    ).get(id=item_to_create.id)).data, status=200)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    if community_image:
-                        delete_file(community_image)
-                    return Response(status=400)
-
-        elif data['type'] == 'addCommunityAdmin':
-            profile = Profile.objects.get(user=user)
-            new_admin = Profile.objects.select_related('user').get(id=int(data['memberId']))
-            community = Community.objects.prefetch_related('admins').get(id=int(data['communityId']))
-            if profile not in community.admins.all():
-                return Response({'message': 'You are not an admin of this community'}, status=400)
-            elif new_admin in community.admins.all():
-                return Response({'message': f"The member you selected is already an admin"}, status=400)
-       
-            with transaction.atomic():
-                try:
-                    community.admins.add(new_admin)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
-
-            return Response(status=204)
-
-        elif data['type'] == 'removeCommunityAdmin':
-            profile = Profile.objects.get(user=user)
-            old_admin = Profile.objects.select_related('user').get(id=int(data['adminId']))
-            community = Community.objects.prefetch_related('admins').get(id=int(data['communityId']))
-            if profile not in community.admins.all():
-                return Response({'message': 'You are not an admin of this community'}, status=400)
-       
-            with transaction.atomic():
-                try:
-                    community.admins.remove(old_admin)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
 
-            return Response(status=204)
-        
-        elif data['type'] == 'addCommunityMember':
-            profile = Profile.objects.get(user=user)
-            new_member_user = User.objects.filter(username=data['username']).first()
-            if not new_member_user:
-                return Response({'message': 'Oops! There is no account associated with this username'}, status=400)
-            new_member = Profile.objects.get(user=new_member_user)
-            community = Community.objects.prefetch_related('admins', 'members').get(id=int(data['communityId']))
-            if profile not in community.admins.all():
-                return Response({'message': 'You are not an admin of this community'}, status=400)
-            elif new_member in community.members.all():
-                return Response({'message': f"The member you selected is already a member of the community"}, status=400)
-       
-            with transaction.atomic():
-                try:
-                    community.members.add(new_member)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
-                
-            return Response(ProfileSerializerOne(new_member).data, status=200)
-        
-        elif data['type'] == 'removeCommunityMember':
-            profile = Profile.objects.get(user=user)
-            member = Profile.objects.select_related('user').get(id=int(data['memberId']))
-            community = Community.objects.prefetch_related('admins').get(id=int(data['communityId']))
-            if profile not in community.admins.all():
-                return Response({'message': 'You are not an admin of this community'}, status=400)
-            elif member in community.admins.all():
-                return Response({'message': 'You cannot remove a member who is an admin. Remove the person from the community admin before'}, status=400)
-       
-            with transaction.atomic():
-                try:
-                    RemovedCommunityMember.objects.create(profile=member, community=community, date=timezone.now().date())
-                    community.members.remove(member)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
+def get_workout_data(request):
+    profile = get_profile_ref(request.user)
+    since = request.query_params.get('since')
+    sync_token = get_sync_token()
+    entities = get_response_entities(request)
+    data = None
+    if since:
+        since = parse_sync_token(since)
+        data = get_sync_changes(profile, since, sync_token, entities) if since is not None else None
 
-            return Response(status=204)
-        
-        elif data['type'] == 'joinCommunity':
-            profile = Profile.objects.get(user=user)
-            data_obj = json.loads(data['dataObj'])
-            community = Community.objects.prefetch_related('members').filter(join_code=data_obj.get('join_code')).first()
-            if not community:
-                return Response({'message': 'Oops! That community code is invalid or has been removed.'}, status=400)
-            elif community and profile in community.members.all():
-                return Response({'message': f"You are already a member of the community '{community.name}'"}, status=400)
-            elif RemovedCommunityMember.objects.filter(profile=profile, community=community).exists():
-                return Response({'message': f"You were removed from the community '{community.name}'. You cannot join using the community code"}, status=400)
-       
-            with transaction.atomic():
-                try:
-                    community.members.add(profile)
-                    return Response(CommunitySerializerOne(Community.objects.select_related('img').prefetch_related(
-                        Prefetch('admins', queryset=Profile.objects.select_related('user', 'img').all()), 
-                        Prefetch('members', queryset=Profile.objects.select_related('user', 'img').all()),
-                        Prefetch('challenges', queryset=Challenge.objects.prefetch_related('workout_types', Prefetch('participants', queryset=ChallengeParticipant.objects.select_related('profile__user').all()),).all()),
-                    ).get(id=community.id)).data, status=200)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
-        
+    if data is None and not (entities or request.query_params.get('since') or request.query_params.get('shape') == 'summary'):
+        # The shape existing clients read: every workout, and each community
+        # with its admins, members and challenges. Clients that sync or ask
+        # for ?shape=summary get a workout page and community summaries, and
+        # load the detail from community/<id>.
+        data = {
+            'workouts': get_workouts_data(get_workout_values(Workout.objects.filter(profile=profile).order_by('id'))),
+            'communities': get_communities_data(Community.objects.filter(members=profile)),
+            'sync_token': sync_token,
+            'reset': False,
+        }
+    elif data is None:
+        workouts_data, workouts_next = get_workouts_page(profile, page_size=request.query_params.get('page_size'), entities=entities)
+        communities = get_community_summary_queryset(profile).filter(members=profile)
+        data = {
+            'workouts': workouts_data,
+            'workouts_next': workouts_next,
+            'communities': [get_normalized_community(x, entities) for x in communities] if entities else CommunitySerializerTwo(communities, many=True).data,
+            'sync_token': sync_token,
+            'reset': bool(request.query_params.get('since')),
+        }
+    if entities:
+        data['entities'] = entities.get_entities()
+        data['default_images'] = get_default_images()
+
+    return Response(data, status=200)
+
+
+class ActionContext:
+    """
+    Caches the caller's profile and their role in the communities that
+    workout/data actions refer to, so a batch of actions looks each of them up
+    only once. Actions that change the caller's own membership update the cache.
+    """
+    def __init__(self, user):
+        self.user = user
+        self._profile = None
+        self.roles = {}
+        # Images the async views already uploaded, by request field
+        self.prepared_images = {}
+
+    @property
+    def profile(self):
+        if self._profile is None:
+            self._profile = get_profile_ref(self.user)
+        return self._profile
+
+    def get_role(self, community_id):
+        # None when the caller is not a member
+        community_id = int(community_id)
+        if community_id not in self.roles:
+            self.roles[community_id] = CommunityMembership.objects.filter(community_id=community_id, profile_id=self.profile.id).values_list('role', flat=True).first()
+        return self.roles[community_id]
+
+    def load_roles(self, community_ids):
+        community_ids = set(community_ids) - set(self.roles)
+        if community_ids:
+            self.roles.update(dict.fromkeys(community_ids))
+            self.roles.update(CommunityMembership.objects.filter(community_id__in=community_ids, profile_id=self.profile.id).values_list('community_id', 'role'))
+
+    def store_image(self, field, uploaded_file):
+        image = self.prepared_images.pop(field, None)
+        if image is None:
+            return store_user_image(self.user, uploaded_file)
+        image.save()
+        return image
+
+
+def is_only_admin(community_id, profile_id):
+    # The admin rows are locked, so two admins stepping down at once cannot both see the other one stay
+    admins = CommunityMembership.objects.select_for_update().filter(community_id=community_id, role='admin').values_list('profile_id', flat=True)
+    return list(admins) == [profile_id]
+
+
+WORKOUT_ACTIONS = {
+    'createWorkout', 'createCommunity', 'addCommunityAdmin', 'removeCommunityAdmin', 'addCommunityMember', 'removeCommunityMember',
+    'joinCommunity', 'exitCommunity', 'deleteCommunity', 'createChallenge', 'joinChallenge', 'exitChallenge', 'deleteChallenge',
+}
+
+
+def get_action_name(data):
+    # Used as a metrics label, so types sent by clients never become new series
+    return data['type'] if data['type'] in WORKOUT_ACTIONS else 'unknown'
+
+
+def perform_workout_action(user, data, context:ActionContext):
+    if data['type'] == 'createWorkout':
+        # The selfie is either sent with the request or uploaded beforehand with an upload ticket
+        uploaded_selfie = get_confirmed_image(user, data['selfieId']) if data.get('selfieId') else None
+        selfie = uploaded_selfie or data.get('selfie')
+        profile = context.profile
+        if data.get('selfieId') and not uploaded_selfie:
+            return Response({'message': 'Invalid image'}, status=400)
+        if not uploaded_selfie and (not selfie or not imghdr.what(selfie)):
+            return Response({'message': 'Invalid image format'}, status=400)
         
-        elif data['type'] == 'exitCommunity':
-            profile = Profile.objects.get(user=user)
-            community = Community.objects.prefetch_related('members').get(id=int(data['communityId']))
-       
-            with transaction.atomic():
-                try:
-                    community.members.remove(profile)
-                    return Response(status=204)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
-                
-        elif data['type'] == 'deleteCommunity':
-            profile = Profile.objects.select_related('user').get(user=user)
-            community = Community.objects.prefetch_related('admins').get(id=int(data['itemId']))
-            channel = f"community_{community.id}"
-            if profile not in community.admins.all():
-                return Response({'message': 'You are not authorized to delete this community'}, status=400)
-       
-            with transaction.atomic():
-                try:
-                    if community.img:
-                        community.img.delete()
-                    community.delete()
-                except Exception as e:
-                    transaction.set_rollback(True)
-                    log_error(e)
-                    return Response(status=400)
-            
+        workout_type = get_workout_type(int(data['workoutType']))
+        points_earned, calories_burned, duration = float(data['pointsEarned']), float(data['caloriesBurned']), float(data['duration'])
+
+        with transaction.atomic():
             try:
-                pusher = use_pusher()
-                pusher.trigger(channel, 'community_deleted', profile.user.username)
+                if not uploaded_selfie:
+                    selfie = context.store_image('selfie', selfie)
+                workout = Workout.objects.create(
+                    profile=profile,
+                    workout_type=workout_type,
+                    duration=duration,
+                    img=selfie,
+                    date=timezone.now().date(),
+                    calories_burned=calories_burned,
+                    points=points_earned,
+                )
+                current_date = timezone.now().date()
+                challenges = Challenge.objects.filter(workout_types=workout_type, start_date__lte=current_date, end_date__gte=current_date)
+                challenge_participants = ChallengeParticipant.objects.filter(challenge__in=challenges, profile=profile)
+                participant_ids = dict(challenge_participants.values_list('id', 'challenge_id'))
+                if participant_ids:
+                    lock_leaderboards(set(participant_ids.values()))
+                    # Read under the lock, so the stored old score is what ties are matched against
+                    updated_participants = list(ChallengeParticipant.objects.select_related('challenge').filter(id__in=participant_ids))
+                    for challenge_participant in updated_participants:
+                        old_points = challenge_participant.points
+                        challenge_participant.points = old_points + points_earned
+                        move_on_leaderboard(challenge_participant, old_points)
+                    ChallengeParticipant.objects.bulk_update(updated_participants, ['points', 'rank'])
+                    challenge_participants_updated(updated_participants)
+                return Response(WorkoutSerializerOne(workout).data, status=200)
             except Exception:
+                transaction.set_rollback(True)
                 log_error(traceback.format_exc())
-            return Response(status=204)
-
-        elif data['type'] == 'createChallenge':
-            profile = Profile.objects.select_related('user').get(user=user)
-            community = Community.objects.prefetch_related('admins').get(id=int(data['communityId']))
-            data_obj = json.loads(data['dataObj'])
-            name, description, start_date, end_date = data_obj.get('name').strip(), data_obj.get('description').strip(), data_obj.get('start_date'), data_obj.get('end_date')
-            if profile not in community.admins.all():
-                return Response({'message': 'You are not authorized to create a challenge in this community'}, status=400)
-            
-            if datetime.fromisoformat(start_date) > datetime.fromisoformat(end_date):
-                return Response({'message': 'The start date cannot be after the end date'}, status=400)
+                if not uploaded_selfie:
+                    delete_file(selfie)
+                return Response(status=400)
             
-            workout_types = WorkoutType.objects.filter(id__in=[int(x) for x in data_obj.get('workout_types')])
-            item_to_create = None
-            with transaction.atomic():
-                try:
-                    item_to_create = Challenge.objects.create(
-                        name=name,
-                        description=description,
-                        start_date=start_date,
-                        end_date=end_date,
-                        date=timezone.now().date(),
-                        community=community,
-                    )
-                    item_to_create.workout_types.set(workout_types)
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
+    elif data['type'] == 'createCommunity':
+        profile = context.profile
+        uploaded_image = get_confirmed_image(user, data['communityImageId']) if data.get('communityImageId') else None
+        community_image = data.get('communityImage') if data.get('communityImage') and data['communityImage'] != 'null' else ''
+        data_obj = json.loads(data['dataObj'])
+        name, description = data_obj.get('name').strip(), data_obj.get('description').strip()
+        if data.get('communityImageId') and not uploaded_image:
+            return Response({'message': 'Invalid image'}, status=400)
+        if community_image and not uploaded_image and not imghdr.what(community_image):
+            return Response({'message': 'Invalid image format'}, status=400)
+   
+        with transaction.atomic():
+            try:
+                if uploaded_image:
+                    community_image = uploaded_image
+                elif community_image:
+                    community_image = context.store_image('communityImage', community_image)
+                item_to_create = Community.objects.create(
+                    name=name,
+                    description=description,
+                    img=community_image if community_image else None,
+                )
+                CommunityMembership.objects.create(community=item_to_create, profile=profile, role='admin')
+                context.roles[item_to_create.id] = 'admin'
+                return Response(get_communities_data(Community.objects.filter(id=item_to_create.id))[0], status=200)
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                if community_image and not uploaded_image:
+                    delete_file(community_image)
+                return Response(status=400)
+
+    elif data['type'] == 'addCommunityAdmin':
+        community_id = int(data['communityId'])
+        if context.get_role(community_id) != 'admin':
+            return Response({'message': 'You are not an admin of this community'}, status=400)
+        membership = CommunityMembership.objects.filter(community_id=community_id, profile_id=int(data['memberId'])).first()
+        if not membership:
+            return Response({'message': 'The person you selected is not a member of the community'}, status=400)
+        elif membership.role == 'admin':
+            return Response({'message': f"The member you selected is already an admin"}, status=400)
+   
+        with transaction.atomic():
+            try:
+                membership.role = 'admin'
+                membership.save(update_fields=['role'])
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                return Response(status=400)
+
+        return Response(status=204)
+
+    elif data['type'] == 'removeCommunityAdmin':
+        community_id = int(data['communityId'])
+        if context.get_role(community_id) != 'admin':
+            return Response({'message': 'You are not an admin of this community'}, status=400)
+        membership = CommunityMembership.objects.filter(community_id=community_id, profile_id=int(data['adminId'])).first()
+        if not membership:
+            return Response({'message': 'The person you selected is not a member of the community'}, status=400)
+        elif membership.role != 'admin':
+            return Response({'message': 'The member you selected is not an admin'}, status=400)
+   
+        with transaction.atomic():
+            try:
+                if is_only_admin(community_id, membership.profile_id):
+                    return Response({'message': 'A community needs at least one admin. Make another member an admin first'}, status=400)
+                membership.role = 'member'
+                membership.save(update_fields=['role'])
+                if membership.profile_id == context.profile.id:
+                    context.roles[community_id] = 'member'
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                return Response(status=400)
+
+        return Response(status=204)
+    
+    elif data['type'] == 'addCommunityMember':
+        new_member = Profile.objects.select_related('user', 'img').filter(user__username=data['username']).first()
+        if not new_member:
+            return Response({'message': 'Oops! There is no account associated with this username'}, status=400)
+        community_id = int(data['communityId'])
+        if context.get_role(community_id) != 'admin':
+            return Response({'message': 'You are not an admin of this community'}, status=400)
+        elif CommunityMembership.objects.filter(community_id=community_id, profile=new_member).exists():
+            return Response({'message': f"The member you selected is already a member of the community"}, status=400)
+   
+        with transaction.atomic():
+            try:
+                CommunityMembership.objects.create(community_id=community_id, profile=new_member)
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                return Response(status=400)
             
-            challenge = Challenge.objects.prefetch_related('workout_types',
-                Prefetch('participants', queryset=ChallengeParticipant.objects.select_related('profile__user').all()), 
-            ).get(id=item_to_create.id)
-            challenge_data = ChallengeSerializerOne(challenge).data
-            channel, challenge_id, challenge_name = f"community_{challenge.community.id}", challenge.id, challenge.name
+        return Response(ProfileSerializerOne(new_member).data, status=200)
+    
+    elif data['type'] == 'removeCommunityMember':
+        community_id = int(data['communityId'])
+        if context.get_role(community_id) != 'admin':
+            return Response({'message': 'You are not an admin of this community'}, status=400)
+        membership = CommunityMembership.objects.filter(community_id=community_id, profile_id=int(data['memberId'])).first()
+        if not membership:
+            return Response({'message': 'The person you selected is not a member of the community'}, status=400)
+        elif membership.role == 'admin':
+            return Response({'message': 'You cannot remove a member who is an admin. Remove the person from the community admin before'}, status=400)
+   
+        with transaction.atomic():
             try:
-                pusher = use_pusher()
-                pusher.trigger(channel, 'challenge_added', {'challenge': challenge_data, 'username': profile.user.username})
+                RemovedCommunityMember.objects.create(profile_id=membership.profile_id, community_id=community_id, date=timezone.now().date())
+                membership.delete()
             except Exception:
+                transaction.set_rollback(True)
                 log_error(traceback.format_exc())
+                return Response(status=400)
 
-            return Response(challenge_data, status=200)
+        return Response(status=204)
+    
+    elif data['type'] == 'joinCommunity':
+        profile = context.profile
+        data_obj = json.loads(data['dataObj'])
+        community = Community.objects.filter(join_code=data_obj.get('join_code')).first()
+        if not community:
+            return Response({'message': 'Oops! That community code is invalid or has been removed.'}, status=400)
+        elif context.get_role(community.id):
+            return Response({'message': f"You are already a member of the community '{community.name}'"}, status=400)
+        elif RemovedCommunityMember.objects.filter(profile=profile, community=community).exists():
+            return Response({'message': f"You were removed from the community '{community.name}'. You cannot join using the community code"}, status=400)
+   
+        with transaction.atomic():
+            try:
+                CommunityMembership.objects.create(community=community, profile=profile)
+                context.roles[community.id] = 'member'
+                return Response(get_communities_data(Community.objects.filter(id=community.id))[0], status=200)
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                return Response(status=400)
+    
+    
+    elif data['type'] == 'exitCommunity':
+        profile = context.profile
+        community_id = int(data['communityId'])
+   
+        with transaction.atomic():
+            try:
+                if is_only_admin(community_id, profile.id):
+                    return Response({'message': 'You are the only admin of this community. Make another member an admin before you leave'}, status=400)
+                CommunityMembership.objects.filter(community_id=community_id, profile=profile).delete()
+                context.roles[community_id] = None
+                return Response(status=204)
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                return Response(status=400)
+            
+    elif data['type'] == 'deleteCommunity':
+        profile = context.profile
+        community_id = int(data['itemId'])
+        channel = f"community_{community_id}"
+        if context.get_role(community_id) != 'admin':
+            return Response({'message': 'You are not authorized to delete this community'}, status=400)
+        community = Community.objects.select_related('img').get(id=community_id)
+   
+        with transaction.atomic():
+            try:
+                if community.img:
+                    community.img.delete()
+                community.delete()
+                context.roles[community_id] = None
+                queue_event(channel, 'community_deleted', profile.user.username)
+            except Exception as e:
+                transaction.set_rollback(True)
+                log_error(e)
+                return Response(status=400)
         
-        elif data['type'] == 'joinChallenge':
-            profile = Profile.objects.get(user=user)
-            challenge = Challenge.objects.prefetch_related('participants').get(id=int(data['challengeId']))
-            item_to_create = None
-            with transaction.atomic():
-                try:
-                    item_to_create = ChallengeParticipant.objects.create(profile=profile, challenge=challenge, date_joined=timezone.now().date())
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
-            return Response(ChallengeParticipantSerializerOne(ChallengeParticipant.objects.select_related('profile__user').get(id=item_to_create.id)).data, status=200)
+        return Response(status=204)
+
+    elif data['type'] == 'createChallenge':
+        profile = context.profile
+        community_id = int(data['communityId'])
+        data_obj = json.loads(data['dataObj'])
+        name, description, start_date, end_date = data_obj.get('name').strip(), data_obj.get('description').strip(), data_obj.get('start_date'), data_obj.get('end_date')
+        if context.get_role(community_id) != 'admin':
+            return Response({'message': 'You are not authorized to create a challenge in this community'}, status=400)
         
-        elif data['type'] == 'exitChallenge':
-            profile = Profile.objects.get(user=user)
-            challenge = Challenge.objects.prefetch_related('participants').get(id=int(data['challengeId']))
-            challenge_participant = ChallengeParticipant.objects.get(profile=profile, challenge=challenge)
-            challenge_participant_data = ChallengeParticipant(challenge_participant).data
-            with transaction.atomic():
-                try:
-                    challenge_participant.delete()
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
-                
-            return Response(challenge_participant_data, status=200)
+        if datetime.fromisoformat(start_date) > datetime.fromisoformat(end_date):
+            return Response({'message': 'The start date cannot be after the end date'}, status=400)
         
-        elif data['type'] == 'deleteChallenge':
-            profile = Profile.objects.select_related('user').get(user=user)
-            challenge = Challenge.objects.select_related('community').prefetch_related('community__admins').get(id=int(data['itemId']))
-            channel, challenge_id, challenge_name = f"community_{challenge.community.id}", challenge.id, challenge.name
-            if profile not in challenge.community.admins.all():
-                return Response({'message': 'You are not authorized to delete this challenge'}, status=400)
-       
-            with transaction.atomic():
-                try:
-                    challenge.delete()
-                except Exception:
-                    transaction.set_rollback(True)
-                    log_error(traceback.format_exc())
-                    return Response(status=400)
+        workout_types = get_workout_types([int(x) for x in data_obj.get('workout_types')])
+        item_to_create = None
+        with transaction.atomic():
+            try:
+                item_to_create = Challenge.objects.create(
+                    name=name,
+                    description=description,
+                    start_date=start_date,
+                    end_date=end_date,
+                    date=timezone.now().date(),
+                    community_id=community_id,
+                )
+                item_to_create.workout_types.set(workout_types)
+                challenge = get_challenge_queryset().get(id=item_to_create.id)
+                challenge_data = ChallengeSerializerOne(challenge).data
+                queue_event(f"community_{community_id}", 'challenge_added', {'challenge': challenge_data, 'username': profile.user.username})
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                return Response(status=400)
 
+        return Response(challenge_data, status=200)
+    
+    elif data['type'] == 'joinChallenge':
+        profile = context.profile
+        challenge = Challenge.objects.get(id=int(data['challengeId']))
+        item_to_create = None
+        with transaction.atomic():
+            try:
+                lock_leaderboards([challenge.id])
+                item_to_create = ChallengeParticipant.objects.create(
+                    profile=profile,
+                    challenge=challenge,
+                    username=profile.user.username,
+                    rank=place_on_leaderboard(challenge.id, 0),
+                    date_joined=timezone.now().date(),
+                )
+            except IntegrityError:
+                transaction.set_rollback(True)
+                return Response({'message': 'You have already joined this challenge'}, status=400)
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                return Response(status=400)
+        return Response(ChallengeParticipantSerializerOne(item_to_create).data, status=200)
+    
+    elif data['type'] == 'exitChallenge':
+        profile = context.profile
+        challenge = Challenge.objects.get(id=int(data['challengeId']))
+        with transaction.atomic():
+            try:
+                lock_leaderboards([challenge.id])
+                challenge_participant = ChallengeParticipant.objects.get(profile=profile, challenge=challenge)
+                challenge_participant_data = ChallengeParticipantSerializerOne(challenge_participant).data
+                remove_from_leaderboard(challenge.id, challenge_participant.points, exclude_id=challenge_participant.id)
+                challenge_participant.delete()
+            except Exception:
+                transaction.set_rollback(True)
+                log_error(traceback.format_exc())
+                return Response(status=400)
+            
+        return Response(challenge_participant_data, status=200)
+    
+    elif data['type'] == 'deleteChallenge':
+        profile = context.profile
+        challenge = Challenge.objects.get(id=int(data['itemId']))
+        channel, challenge_id, challenge_name = f"community_{challenge.community_id}", challenge.id, challenge.name
+        if context.get_role(challenge.community_id) != 'admin':
+            return Response({'message': 'You are not authorized to delete this challenge'}, status=400)
+   
+        with transaction.atomic():
             try:
-                pusher = use_pusher()
-                pusher.trigger(channel, 'challenge_deleted', {'challenge_id': challenge_id, 'challenge_name': challenge_name, 'username': profile.user.username})
+                challenge.delete()
+                queue_event(channel, 'challenge_deleted', {'challenge_id': challenge_id, 'challenge_name': challenge_name, 'username': profile.user.username})
             except Exception:
+                transaction.set_rollback(True)
                 log_error(traceback.format_exc())
-            return Response(status=204)
+                return Response(status=400)
+
+        return Response(status=204)
+
+    return Response({'message': 'Unknown action'}, status=400)
 
 
 @api_view(['POST'])
-def register_user(request):
-    data = request.data
+@permission_classes([IsAuthenticated])
+def run_workout_actions(request):
+    """
+    Runs a list of workout/data actions in order. Each action gets its own
+    savepoint and result; with 'atomic' set, the first failure rolls back the
+    whole batch. Realtime events are merged per community and queued at the end.
+    """
+    actions, atomic = request.data.get('actions'), bool(request.data.get('atomic'))
+    if not isinstance(actions, list) or not actions or not all(isinstance(x, dict) and x.get('type') for x in actions):
+        return Response({'message': 'Invalid actions'}, status=400)
+    if len(actions) > settings.WORKOUT_BATCH_MAX_ACTIONS:
+        return Response({'message': f"A batch can contain at most {settings.WORKOUT_BATCH_MAX_ACTIONS} actions"}, status=400)
+
+    context = ActionContext(request.user)
+    community_ids = [x.get('itemId') if x['type'] == 'deleteCommunity' else x.get('communityId') for x in actions]
+    try:
+        context.load_roles([int(x) for x in community_ids if x])
+    except (TypeError, ValueError):
+        return Response({'message': 'Invalid actions'}, status=400)
+
+    results, events = [], []
+    with transaction.atomic():
+        for action in actions:
+            # dataObj is a JSON string in workout/data requests but may arrive as an object here
+            data = {**action, 'dataObj': json.dumps(action['dataObj'])} if isinstance(action.get('dataObj'), dict) else action
+            with collect_events() as action_events:
+                try:
+                    with transaction.atomic():
+                        response = perform_workout_action(request.user, data, context)
+                        if response.status_code >= 400:
+                            transaction.set_rollback(True)
+                except ObjectDoesNotExist:
+                    response = Response({'message': 'The item no longer exists'}, status=400)
+                except Exception:
+                    log_error(traceback.format_exc())
+                    response = Response(status=400)
+
+            results.append({'type': data['type'], 'status': response.status_code, 'data': response.data})
+            if response.status_code < 400:
+                events += action_events
+            elif atomic:
+                transaction.set_rollback(True)
+                return Response({'message': 'The batch was not applied because an action failed', 'results': results}, status=400)
+
+        queue_events(coalesce_events(events))
+
+    return Response({'results': results}, status=200)
+
+
+def read_registration(data):
     data_obj = json.loads(data['dataObj'])
-    email, username, password = data_obj.get('email').strip(), data_obj.get('username').strip(), data_obj.get('password').strip()
+    email = data_obj.get('email').strip()
     img = data['userImage'] if data['userImage'] and data['userImage'] != 'null' else None
     if img and not imghdr.what(img):
-        return Response({'message': 'Invalid image file. Ensure you upload a valid image file or remove the image'}, status=400)
+        raise ErrorMessageException('Invalid image file. Ensure you upload a valid image file or remove the image')
     if not valid_email(email):
-        return Response({'message': "Invalid email address. Check your email address and ensure it's valid"}, status=400)
-    if User.objects.filter(email=email).exists():
-        return Response({'message': 'A user with that email address already exists. Please login if you already have an account.'}, status=400)
+        raise ErrorMessageException("Invalid email address. Check your email address and ensure it's valid")
     
-    age, gender, country, city = int(data_obj.get('age')), data_obj.get('gender').strip(), data_obj.get('country').strip(), data_obj.get('city').strip()
-    height = float(data_obj.get('height')) if data_obj.get('height') and data_obj.get('height') != 'null' else None
-    weight = float(data_obj.get('weight')) if data_obj.get('weight') and data_obj.get('weight') != 'null' else None
-    bio = data_obj.get('bio').strip() if data_obj.get('bio') and data_obj.get('bio') != 'null' else None
+    return img, {
+        'email': email,
+        'username': data_obj.get('username').strip(),
+        'password': data_obj.get('password').strip(),
+        'age': int(data_obj.get('age')),
+        'gender': data_obj.get('gender').strip(),
+        'country': data_obj.get('country').strip(),
+        'city': data_obj.get('city').strip(),
+        'height': float(data_obj.get('height')) if data_obj.get('height') and data_obj.get('height') != 'null' else None,
+        'weight': float(data_obj.get('weight')) if data_obj.get('weight') and data_obj.get('weight') != 'null' else None,
+        'bio': data_obj.get('bio').strip() if data_obj.get('bio') and data_obj.get('bio') != 'null' else None,
+    }
+
+
+def create_account(fields, img=None):
+    user = User.objects.create_user(username=fields['username'], email=fields['email'], password=fields['password'])
+    if img:
+        img = store_user_image(user, img)
+    Profile.objects.create(user=user, img=img, **{x: fields[x] for x in ['age', 'gender', 'height', 'weight', 'country', 'city', 'bio']})
+    return user, img
+
+
+def send_welcome_email(user):
+    subject = "Welcome to PowerUp! 🚀"
+    context = {"first_name": user.first_name, "app_url": "https://powerup.onrender.com", 'support_email': os.environ.get('EMAIL_HOST_USER'), 'logo_url': 'https://res.cloudinary.com/dbrgcxign/image/upload/v1745955648/0d51667561df5170ba0bcd0523ed28bf_slkgym.webp'}
+    html_content = render_to_string("welcome_email.html", context)
+    email_sender = formataddr((os.environ.get('EMAIL_SENDER_NAME'), os.environ.get('EMAIL_HOST_USER')))
+    send_email = EmailMultiAlternatives(subject, "", email_sender, [user.email])
+    send_email.attach_alternative(html_content, "text/html")
+    with track('smtp'):
+        send_email.send(fail_silently=False)
+
+
+@api_view(['POST'])
+def register_user(request):
+    try:
+        img, fields = read_registration(request.data)
+    except ErrorMessageException as e:
+        return Response({'message': e.message}, status=400)
+    if User.objects.filter(email=fields['email']).exists():
+        return Response({'message': 'A user with that email address already exists. Please login if you already have an account.'}, status=400)
     
     with transaction.atomic():
         try:
-            user = User.objects.create_user(
-                username=username,
-                email=email,
-                password=password,
-            )
-            if img:
-                img = UserImageFile.objects.create(user=user, url=img, filename=img.name)
-            Profile.objects.create(user=user, age=age, gender=gender, height=height, weight=weight, country=country, city=city, bio=bio, img=img if img else None)
-            subject = "Welcome to PowerUp! 🚀"
-            to_email = user.email
-            context = {"first_name": user.first_name, "app_url": "https://powerup.onrender.com", 'support_email': os.environ.get('EMAIL_HOST_USER'), 'logo_url': 'https://res.cloudinary.com/dbrgcxign/image/upload/v1745955648/0d51667561df5170ba0bcd0523ed28bf_slkgym.webp'}
-            html_content = render_to_string("welcome_email.html", context)
-            email_sender = formataddr((os.environ.get('EMAIL_SENDER_NAME'), os.environ.get('EMAIL_HOST_USER')))
+            user, img = create_account(fields, img)
             try:
-                send_email = EmailMultiAlternatives(subject, "", email_sender, [to_email])
-                send_email.attach_alternative(html_content, "text/html")
-                send_email.send(fail_silently=False)
+                send_welcome_email(user)
             except Exception:
                 transaction.set_rollback(True)
                 log_error(traceback.format_exc())
@@ -544,3 +941,88 @@ def register_user(request):
                 delete_file(img)
             return Response(status=400)
 
+
+# Async views, served in place of register_user and get_user_workout_data when
+# ASYNC_VIEWS is set (see backend/asgi.py)
+@async_api_view(['POST'])
+async def register_user_async(request):
+    """
+    Same contract as register_user. The account is created first, then the
+    image upload and the welcome email run at the same time; if either fails
+    the account is removed again.
+    """
+    try:
+        img, fields = read_registration(request.data)
+    except ErrorMessageException as e:
+        return Response({'message': e.message}, status=400)
+    if await User.objects.filter(email=fields['email']).aexists():
+        return Response({'message': 'A user with that email address already exists. Please login if you already have an account.'}, status=400)
+
+    try:
+        user, _ = await sync_to_async(transaction.atomic(create_account))(fields)
+    except IntegrityError:
+        return Response({'message': 'A user with that username already exists. Please choose a different username.'}, status=400)
+    except Exception:
+        log_error(traceback.format_exc())
+        return Response(status=400)
+
+    # Neither call uses the database, so they run outside the request's database thread
+    image, email_error = await asyncio.gather(
+        sync_to_async(prepare_user_image, thread_sensitive=False)(user, img) if img else asyncio.sleep(0),
+        sync_to_async(send_welcome_email, thread_sensitive=False)(user),
+        return_exceptions=True,
+    )
+    try:
+        if isinstance(image, Exception):
+            raise image
+        if isinstance(email_error, Exception):
+            raise email_error
+        if image:
+            await sync_to_async(save_profile_image)(user, image)
+    except Exception:
+        log_error(traceback.format_exc())
+        if isinstance(image, UserImageFile):
+            await sync_to_async(delete_file, thread_sensitive=False)(image)
+        await user.adelete()
+        if isinstance(email_error, Exception):
+            return Response({'message': 'A network error occurred. Please check your internet connection and try again.'}, status=400)
+        return Response(status=400)
+
+    return Response(status=201)
+
+
+@transaction.atomic
+def save_profile_image(user, image):
+    image.save()
+    Profile.objects.filter(user=user).update(img=image)
+
+
+@async_api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+async def get_user_workout_data_async(request):
+    """
+    Same contract as get_user_workout_data. Images sent with createWorkout and
+    createCommunity are uploaded before the action's transaction starts,
+    outside the request's database thread.
+    """
+    if request.method == 'GET':
+        return await sync_to_async(get_workout_data)(request)
+
+    set_request_action(get_action_name(request.data))
+    context = ActionContext(request.user)
+    field = {'createWorkout': 'selfie', 'createCommunity': 'communityImage'}.get(request.data['type'])
+    uploaded_file = request.data.get(field) if field else None
+    if uploaded_file and not isinstance(uploaded_file, str) and imghdr.what(uploaded_file):
+        try:
+            context.prepared_images[field] = await sync_to_async(prepare_user_image, thread_sensitive=False)(request.user, uploaded_file)
+        except Exception:
+            log_error(traceback.format_exc())
+            return Response(status=400)
+
+    try:
+        return await sync_to_async(perform_workout_action)(request.user, request.data, context)
+    finally:
+        # Left over when the action returned before saving the image
+        for image in context.prepared_images.values():
+            await sync_to_async(delete_file, thread_sensitive=False)(image)
+
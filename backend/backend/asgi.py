@@ -3,14 +3,48 @@ ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+To serve many slow requests (image uploads, the welcome email) from one
+process, run uvicorn workers under gunicorn with ASYNC_VIEWS set:
+
+    ASYNC_VIEWS=true gunicorn backend.asgi:application -k uvicorn.workers.UvicornWorker -w 4
+
+Blocking storage and SMTP calls in the async views run in worker threads, so
+a worker keeps accepting requests while they wait.
+
+WhiteNoise only speaks WSGI, so with ASYNC_VIEWS it is taken out of the
+middleware and requests under STATIC_URL are routed to it here, before they
+reach Django. Those requests still run in a worker thread; put a CDN in front
+of STATIC_URL to keep them off the workers entirely.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
 
 import os
 
+from asgiref.wsgi import WsgiToAsgi
+from django.conf import settings
 from django.core.asgi import get_asgi_application
+from django.core.wsgi import get_wsgi_application
+from whitenoise import WhiteNoise
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
+
+def serve_static_first(django_application, static_application):
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].startswith(settings.STATIC_URL):
+            return await static_application(scope, receive, send)
+        return await django_application(scope, receive, send)
+    return application
+
+
+def get_static_application():
+    # Missing files fall through to Django, which answers them with a 404
+    static = WhiteNoise(get_wsgi_application(), root=settings.STATIC_ROOT, prefix=settings.STATIC_URL, max_age=0 if settings.DEBUG else 60)
+    return WsgiToAsgi(static)
+
+
 application = get_asgi_application()
+if settings.ASYNC_VIEWS:
+    application = serve_static_first(application, get_static_application())
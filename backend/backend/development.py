@@ -34,6 +34,7 @@ DATABASES = {
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+UPLOAD_BACKEND = 'local'
 
 # Cors Config
 CORS_ALLOWED_ORIGINS = [
@@ -45,6 +46,9 @@ PUSHER_APP_ID = os.environ.get('PUSHER_APP_ID_DEV')
 PUSHER_KEY = os.environ.get('PUSHER_KEY_DEV')
 PUSHER_SECRET = os.environ.get('PUSHER_SECRET_DEV')
 PUSHER_CLUSTER = os.environ.get('PUSHER_CLUSTER')
+PUSHER_HOST = os.environ.get('PUSHER_HOST')
+PUSHER_PORT = int(os.environ['PUSHER_PORT']) if os.environ.get('PUSHER_PORT') else None
+PUSHER_SSL = os.environ.get('PUSHER_SSL', 'true').lower() != 'false'
 
 # # Silk
 # SILKY_PYTHON_PROFILER = True
@@ -11,7 +11,8 @@ ALLOWED_HOSTS = [
 DATABASES = {
     'default':  dj_database_url.config(
         default=os.environ.get('DATABASE_URL'),
-        conn_max_age=600,
+        # Async requests run in short-lived threads, which would each keep a connection open
+        conn_max_age=0 if ASYNC_VIEWS else 600,
         conn_health_checks=True,
     )
 }
@@ -21,8 +22,14 @@ CORS_ALLOWED_ORIGINS = [
     "https://powerup-1fqe.onrender.com",
 ]
 
+# Direct uploads go to Cloudinary
+UPLOAD_BACKEND = 'cloudinary'
+
 # Pusher
 PUSHER_CLUSTER = os.environ.get('PUSHER_CLUSTER')
+PUSHER_HOST = os.environ.get('PUSHER_HOST')
+PUSHER_PORT = int(os.environ['PUSHER_PORT']) if os.environ.get('PUSHER_PORT') else None
+PUSHER_SSL = os.environ.get('PUSHER_SSL', 'true').lower() != 'false'
 PUSHER_APP_ID = os.environ.get('PUSHER_APP_ID_PROD')
 PUSHER_KEY = os.environ.get('PUSHER_KEY_PROD')
 PUSHER_SECRET = os.environ.get('PUSHER_SECRET_PROD')
@@ -30,9 +30,13 @@ INSTALLED_APPS = [
     'cloudinary',
 ]
 
+# Set ASYNC_VIEWS when serving through ASGI workers (see backend/asgi.py) to
+# route register and workout/data to their async variants.
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', 'false').lower() == 'true'
+
 MIDDLEWARE = [
+    'api.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -42,6 +46,11 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.gzip.GZipMiddleware',
 ]
+# WhiteNoise is sync-only. Under ASGI it would move every request, not just
+# static ones, to a worker thread and back, so with ASYNC_VIEWS backend/asgi.py
+# serves STATIC_URL in front of Django instead.
+if not ASYNC_VIEWS:
+    MIDDLEWARE.insert(2, 'whitenoise.middleware.WhiteNoiseMiddleware')
 
 
 ROOT_URLCONF = 'backend.urls'
@@ -109,9 +118,105 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'api.authentication.ProfileJWTAuthentication',
+    ),
+    # JSON stays the default; clients opt in to MessagePack with Accept and Content-Type
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.ORJSONRenderer',
+        'api.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+        'api.renderers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
+}
+
+# Cache
+# Set CACHE_REDIS_URL so version stamps are shared by every worker process.
+# The local memory fallback is per process, so changes reach other workers
+# only when their entries expire.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['CACHE_REDIS_URL'],
+    } if os.environ.get('CACHE_REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
 }
+# Access tokens are trusted without reading the user row only when the cache
+# is shared, so a revoked user (see api.authentication) is seen by every worker
+AUTH_TRUST_TOKEN_CLAIMS = bool(os.environ.get('CACHE_REDIS_URL'))
+# How long a refresh token found missing from the blacklist is trusted without
+# a query. Only safe with a shared cache, where blacklist() clears the entry on every worker
+AUTH_BLACKLIST_MISS_SECONDS = 300 if os.environ.get('CACHE_REDIS_URL') else 0
+WORKOUT_TYPES_CACHE_TIMEOUT = 300
+
+# Uploaded image renditions
+IMAGE_RENDITION_FORMAT = 'WEBP'
+IMAGE_RENDITION_QUALITY = 80
+
+# 'sync' stores uploads during the request; 'deferred' spools them locally and
+# leaves the storage upload to the process_pending_uploads worker
+MEDIA_UPLOAD_MODE = os.environ.get('MEDIA_UPLOAD_MODE', 'sync')
+MEDIA_SPOOL_DIR = os.environ.get('MEDIA_SPOOL_DIR', os.path.join(BASE_DIR, 'spool'))
+MEDIA_UPLOAD_MAX_ATTEMPTS = 5
+
+# Storage garbage collection
+STORAGE_DELETE_WORKERS = 8
+STORAGE_DELETE_MAX_ATTEMPTS = 10
+# Deletions claimed by a worker that stops before recording the result are retried after this
+STORAGE_DELETE_CLAIM_SECONDS = 300
+
+# Direct upload tickets
+# 'local' matches the default file storage; production.py switches to 'cloudinary'
+UPLOAD_BACKEND = 'local'
+UPLOAD_TICKET_MAX_AGE = 600
+UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+
+# Request metrics
+# Each worker process writes its histograms to METRICS_DIR and /metrics merges
+# them, so the directory must be shared by all workers on the host. /metrics
+# answers only when METRICS_TOKEN is set and sent as a bearer token.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(BASE_DIR, 'metrics'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_FLUSH_SECONDS = 5
+
+# Workout history pagination
+WORKOUT_PAGE_SIZE = 50
+WORKOUT_MAX_PAGE_SIZE = 200
+
+# Community detail pagination
+COMMUNITY_PAGE_SIZE = 50
+COMMUNITY_MAX_PAGE_SIZE = 200
+
+# Challenge leaderboards
+LEADERBOARD_SIZE = 10
+LEADERBOARD_NEIGHBOURS = 5
+LEADERBOARD_MAX_SIZE = 100
+
+# Delta sync
+SYNC_SETTLE_SECONDS = 30
+SYNC_MAX_CHANGES = 2000
+SYNC_CHANGE_RETENTION_DAYS = 30
+
+# Realtime event outbox
+PUSHER_TIMEOUT = 5
+PUSHER_POOL_SIZE = 4
+REALTIME_MAX_ATTEMPTS = 10
+REALTIME_RETRY_BASE_SECONDS = 2
+REALTIME_RETRY_MAX_SECONDS = 300
+# Events claimed by a worker that stops before recording the result are retried after this
+REALTIME_CLAIM_SECONDS = 60
+# Largest size of a coalesced membership event, kept under Pusher's 10 KB
+# limit per event with a margin
+REALTIME_COALESCE_MAX_BYTES = 8192
+
+# Batched workout/data actions
+WORKOUT_BATCH_MAX_ACTIONS = 100
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=30),